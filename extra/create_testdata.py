@@ -408,12 +408,12 @@ def create_news_test_data():
     # comments
     replies = {'small': 4, 'medium': 8, 'large': 12}[SIZE]
     articles = Article.query.all()
-    for article in articles:
-        for x in xrange(randrange(replies * 4)):
-            article = choice(articles)
-            user = choice(users)
-            comment = Comment(text=chomsky(randint(0, 5) or 10),
-                author=user, article=article)
+    comments = ({'text': chomsky(randint(0, 5) or 10),
+                 'author_id': choice(users).id,
+                 'article_id': choice(articles).id}
+                for article in articles for x in xrange(randrange(replies * 4)))
+    db.bulk_insert(Comment, comments,
+                   counters={'article_id': (Article, 'comment_count')})
     db.session.commit()
 
 
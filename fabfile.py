@@ -56,6 +56,100 @@ def reset(no_testdata=False):
         local("python %s" % _j('extra/create_testdata.py'), capture=False)
 
 
+def reconcile_counters(fix='yes', chunk_size=1000):
+    """
+    Recompute the denormalized counters and report the drift found.
+
+    Specify fix=no to only report the drift without correcting it.
+    """
+    dispatcher = _make_app()
+    from inyoka.core.database import db
+    report = db.reconcile_counters(int(chunk_size), fix.lower() in ('yes', 'y'))
+    for name, drift in sorted(report.iteritems()):
+        print u'%s: %d rows drifted, %+d in total' % (name, len(drift),
+                                                      sum(drift.values()))
+
+
+def build_manifest():
+    """
+    Write the component manifest and the revision file of the build.
+
+    With a manifest Inyoka imports components on first use instead of
+    importing every module on startup.  Rerun this after adding components
+    or changing activated_components.
+    """
+    import json
+    for filename in ('components.json', 'REVISION'):
+        if _path.exists(_j('inyoka', filename)):
+            os.remove(_j('inyoka', filename))
+    from inyoka import get_hg_revision, MANIFEST_FILE, REVISION_FILE
+    from inyoka.core.api import ctx
+    with open(_j('inyoka', MANIFEST_FILE), 'w') as fobj:
+        json.dump(ctx.dump_manifest(), fobj, indent=2, sort_keys=True)
+    with open(_j('inyoka', REVISION_FILE), 'w') as fobj:
+        fobj.write(get_hg_revision(_base_dir) or 'unknown')
+
+
+def compress_static(level=9):
+    """
+    Write gzip compressed siblings of the static files.
+
+    The static file middleware serves them to clients accepting gzip.  Rerun
+    this on every deployment, outdated siblings are ignored.
+    """
+    dispatcher = _make_app()
+    import gzip
+    import mimetypes
+    from inyoka.core.middlewares.static import STATIC_PATH
+    from inyoka.core.middlewares.compression import is_compressible
+    count = 0
+    for root, dirs, files in os.walk(STATIC_PATH):
+        for name in files:
+            mimetype = mimetypes.guess_type(name)[0]
+            if name.endswith('.gz') or not mimetype or \
+               not is_compressible(mimetype):
+                continue
+            filename = _path.join(root, name)
+            with open(filename, 'rb') as fobj:
+                data = fobj.read()
+            compressed = gzip.GzipFile(filename + '.gz', 'wb', int(level))
+            try:
+                compressed.write(data)
+            finally:
+                compressed.close()
+            count += 1
+    print u'Compressed %d static files' % count
+
+
+def compile_templates():
+    """
+    Compile all templates to Python modules.
+
+    Enable templates.use_compiled to load them instead of compiling the
+    templates in every worker.  Rerun this on every deployment, changed
+    templates are not reloaded.
+    """
+    dispatcher = _make_app()
+    from inyoka.core.templating import compile_templates
+    print u'Compiled %d templates' % compile_templates()
+
+
+def build_assets(compress='yes'):
+    """
+    Write the static asset bundles, fingerprinted copies and the manifest.
+
+    Templates refer to the fingerprinted files which are cached forever by
+    clients.  Run this on every deployment, by default ``compress_static``
+    is run afterwards.
+    """
+    dispatcher = _make_app()
+    from inyoka.core.assets import build_assets
+    manifest = build_assets()
+    print u'Built %d static files' % len(set(manifest['assets'].values()))
+    if compress == 'yes':
+        compress_static()
+
+
 def _action(*args, **kwargs):
     def _inner(app_factory, hostname=None, port=None, server='simple'):
         from inyoka.core.api import ctx
@@ -285,6 +379,61 @@ def lsdns(basedomain=None):
     ctx.cfg['base_domain_name'] = _old
 
 
+def bench_routing(rounds=100):
+    """
+    Match an URL of every rule of the URL map `rounds` times, once with our
+    partitioned map and once with a plain werkzeug map.
+    """
+    from timeit import default_timer
+    from werkzeug.routing import Map as WerkzeugMap, NumberConverter
+    from werkzeug.exceptions import HTTPException
+    from inyoka.core.api import ctx
+
+    url_map = ctx.dispatcher.url_map
+    plain_map = WerkzeugMap([rule.empty() for rule in url_map.iter_rules()],
+                            converters=url_map.converters)
+    urls = []
+    for rule in url_map.iter_rules():
+        values = dict((arg, 1 if isinstance(converter, NumberConverter)
+                            else u'foo')
+                      for arg, converter in rule._converters.iteritems())
+        try:
+            urls.append(rule.build(values))
+        except Exception:
+            continue
+
+    for name, map in (('partitioned', url_map), ('werkzeug', plain_map)):
+        adapters = {}
+        start = default_timer()
+        for x in xrange(int(rounds)):
+            for subdomain, path in urls:
+                adapter = adapters.get(subdomain)
+                if adapter is None:
+                    adapter = adapters[subdomain] = map.bind(
+                        ctx.cfg['base_domain_name'], subdomain=subdomain)
+                try:
+                    adapter.match(path)
+                except HTTPException:
+                    pass
+        duration = default_timer() - start
+        print u'%s: %d matches in %.3fs (%.1fus per match)' % (
+            name, len(urls) * int(rounds), duration,
+            duration * 1e6 / (len(urls) * int(rounds)))
+
+
+def profile(endpoint, sort='cumulative', count=30):
+    """
+    Print the profile of `endpoint` collected by the profiler middleware.
+    """
+    dispatcher = _make_app()
+    from inyoka.core.middlewares.profiler import load_profile
+    stats = load_profile(endpoint)
+    if stats is None:
+        print u'No profile for %s' % endpoint
+        return
+    stats.sort_stats(sort).print_stats(int(count))
+
+
 def reindex(index):
     """
     Iterate over all documents we're able to find (even those that are already
@@ -11,8 +11,9 @@
     :license: GNU GPL, see LICENSE for more details.
 """
 import os
+import sys
 import socket
-from os.path import realpath, dirname, join, pardir
+from os.path import realpath, dirname, join, pardir, isfile
 from inspect import getmembers, isclass
 from operator import methodcaller
 from itertools import imap
@@ -21,18 +22,22 @@ from werkzeug import find_modules, import_string, cached_property
 
 from logbook import Processor
 
-from mercurial import ui as hgui
-from mercurial.localrepo import localrepository
-from mercurial.node import short as shorthex
-
 from inyoka.utils.logger import logger
 from inyoka.context import LocalProperty
-from inyoka.core.config import ListConfigField
+from inyoka.core.config import Configuration, ListConfigField
 
 
 #: Inyoka revision present in the current mercurial working copy
 INYOKA_REVISION = 'unknown'
 
+#: Name of the file in the Inyoka module that contains the revision of the
+#: build.  It's written by ``fab build_manifest``.
+REVISION_FILE = 'REVISION'
+
+#: Name of the component manifest in the Inyoka module, see
+#: :meth:`ApplicationContext.dump_manifest`.
+MANIFEST_FILE = 'components.json'
+
 #: List of activated components.  This defaults to load all components
 #  from the inyoka.* namespace.
 activated_components = ListConfigField('activated_components',
@@ -79,7 +84,7 @@ class InterfaceMeta(type):
             # base class for that component.
             mro = sum(imap(methodcaller('mro'), bases), [])
             # bind all classes that implement the interface protocol.
-            obj._interfaces = {c for c in mro if '_isinterface' in dir(c)}
+            obj._interfaces = {c for c in mro if hasattr(c, '_isinterface')}
 
         return obj
 
@@ -107,6 +112,38 @@ def _is_interface(value):
             value is not Interface)
 
 
+def _get_path(obj):
+    """Return the dotted import path of a class."""
+    return obj.__module__ + '.' + obj.__name__
+
+
+def _get_eager_modules():
+    """Return the names of the imported modules that have to be imported
+    on startup.  These are the modules that define configuration fields on
+    module or class level and the modules that define database models,
+    as those register counters and caches needed by the tasks.
+    """
+    fields = set(imap(id, Configuration.defined_vars.itervalues()))
+    database = sys.modules.get('inyoka.core.database')
+    model = getattr(database, 'Model', None)
+    modules = set()
+    for name, module in sys.modules.items():
+        if module is None:
+            continue
+        for value in vars(module).values():
+            if isclass(value) and value.__module__ == name:
+                if model is not None and issubclass(value, model):
+                    modules.add(name)
+                    break
+                values = vars(value).values()
+            else:
+                values = (value,)
+            if any(id(v) in fields for v in values):
+                modules.add(name)
+                break
+    return sorted(modules)
+
+
 def _import_module(module, ignore_modules=None):
     """Import the components to setup the metaclass magic.
 
@@ -149,9 +186,10 @@ class ApplicationContext(object):
         self._components = {}
         #: component class -> instance mapping
         self._instances = {}
+        #: Interface path -> component paths not imported yet
+        self._pending = {}
 
         # setup config
-        from inyoka.core.config import Configuration
         cfile = os.environ.get('INYOKA_CONFIG', 'inyoka.ini')
         self.cfg = cfg = Configuration(join(realpath(
             os.environ['INYOKA_INSTANCE']), cfile))
@@ -183,11 +221,14 @@ class ApplicationContext(object):
     def component_is_activated(self, component, deactivated_packages=None):
         """Checks whether a component should be added to the registry or not.
 
-        :param component: The component to check.
+        :param component: The component or its dotted import path.
         :param deactivated_packages: List of packages not to load.
         """
         deactivated_packages = deactivated_packages or []
-        component_path = component.__module__ + '.' + component.__name__
+        if isinstance(component, basestring):
+            component_path = component
+        else:
+            component_path = _get_path(component)
         for path in deactivated_packages:
             if path[-1] == '*':
                 if component_path.startswith(path[:-2]):
@@ -242,6 +283,8 @@ class ApplicationContext(object):
         """
         logger.debug(u'Unload component %r' % component)
         isinterface = getattr(component, '_isinterface', False)
+        if isinterface:
+            self._pending.pop(_get_path(component), None)
         if isinterface and component in self._components:
             self._components.pop(component)
             return True
@@ -288,6 +331,43 @@ class ApplicationContext(object):
 
         return self.load_components(components)
 
+    def dump_manifest(self):
+        """Return a manifest of the loaded components for
+        :meth:`load_manifest`.  It's a dictionary with the dotted import
+        paths of the components per interface in ``components`` and of the
+        modules defining configuration fields or database models in
+        ``modules``.
+        """
+        components = dict(
+            (_get_path(interface), sorted(imap(_get_path, implementations)))
+            for interface, implementations in self._components.iteritems())
+        return {'components': components, 'modules': _get_eager_modules()}
+
+    def load_manifest(self, manifest, deactivated_components=None):
+        """Register the components of a manifest returned by
+        :meth:`dump_manifest` without importing them.  Only the modules
+        defining configuration fields or database models are imported
+        right away, the
+        components of an interface are imported the first time
+        :meth:`get_implementations` is asked for it.
+
+        :param manifest: The manifest dictionary.
+        :param deactivated_components: Components to ignore.
+        """
+        for module in manifest['modules']:
+            import_string(module)
+        deactivated_components = set((deactivated_components or
+                                      self.cfg['deactivated_components']))
+        for interface, components in manifest['components'].iteritems():
+            self._pending.setdefault(interface, set()).update(
+                path for path in components
+                if self.component_is_activated(path, deactivated_components))
+
+    def _load_pending(self, interface):
+        paths = self._pending.pop(_get_path(interface), None)
+        if paths:
+            self.load_components(imap(import_string, paths))
+
     def get_implementations(self, interface, instances=False):
         """Return all known implementations of `interface`.
 
@@ -295,6 +375,8 @@ class ApplicationContext(object):
         :param instances: Return all implementations as instances not classes.
 
         """
+        if self._pending:
+            self._load_pending(interface)
         if not instances:
             return self._components.get(interface, ())
         return {self.get_instance(impl) for impl in self._components.get(interface, ())}
@@ -316,6 +398,26 @@ class ApplicationContext(object):
         return self.dispatcher(environ, start_response)
 
 
+def get_hg_revision(path):
+    """Return the ``rev:node`` of the tip of the mercurial repository at
+    `path` or `None` if there is none.
+    """
+    try:
+        from mercurial import ui as hgui
+        from mercurial.error import RepoError
+        from mercurial.localrepo import localrepository
+        from mercurial.node import short as shorthex
+    except ImportError:
+        return None
+    try:
+        repository = localrepository(hgui.ui(), path)
+        ctx = repository['tip']
+    except (RepoError, TypeError):
+        # fail silently
+        return None
+    return '%(num)s:%(id)s' % {'num': ctx.rev(), 'id': shorthex(ctx.node())}
+
+
 def _bootstrap():
     """Get the Inyoka version and store it."""
     global INYOKA_REVISION
@@ -327,16 +429,15 @@ def _bootstrap():
     os.environ['INYOKA_INSTANCE'] = realpath(join(conts, pardir))
     os.environ['CELERY_LOADER'] = 'inyoka.core.celery_support.CeleryLoader'
 
-    # get the `INYOKA_REVISION` using the mercurial python api
-    try:
-        ui = hgui.ui()
-        repository = localrepository(ui, join(conts, '..'))
-        ctx = repository['tip']
-        INYOKA_REVISION = ('%(num)s:%(id)s' %
-            {'num': ctx.rev(), 'id': shorthex(ctx.node())})
-    except TypeError:
-        # fail silently
-        pass
+    # get the `INYOKA_REVISION` from the build, fall back to the mercurial
+    # python api in a working copy
+    revision_file = join(conts, REVISION_FILE)
+    if isfile(revision_file):
+        with open(revision_file) as fobj:
+            INYOKA_REVISION = fobj.read().strip() or INYOKA_REVISION
+    else:
+        INYOKA_REVISION = get_hg_revision(join(conts, pardir)) or \
+                          INYOKA_REVISION
 
     # This value defines the timeout for sockets in seconds.  Per default python
     # sockets do never timeout and as such we have blocking workers.
@@ -348,8 +449,15 @@ def _bootstrap():
     ctx = ApplicationContext()
     ctx.bind()
 
-    # setup components
-    ctx.load_packages(ctx.cfg['activated_components'])
+    # setup components, use the manifest of the build if there is one so
+    # that components are only imported once they are used
+    manifest_file = join(conts, MANIFEST_FILE)
+    if isfile(manifest_file):
+        import json
+        with open(manifest_file) as fobj:
+            ctx.load_manifest(json.load(fobj))
+    else:
+        ctx.load_packages(ctx.cfg['activated_components'])
     if ctx.cfg['testing']:
         logger.level_name = 'ERROR'
 
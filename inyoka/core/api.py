@@ -13,7 +13,7 @@ from inyoka.context import ctx
 from inyoka.core.resource import IResourceManager
 from inyoka.core.config import BooleanConfigField, TextConfigField, \
     IntegerConfigField, DottedConfigField, ListConfigField
-from inyoka.core.models import Cache, Confirm, Tag, Storage
+from inyoka.core.models import Cache, Confirm, Tag, Storage, SlugCounter
 
 
 #: The default path to media files.
@@ -72,6 +72,11 @@ class ICoreResourceManager(IResourceManager):
     #: The duration a permanent session is valid.  Defined in days, defaults to 30
     permanent_session_lifetime = IntegerConfigField('permanent_session_lifetime', default=30)
 
+    #: Check the configuration file for changes at most every n seconds.
+    #: ``0`` checks it on every request.
+    config_check_interval = IntegerConfigField('config_check_interval',
+                                               default=5, min_value=0)
+
     #: Path to the directory that includes static files.  Relative to the inyoka
     #: package path.
     static_path = TextConfigField('static_path', default=u'static')
@@ -80,13 +85,14 @@ class ICoreResourceManager(IResourceManager):
     deactivated_components.default.append('inyoka.core.tasks')
 
     #: register core models
-    models = [Cache, Confirm, Tag, Storage]
+    models = [Cache, Confirm, Tag, Storage, SlugCounter]
 
 
 # Import shortcuts
 from inyoka.core.database import db
 from inyoka.core.auth.decorators import login_required
-from inyoka.core.http import Request, Response, redirect_to, redirect
+from inyoka.core.http import Request, Response, redirect_to, redirect, \
+     conditional
 from inyoka.core.routing import IController, IServiceProvider
 from inyoka.core.routing import view, service, Rule, href
 from inyoka.core.templating import templated, render_template
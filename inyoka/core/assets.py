@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+    inyoka.core.assets
+    ~~~~~~~~~~~~~~~~~~
+
+    A deploy-time pipeline for the static JavaScript and CSS files.
+
+    ``fab build_assets`` concatenates the files of the :data:`BUNDLES`,
+    writes every asset under a name containing a hash of its content and
+    records those names in a manifest.  Templates resolve assets with
+    :func:`asset_url` and :func:`asset_urls`, the static file middleware
+    serves fingerprinted files with far-future cache headers since their
+    content never changes.
+
+    Without a manifest or in debug mode the source files are used.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+import os
+import re
+import json
+from hashlib import md5
+from os.path import join, isfile, splitext
+from threading import Lock
+from inyoka.context import ctx
+from inyoka.core.config import BooleanConfigField
+from inyoka.core.routing import href
+
+
+#: Use the fingerprinted assets of the manifest, ignored in debug mode
+assets_enabled = BooleanConfigField('assets.enabled', default=True)
+
+#: The name of the manifest, relative to the static path
+MANIFEST_FILE = 'assets.json'
+
+#: The directories below the static path that contain assets
+ASSET_DIRECTORIES = ('js', 'style')
+
+#: Bundles and the files they are concatenated from, in order
+BUNDLES = {
+    'js/core.bundle.js': ['js/jquery.js', 'js/jquery.ui.js', 'js/classy.js',
+                          'js/babel.js', 'js/inyoka.js'],
+    'js/base.bundle.js': ['js/overall.js', 'js/html5.js'],
+    'style/base.bundle.css': ['style/reset.css', 'style/table.css',
+                              'style/forms.css', 'style/markup.css',
+                              'style/typography.css', 'style/layout.css',
+                              'style/debug.css'],
+    'style/paste.bundle.css': ['style/paste.css', 'style/diff.css',
+                               'style/highlighting.css'],
+}
+
+#: Matches the names written by :func:`build_assets`
+FINGERPRINT_RE = re.compile(r'\.([0-9a-f]{12})\.[a-z0-9]+$')
+
+_separators = {'.js': ';\n', '.css': '\n'}
+
+_manifest = None
+_manifest_lock = Lock()
+
+
+def get_static_path():
+    """Return the directory of the static files."""
+    return join(os.environ['INYOKA_MODULE'], ctx.cfg['static_path'])
+
+
+def get_fingerprint(path):
+    """Return the content hash in the name of `path` or `None` if
+    `path` is not fingerprinted.
+    """
+    match = FINGERPRINT_RE.search(path)
+    if match is not None:
+        return match.group(1)
+
+
+def _read(static_path, path):
+    with open(join(static_path, path), 'rb') as fobj:
+        return fobj.read()
+
+
+def _write_fingerprinted(static_path, path, data):
+    root, ext = splitext(path)
+    target = '%s.%s%s' % (root, md5(data).hexdigest()[:12], ext)
+    filename = join(static_path, target)
+    # the content is part of the name, so existing files are up to date
+    if not isfile(filename):
+        with open(filename, 'wb') as fobj:
+            fobj.write(data)
+    return target
+
+
+def build_assets(static_path=None):
+    """Write the bundles and fingerprinted copies of all other assets
+    below `static_path` and the manifest mapping every asset to the file
+    serving it.  Files of previous builds are kept for pages still
+    referring to them.  Return the manifest.
+    """
+    static_path = static_path or get_static_path()
+    bundled = set()
+    for members in BUNDLES.itervalues():
+        bundled.update(members)
+
+    assets = {}
+    for directory in ASSET_DIRECTORIES:
+        for name in sorted(os.listdir(join(static_path, directory))):
+            path = '%s/%s' % (directory, name)
+            if splitext(name)[1] not in _separators or \
+               get_fingerprint(name) is not None or path in bundled:
+                continue
+            assets[path] = _write_fingerprinted(static_path, path,
+                                                _read(static_path, path))
+
+    for bundle, members in BUNDLES.iteritems():
+        separator = _separators[splitext(bundle)[1]]
+        data = separator.join(_read(static_path, path) for path in members)
+        target = _write_fingerprinted(static_path, bundle, data)
+        for path in members:
+            assets[path] = target
+
+    manifest = {'assets': assets}
+    filename = join(static_path, MANIFEST_FILE)
+    with open(filename + '.tmp', 'w') as fobj:
+        json.dump(manifest, fobj, indent=2, sort_keys=True)
+    os.rename(filename + '.tmp', filename)
+    return manifest
+
+
+def get_manifest():
+    """Return the asset manifest or `None` if fingerprinted assets are
+    not used.  The manifest is loaded once per process.
+    """
+    global _manifest
+    cfg = ctx.cfg
+    if cfg['debug'] or not cfg['assets.enabled']:
+        return None
+    if _manifest is None:
+        with _manifest_lock:
+            if _manifest is None:
+                filename = join(get_static_path(), MANIFEST_FILE)
+                manifest = {}
+                if isfile(filename):
+                    with open(filename) as fobj:
+                        manifest = json.load(fobj)
+                _manifest = manifest.get('assets', {})
+    return _manifest or None
+
+
+def reset_manifest():
+    """Forget the loaded manifest so that it is read again."""
+    global _manifest
+    _manifest = None
+
+
+def asset_url(path):
+    """Return the URL of the static file `path` or of the file serving
+    it according to the manifest.
+    """
+    manifest = get_manifest()
+    if manifest is not None:
+        path = manifest.get(path, path)
+    return href('static', file=path)
+
+
+def asset_urls(names, directory, exclude=()):
+    """Return the URLs of the static files `names` in `directory`, each
+    bundle is only included once.  Files that are served by the same
+    bundle as one of the names in `exclude` are left out, use it for files
+    included before.
+    """
+    manifest = get_manifest() or {}
+    def _resolve(name):
+        path = '%s/%s' % (directory, name)
+        return manifest.get(path, path)
+    seen = set(_resolve(name) for name in exclude)
+    urls = []
+    for name in names:
+        target = _resolve(name)
+        if target not in seen:
+            seen.add(target)
+            urls.append(href('static', file=target))
+    return urls
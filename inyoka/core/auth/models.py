@@ -13,7 +13,6 @@ from datetime import datetime
 from werkzeug import cached_property
 
 from inyoka.i18n import _
-from inyoka.core.cache import cache
 from inyoka.context import ctx
 from inyoka.core.database import db
 from inyoka.core.serializer import SerializableObject
@@ -45,6 +44,8 @@ user_group = db.Table('core_group_user', db.metadata,
 class Group(db.Model):
     __tablename__ = 'core_group'
 
+    reference = db.ReferenceData('name')
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Unicode(40), unique=True)
 
@@ -84,13 +85,9 @@ class UserQuery(db.Query):
         return super(UserQuery, self).get(pk)
 
     def get_anonymous(self):
-        user = cache.get('core/anonymous')
-        if user is None:
-            name = ctx.cfg['anonymous_name']
-            user = User.query.get(name)
-            cache.set('core/anonymous', user)
-        user = db.session.merge(user, load=False)
-        return user
+        name = ctx.cfg['anonymous_name']
+        return User.reference.lookup(db.session, 'username', name,
+                                     lambda: User.query.get(name))
 
 
 class AutomaticUserProfile(db.MapperExtension):
@@ -106,6 +103,9 @@ class User(db.Model, SerializableObject):
 
     query = db.session.query_property(UserQuery)
 
+    #: Only used for the anonymous user, see :meth:`UserQuery.get_anonymous`
+    reference = db.ReferenceData('username', queries=False)
+
     # serializer properties
     object_type = 'inyoka.user'
     public_fields = ('id', 'username', 'pw_hash', 'status', 'real_name')
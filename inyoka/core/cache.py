@@ -14,16 +14,19 @@
 """
 import time
 import random
+from hashlib import md5
 from os.path import join
 from datetime import datetime
 from functools import wraps
 from werkzeug.contrib.cache import NullCache, SimpleCache, FileSystemCache, \
      MemcachedCache, BaseCache, GAEMemcachedCache
 from inyoka.context import ctx
+from inyoka.i18n import get_locale
 from inyoka.core.database import db
 from inyoka.core.models import Cache
 from inyoka.core.config import TextConfigField, IntegerConfigField
 from inyoka.utils import flatten_list
+from inyoka.utils.timing import timed_function
 
 
 __all__ = ('cache',)
@@ -44,6 +47,13 @@ caching_timeout = IntegerConfigField('caching.timeout', default=300, min_value=1
 #: Set the memcached servers.  Comma seperated list of memcached servers
 caching_memcached_servers = TextConfigField('caching.memcached_servers', default=u'')
 
+#: Serve expired template fragments for n more seconds while they are rendered again
+caching_fragment_grace_time = IntegerConfigField('caching.fragment_grace_time',
+                                                 default=30, min_value=1)
+
+#: The timeout of the generation numbers of fragment cache tags
+FRAGMENT_TAG_TIMEOUT = 30 * 24 * 60 * 60
+
 
 
 class DatabaseCache(BaseCache):
@@ -278,6 +288,55 @@ def clear_memoized(*keys):
     _memoized[:] = [x for x in _memoized if not deletes(x)]
 
 
+def _get_fragment_key(key, tags):
+    # changing the generation of a tag changes the keys of its fragments
+    generations = [cache.get('fragment-tag/%s' % tag) for tag in tags]
+    data = repr((key, str(get_locale()), zip(tags, generations)))
+    return 'fragment/%s' % md5(data).hexdigest()
+
+
+def cached_fragment(key, render, timeout=None, tags=()):
+    """Return the template fragment cached for `key` and the current
+    language or call `render` to create and cache it.  Use the
+    ``{% cache %}`` template tag instead of calling this directly.
+
+    An expired fragment is rendered again by the first request noticing
+    it.  Other requests get the old fragment for up to
+    ``caching.fragment_grace_time`` seconds meanwhile, so that they do not
+    render it at the same time.
+
+    :param key: The key of the fragment, any value with a stable `repr`.
+    :param render: A callable returning the fragment.
+    :param timeout: The seconds the fragment is valid, ``caching.timeout``
+                    by default.
+    :param tags: Names to invalidate the fragment with, see
+                 :func:`invalidate_fragments`.
+    """
+    if timeout is None:
+        timeout = ctx.cfg['caching.timeout']
+    grace_time = ctx.cfg['caching.fragment_grace_time']
+    cache_key = _get_fragment_key(key, list(tags))
+    now = time.time()
+    rv = cache.get(cache_key)
+    if rv is not None:
+        expires, value = rv
+        if expires > now:
+            return value
+        cache.set(cache_key, (now + grace_time, value), timeout=grace_time)
+    value = render()
+    cache.set(cache_key, (now + timeout, value), timeout=timeout + grace_time)
+    return value
+
+
+def invalidate_fragments(*tags):
+    """Drop all template fragments cached with one of `tags`."""
+    for tag in tags:
+        key = 'fragment-tag/%s' % tag
+        # memcached does not increment missing keys
+        cache.add(key, 0, timeout=FRAGMENT_TAG_TIMEOUT)
+        cache.inc(key)
+
+
 #: the cache system factories.
 CACHE_SYSTEMS = {
     'null': lambda: NullCache(),
@@ -300,6 +359,12 @@ def set_cache():
     """
     global cache
     cache = CACHE_SYSTEMS[ctx.cfg['caching.system']]()
+    # account the time spent in the cache to the current request
+    for name in ('get', 'get_many', 'get_dict', 'set', 'add', 'set_many',
+                 'delete', 'delete_many', 'inc', 'dec'):
+        method = getattr(cache, name, None)
+        if method is not None:
+            setattr(cache, name, timed_function('cache', method))
     return cache
 
 # enable the caching system
@@ -11,6 +11,7 @@
 """
 import os
 from os import path
+from time import time
 from threading import Lock
 from wtforms.validators import ValidationError
 from markupsafe import soft_unicode
@@ -195,6 +196,7 @@ class Configuration(object):
         self._values = {}
         self._converted_values = {}
         self._lock = Lock()
+        self._next_check = 0
         with self._lock:
             self._load_config()
 
@@ -310,6 +312,22 @@ class Configuration(object):
             return False
         return path.getmtime(self.filename) > self._load_time
 
+    def reload_if_changed(self, interval=0):
+        """Reload the configuration if there are changes on the file system.
+        The file system is asked at most every `interval` seconds, calls in
+        between return `False` without touching the file.
+
+        Return `True` if the configuration was reloaded.
+        """
+        now = time()
+        if now < self._next_check:
+            return False
+        self._next_check = now + interval
+        if self.changed_external:
+            self.reload()
+            return True
+        return False
+
     def __iter__(self):
         """Iterate over all keys"""
         return iter(self.defined_vars)
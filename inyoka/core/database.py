@@ -78,44 +78,56 @@ import sys
 import time
 from os import remove, path
 from types import ModuleType
-from threading import Lock
+from threading import Lock, local as thread_local
 from contextlib import contextmanager
+from operator import itemgetter
 from datetime import datetime
+from uuid import uuid4
 from werkzeug import FileStorage
 from mimetypes import guess_type
 import sqlalchemy
 from sqlalchemy import MetaData, create_engine
 from sqlalchemy import orm, sql, exc, func
-from sqlalchemy.interfaces import ConnectionProxy
+from sqlalchemy.interfaces import ConnectionProxy, PoolListener
 from sqlalchemy.orm.session import Session as SASession
 from sqlalchemy.engine.url import make_url, URL
 from sqlalchemy.util import to_list
 from sqlalchemy.orm.interfaces import AttributeExtension
 from sqlalchemy.orm.attributes import get_attribute, set_attribute
 from sqlalchemy.pool import QueuePool
+from sqlalchemy import queue as sqla_queue
 from sqlalchemy.ext.declarative import declarative_base, \
     DeclarativeMeta as SADeclarativeMeta
 from sqlalchemy.ext.compiler import compiles
-from sqlalchemy.types import MutableType, TypeDecorator
+from sqlalchemy.types import MutableType, TypeDecorator, NullType
 from sqlalchemy.engine import reflection
 from sqlalchemy.schema import DropTable, DropConstraint
+from sqlalchemy.sql.expression import FunctionElement
 from inyoka import InterfaceMeta
 from inyoka.context import ctx
 from inyoka.core.resource import IResourceManager
 from inyoka.utils import flatten_iterator
-from inyoka.utils.text import get_next_increment, gen_ascii_slug
-from inyoka.utils.debug import find_calling_context
+from inyoka.utils.text import gen_ascii_slug
+from inyoka.utils.debug import find_calling_context, NPlusOneDetector
+from inyoka.utils.logger import logger
+from inyoka.utils.stats import Aggregate, Histogram
 from inyoka.utils.files import find_unused_filename, obfuscate_filename
 from inyoka.core.config import BooleanConfigField, TextConfigField, \
     IntegerConfigField
 from itertools import imap
 from itertools import ifilter
+from itertools import count, islice, izip, chain
 from io import open
 
 
 _engine = None
+_replica_engines = None
+_replica_counter = count()
+_detectors = thread_local()
 _engine_lock = Lock()
+_read_statement_re = re.compile(r'^\s*select\b', re.I)
 _ending_numbers = re.compile(r'([^\d]+)(\d+)$')
+_date_kinds = ('year', 'month', 'day', 'hour', 'minute', 'second')
 
 
 #: The database URL.  For more information about database settings
@@ -141,6 +153,139 @@ database_pool_recycle = IntegerConfigField('database.pool_recycle', default=-1,
 #: queued connection pools.
 database_pool_timeout = IntegerConfigField('database.pool_timeout', default=30, min_value=5)
 
+#: The number of connections kept open in the pool of each process.  Like
+#: ``database.pool_timeout`` this is not used for SQLite, Access or Informix.
+database_pool_size = IntegerConfigField('database.pool_size', default=5, min_value=1)
+
+#: The number of connections that may be opened in addition to
+#: ``database.pool_size`` under load.  They are closed when returned to the
+#: pool.  Set to -1 to allow any number of connections.
+database_max_overflow = IntegerConfigField('database.max_overflow', default=10,
+                                           min_value=-1)
+
+#: Test connections with a cheap statement when they are taken from the pool
+#: and replace them if the database server closed them in the meantime.
+database_pool_pre_ping = BooleanConfigField('database.pool_pre_ping', default=True)
+
+#: Number of seconds a process trusts its cached reference data (see
+#: :class:`ReferenceData`) before it asks the shared cache whether another
+#: process changed the data.
+database_reference_check_interval = IntegerConfigField(
+    'database.reference_check_interval', default=5, min_value=0)
+
+#: Number of seconds a process keeps cached reference data at most, even if
+#: it did not notice a change.
+database_reference_max_age = IntegerConfigField(
+    'database.reference_max_age', default=300, min_value=0)
+
+#: Sample the query counters of every n-th request into the per-endpoint
+#: statistics.  Set to 0 to disable the statistics.
+database_stats_sample_rate = IntegerConfigField('database.stats_sample_rate',
+                                                default=10, min_value=0)
+
+#: Warn about statements that are executed more than n times (except for
+#: their parameters) in a single request.  This helps to find "N+1" query
+#: patterns.  Set to 0 to disable the detection.
+database_n_plus_one_threshold = IntegerConfigField(
+    'database.n_plus_one_threshold', default=0, min_value=0)
+
+#: Whitespace separated list of database URLs of read replicas.  If set,
+#: read-only queries are sent to one of those databases (round-robin)
+#: while flushes and anything inside a write transaction go to the primary
+#: database configured by ``database.url``.
+database_replica_urls = TextConfigField('database.replica_urls', default=u'')
+
+#: Number of seconds a client sticks to the primary database after a request
+#: wrote to it.  This ensures that users see their own edits even if the
+#: replicas lag behind.  Only used if ``database.replica_urls`` is set.
+database_replica_stick_time = IntegerConfigField('database.replica_stick_time',
+                                                 default=10, min_value=0)
+
+
+#: Time spent waiting for a connection from the pool in seconds
+pool_wait_times = Histogram((0.001, 0.01, 0.1, 1, 10))
+
+
+class _TimedQueue(sqla_queue.Queue):
+    """The queue of the pooled connections.  Records the time spent waiting
+    for a connection to be returned into :data:`pool_wait_times`, getting a
+    connection without waiting counts as no wait at all.
+    """
+
+    def get(self, block=True, timeout=None):
+        try:
+            rv = sqla_queue.Queue.get(self, False)
+        except sqla_queue.Empty:
+            # the pool opens a new connection if it may
+            if not block:
+                raise
+        else:
+            pool_wait_times.add(0.0)
+            return rv
+        start = time.time()
+        try:
+            return sqla_queue.Queue.get(self, True, timeout)
+        finally:
+            pool_wait_times.add(time.time() - start)
+
+
+class InyokaQueuePool(QueuePool):
+    """Queue pool that records the time it takes to get a connection into
+    :data:`pool_wait_times`.  Opening new connections is not included.
+    """
+
+    def __init__(self, creator, pool_size=5, **kwargs):
+        QueuePool.__init__(self, creator, pool_size, **kwargs)
+        self._pool = _TimedQueue(pool_size)
+
+
+class PingListener(PoolListener):
+    """Ping connections on checkout and let the pool replace connections
+    that were closed by the database server.
+    """
+
+    def checkout(self, dbapi_con, con_record, con_proxy):
+        try:
+            cursor = dbapi_con.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except Exception:
+            raise exc.DisconnectionError()
+
+
+def _get_engine_options(info):
+    # convert_unicode: Let SQLAlchemy convert all values to unicode
+    #                  before we get them
+    # echo:            Set the database debug level
+    # pool_recycle:    Enable long-living connection pools
+    # pool_timeout:    Timeout before giving up returning on a connection
+    # pool_size:       Connections kept in the pool
+    # max_overflow:    Connections opened in addition under load
+    options = {'convert_unicode':   True,
+               'echo':              ctx.cfg['database.echo'],
+               'pool_recycle':      ctx.cfg['database.pool_recycle']}
+    # SQLite, Access and Informix uses ThreadLocalQueuePool per default
+    # and as such cannot use a timeout for pooled connections.
+    if info.drivername not in ('sqlite', 'access', 'informix'):
+        options.update({
+            'poolclass': InyokaQueuePool,
+            'pool_timeout': ctx.cfg['database.pool_timeout'],
+            'pool_size': ctx.cfg['database.pool_size'],
+            'max_overflow': ctx.cfg['database.max_overflow']
+        })
+    if ctx.cfg['database.pool_pre_ping']:
+        options['listeners'] = [PingListener()]
+
+    # if in debug mode hook in our connection debug proxy,
+    # otherwise just count the queries
+    if ctx.cfg['database.debug']:
+        options['proxy'] = ConnectionDebugProxy()
+    else:
+        options['proxy'] = ConnectionAccountingProxy()
+    return options
+
 
 def get_engine(info=None, force_new=False):
     """Creates the engine if it does not exist and returns
@@ -154,28 +299,8 @@ def get_engine(info=None, force_new=False):
     with _engine_lock:
         if _engine is None or force_new:
             info = make_url(info or ctx.cfg['database.url'])
-            # convert_unicode: Let SQLAlchemy convert all values to unicode
-            #                  before we get them
-            # echo:            Set the database debug level
-            # pool_recycle:    Enable long-living connection pools
-            # pool_timeout:    Timeout before giving up returning on a connection
-            options = {'convert_unicode':   True,
-                       'echo':              ctx.cfg['database.echo'],
-                       'pool_recycle':      ctx.cfg['database.pool_recycle']}
-            # SQLite, Access and Informix uses ThreadLocalQueuePool per default
-            # and as such cannot use a timeout for pooled connections.
-            if info.drivername not in ('sqlite', 'access', 'informix'):
-                options.update({
-                    'poolclass': QueuePool,
-                    'pool_timeout': ctx.cfg['database.pool_timeout']
-                })
-
-            # if in debug mode hook in our connection debug proxy
-            if ctx.cfg['database.debug']:
-                options['proxy'] = ConnectionDebugProxy()
-
             url = SafeURL(info)
-            engine = create_engine(url, **options)
+            engine = create_engine(url, **_get_engine_options(info))
             if not force_new:
                 _engine = engine
         else:
@@ -183,10 +308,45 @@ def get_engine(info=None, force_new=False):
         return engine
 
 
+def get_replica_engines():
+    """Return the list of engines for the configured read replicas.
+
+    The engines are created once and share the pool options of the primary
+    engine.  If no replicas are configured an empty list is returned.
+    """
+    global _replica_engines
+    with _engine_lock:
+        if _replica_engines is None:
+            infos = map(make_url, ctx.cfg['database.replica_urls'].split())
+            _replica_engines = [create_engine(SafeURL(info),
+                                              **_get_engine_options(info))
+                                for info in infos]
+        return _replica_engines
+
+
+def get_pool_status():
+    """Return the state of the connection pools of this process."""
+    engines = [('primary', get_engine())]
+    engines.extend(('replica%d' % idx, engine)
+                   for idx, engine in enumerate(get_replica_engines()))
+    pools = {}
+    for name, engine in engines:
+        pool = engine.pool
+        status = {'status': pool.status()}
+        if isinstance(pool, QueuePool):
+            status.update(size=pool.size(), checked_in=pool.checkedin(),
+                          checked_out=pool.checkedout(),
+                          overflow=pool.overflow())
+        pools[name] = status
+    return {'pools': pools, 'wait_times': pool_wait_times.snapshot()}
+
+
 @ctx.cfg.reload_signal.connect
 def reload_engine_on_uri_change(sender, config):
     current_uri = unicode(get_engine().url.url)
-    if current_uri != config['database.url']:
+    replica_uris = [unicode(e.url.url) for e in get_replica_engines()]
+    if current_uri != config['database.url'] or \
+       replica_uris != config['database.replica_urls'].split():
         refresh_engine()
         get_engine()
 
@@ -197,12 +357,15 @@ def refresh_engine(*args, **kwargs):
     engine.  Only do that in single-threaded test environments or console
     sessions.
     """
-    global _engine
+    global _engine, _replica_engines
     with _engine_lock:
         session.remove()
         if _engine is not None:
             _engine.dispose()
+        for engine in _replica_engines or ():
+            engine.dispose()
         _engine = None
+        _replica_engines = None
 
 
 class AdvancedDropTable(DropTable):
@@ -218,6 +381,64 @@ def visit_drop_table_cascade(element, compiler, **kw):
     )
 
 
+class date_trunc(FunctionElement):
+    """Truncate the date or datetime `column` to the start of its year,
+    month, day, hour, minute or second.  The database returns either a
+    datetime or a string; use :func:`parse_date_bucket` to normalize it.
+    """
+    name = 'date_trunc'
+    type = NullType()
+    def __init__(self, kind, column):
+        if kind not in _date_kinds:
+            raise ValueError('unknown date kind %r' % kind)
+        self.kind = kind
+        FunctionElement.__init__(self, column)
+
+
+def _escape_format(fmt, compiler):
+    # percent signs have to be escaped for DB-API modules using them as
+    # parameter markers
+    if compiler.dialect.paramstyle in ('format', 'pyformat'):
+        return fmt.replace('%', '%%')
+    return fmt
+
+
+@compiles(date_trunc)
+def visit_date_trunc(element, compiler, **kw):
+    # PostgreSQL and the SQL standard
+    return "date_trunc('%s', %s)" % (element.kind,
+                                     compiler.process(element.clauses))
+
+
+@compiles(date_trunc, 'mysql')
+def visit_date_trunc_mysql(element, compiler, **kw):
+    fmt = ('%Y-01-01', '%Y-%m-01', '%Y-%m-%d', '%Y-%m-%d %H:00:00',
+           '%Y-%m-%d %H:%i:00', '%Y-%m-%d %H:%i:%s')[
+           _date_kinds.index(element.kind)]
+    return "DATE_FORMAT(%s, '%s')" % (compiler.process(element.clauses),
+                                      _escape_format(fmt, compiler))
+
+
+@compiles(date_trunc, 'sqlite')
+def visit_date_trunc_sqlite(element, compiler, **kw):
+    fmt = ('%Y-01-01', '%Y-%m-01', '%Y-%m-%d', '%Y-%m-%d %H:00:00',
+           '%Y-%m-%d %H:%M:00', '%Y-%m-%d %H:%M:%S')[
+           _date_kinds.index(element.kind)]
+    return "strftime('%s', %s)" % (_escape_format(fmt, compiler),
+                                   compiler.process(element.clauses))
+
+
+def parse_date_bucket(value):
+    """Convert the result of :class:`date_trunc` into a datetime."""
+    if isinstance(value, basestring):
+        if len(value) == 10:
+            value += ' 00:00:00'
+        return datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    return value
+
+
 def atomic_add(obj, column, delta, expire=False, primary_key_field=None):
     """Performs an atomic add (or subtract) of the given column on the
     object.  This updates the object in place for reflection but does
@@ -249,6 +470,7 @@ def atomic_add(obj, column, delta, expire=False, primary_key_field=None):
     })
 
     db.session.execute(stmt)
+    _mark_reference_change(db.session(), type(obj))
 
     val = orm.attributes.get_attribute(obj, column)
     if expire:
@@ -258,6 +480,301 @@ def atomic_add(obj, column, delta, expire=False, primary_key_field=None):
         orm.attributes.set_committed_value(obj, column, val + delta)
 
 
+def _make_delta_update(table, key, column, deltas):
+    """Return an UPDATE that adds ``deltas[value]`` to `column` of the
+    rows whose `key` column matches `value`.
+    """
+    return sql.update(table, key.in_(deltas.keys()), {
+        column: func.coalesce(table.c[column], 0) + sql.case(deltas, value=key)
+    })
+
+
+#: The timeout of buffered counter increments in seconds, far above the
+#: interval they are flushed in.  Increments are lost if they are not
+#: flushed in time.
+COUNTER_TIMEOUT = 60 * 60 * 24
+
+
+class BufferedCounter(object):
+    """Write-behind buffer for an integer counter column such as a view
+    count.  Instead of updating the row on every increment the deltas are
+    collected in the cache and written back by :func:`flush_counters`
+    with one UPDATE per table::
+
+        class Article(db.Model):
+            view_count = db.Column(db.Integer, default=0, nullable=False)
+            views = db.BufferedCounter('view_count')
+
+        Article.views.add(article)
+        article.views       # the persisted value plus pending increments
+
+    The increments are only buffered in caches shared by all processes,
+    otherwise they are written through with :func:`atomic_add`.
+    """
+
+    #: All counters known to :func:`flush_counters`
+    registry = []
+
+    #: The caching systems shared by all processes
+    cache_systems = ('memcached', 'gaememcached')
+
+    def __init__(self, column):
+        self.column = column
+        self.model = None
+
+    def bind(self, model):
+        """Called by the model metaclass for the class defining the counter."""
+        self.model = model
+        BufferedCounter.registry.append(self)
+
+    @property
+    def target(self):
+        """The table and primary key column the counter is stored in."""
+        table = orm.class_mapper(self.model).columns[self.column].table
+        return table, list(table.primary_key)[0]
+
+    def _get_cache_key(self, *parts):
+        table = self.target[0]
+        return '/'.join(['counters', table.name, self.column] +
+                        [unicode(part) for part in parts])
+
+    def _get_ident(self, obj):
+        mapper = orm.object_mapper(obj)
+        return getattr(obj, mapper.get_property_by_column(self.target[1]).key)
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        return getattr(obj, self.column) + self.pending(obj)
+
+    def pending(self, obj):
+        """Return the increments of `obj` not yet written to the database."""
+        from inyoka.core.cache import cache
+        ident = self._get_ident(obj)
+        if ident is None:
+            return 0
+        return cache.get(self._get_cache_key(ident)) or 0
+
+    def add(self, obj, delta=1):
+        """Buffer an increment of `delta` for `obj`."""
+        from inyoka.core.cache import cache
+        if ctx.cfg['caching.system'] not in self.cache_systems:
+            atomic_add(obj, self.column, delta)
+            return
+        ident = self._get_ident(obj)
+        key = self._get_cache_key(ident)
+        # memcached does not increment missing keys.  Incrementing does not
+        # extend the timeout either, so it must outlast many flushes.
+        cache.add(key, 0, timeout=COUNTER_TIMEOUT)
+        cache.inc(key, delta)
+        self._register(ident)
+
+    def _register(self, ident):
+        """Append `ident` to the log of rows the next flush writes unless
+        it is already waiting there.
+
+        The cache has neither atomic set operations nor does ``add`` tell
+        whether it stored the value, so every writer adds a value with a
+        token of its own and reads it back to check that it won.  Each
+        entry of the log is a slot key of its own for the same reason.
+        """
+        from inyoka.core.cache import cache
+        token = uuid4().hex
+        marker = self._get_cache_key('pending', ident)
+        cache.add(marker, token, timeout=COUNTER_TIMEOUT)
+        if cache.get(marker) != token:
+            return
+        # the hint only saves probing taken slots, it may be stale
+        next_key = self._get_cache_key('next')
+        idx = max(cache.get(next_key) or 0,
+                  cache.get(self._get_cache_key('flushed')) or 0)
+        entry = (ident, token)
+        while True:
+            slot = self._get_cache_key('slots', idx)
+            cache.add(slot, entry, timeout=COUNTER_TIMEOUT)
+            if cache.get(slot) == entry:
+                break
+            idx += 1
+        cache.set(next_key, idx + 1, timeout=COUNTER_TIMEOUT)
+
+    def _read_log(self, start):
+        """Return the rows of the log from slot `start` on and the slot
+        after the last one.
+        """
+        from inyoka.core.cache import cache
+        idents = set()
+        end = start
+        while True:
+            keys = [self._get_cache_key('slots', idx)
+                    for idx in xrange(end, end + 100)]
+            for entry in cache.get_many(*keys):
+                if entry is None:
+                    return idents, end
+                idents.add(entry[0])
+                end += 1
+
+    def flush(self):
+        """Write all pending increments back to the database."""
+        from inyoka.core.cache import cache
+        flushed_key = self._get_cache_key('flushed')
+        start = cache.get(flushed_key) or 0
+        idents, end = self._read_log(start)
+        if not idents:
+            return 0
+        # increments after this are registered again for the next flush
+        cache.delete_many(*[self._get_cache_key('pending', ident)
+                            for ident in idents])
+
+        deltas = {}
+        for ident in idents:
+            delta = cache.get(self._get_cache_key(ident))
+            if delta:
+                deltas[ident] = delta
+        if deltas:
+            table, pk = self.target
+            try:
+                session.execute(_make_delta_update(table, pk, self.column,
+                                                   deltas))
+                session.commit()
+            except:
+                # the log is not advanced, the next flush retries the rows
+                session.rollback()
+                raise
+        cache.set(flushed_key, end, timeout=COUNTER_TIMEOUT)
+
+        # only subtract what was written, concurrent increments stay pending
+        for ident, delta in deltas.iteritems():
+            cache.dec(self._get_cache_key(ident), delta)
+        return len(deltas)
+
+
+def flush_counters():
+    """Write the increments of all :class:`BufferedCounter` back to the
+    database and return the number of updated rows.
+    """
+    return sum(counter.flush() for counter in BufferedCounter.registry)
+
+
+class DenormalizedCounter(object):
+    """A counter column that is maintained incrementally (e.g. by an
+    attribute extension) but can be recomputed from the rows it counts.
+    Use :func:`register_counter` to create and extend them.
+    """
+
+    #: All counters checked by :func:`reconcile_counters`
+    registry = {}
+
+    def __init__(self, column):
+        self.column = column
+        self.sources = []
+
+    @property
+    def name(self):
+        return '%s.%s' % (self.column.table.name, self.column.name)
+
+    def _get_actual(self, first, last):
+        """Return the correct counts of the rows from `first` to `last`."""
+        actual = {}
+        for key, value in self.sources:
+            query = sql.select([key, value], sql.and_(key >= first,
+                                                      key <= last))
+            for ident, value in session.execute(query.group_by(key)):
+                actual[ident] = actual.get(ident, 0) + (value or 0)
+        return actual
+
+    def _make_update(self, idents):
+        """Return an UPDATE that recomputes the counter of the rows with
+        the primary keys `idents` with correlated subqueries.
+        """
+        table = self.column.table
+        pk = list(table.primary_key)[0]
+        actual = None
+        for key, value in self.sources:
+            count = sql.select([func.coalesce(value, 0)], key == pk) \
+                       .as_scalar()
+            actual = count if actual is None else actual + count
+        return table.update(pk.in_(idents), {self.column.key: actual})
+
+    def reconcile(self, chunk_size=1000, fix=True):
+        """Recompute the counter in chunks of `chunk_size` rows.  Returns a
+        dictionary that maps the primary keys of the drifted rows to the
+        difference of the correct and the stored value.  If `fix` is `True`
+        the drifted rows of every chunk are corrected with one UPDATE and
+        committed.  The UPDATE counts the rows itself, so changes committed
+        after the drift was read are not counted twice.
+        """
+        table = self.column.table
+        pk = list(table.primary_key)[0]
+        drift = {}
+        last = None
+        while True:
+            query = sql.select([pk, self.column]).order_by(pk) \
+                       .limit(chunk_size)
+            if last is not None:
+                query = query.where(pk > last)
+            rows = session.execute(query).fetchall()
+            if not rows:
+                break
+            last = rows[-1][0]
+
+            actual = self._get_actual(rows[0][0], last)
+            deltas = {}
+            for ident, stored in rows:
+                delta = actual.get(ident, 0) - (stored or 0)
+                if delta or stored is None:
+                    deltas[ident] = delta
+            if deltas and fix:
+                try:
+                    session.execute(self._make_update(deltas.keys()))
+                    _mark_table_change(session(), table)
+                    session.commit()
+                except:
+                    session.rollback()
+                    raise
+            drift.update(deltas)
+            if len(rows) < chunk_size:
+                break
+        return drift
+
+
+def register_counter(column, key, value=None):
+    """Register `column` as denormalized counter of the rows grouped by
+    `key`, for :func:`reconcile_counters`.  `value` is the aggregate that
+    is summed up, it defaults to the number of rows.  A counter may be
+    registered with multiple sources, their values are added up::
+
+        db.register_counter(Question.answer_count, Answer.question_id)
+        db.register_counter(ForumEntry.score, Vote.entry_id,
+                            db.func.sum(Vote.score))
+        db.register_counter(Tag.tagged, question_tag.c.tag_id)
+    """
+    if isinstance(column, orm.attributes.QueryableAttribute):
+        column = column.property.columns[0]
+    key = getattr(key, '__clause_element__', lambda: key)()
+    counter = DenormalizedCounter.registry.get(column)
+    if counter is None:
+        counter = DenormalizedCounter.registry[column] = \
+            DenormalizedCounter(column)
+    counter.sources.append((key, func.count() if value is None else value))
+    return counter
+
+
+def reconcile_counters(chunk_size=1000, fix=True):
+    """Recompute all registered denormalized counters and return a dictionary
+    that maps the counter names (``table.column``) to the drift found, see
+    :meth:`DenormalizedCounter.reconcile`.
+    """
+    report = {}
+    for counter in sorted(DenormalizedCounter.registry.itervalues(),
+                          key=lambda c: c.name):
+        drift = counter.reconcile(chunk_size, fix)
+        if drift:
+            logger.warning(u'Counter %s drifted in %d rows'
+                           % (counter.name, len(drift)))
+        report[counter.name] = drift
+    return report
+
+
 def _strip_ending_nums(string):
     # check for ending numbers to split with.  If we do that our LIKE statement
     # will also match all possible threads that may end with numbers but do not
@@ -268,23 +785,217 @@ def _strip_ending_nums(string):
     return string
 
 
-def find_next_increment(column, string, max_length=None):
+def find_next_increment(column, string, max_length=None, connection=None,
+                        reserved=()):
     """Get the next incremented string based on `column` and `string`.
 
     Example::
 
         find_next_increment(Category.slug, 'category name')
+
+    `string` is returned as is if it is not yet used.  Otherwise the last
+    suffix handed out for the prefix is incremented in the
+    :class:`~inyoka.core.models.SlugCounter` table, so that neither case
+    has to load all similar values.  The counter of a prefix is only
+    initialized once from the existing values.  Values in `reserved` are
+    treated as used even if they are not yet stored in the database.
     """
+    from inyoka.core.models import SlugCounter
+    if hasattr(column, '__clause_element__'):
+        column = column.__clause_element__()
+    connection = connection or session.connection()
+    execute = connection.execute
+    exists = lambda value: value in reserved or execute(sql.select([column],
+        column == value).limit(1)).first() is not None
+
+    candidate = string[:max_length] if max_length is not None else string
+    if not exists(candidate):
+        return candidate
+
     string = _strip_ending_nums(string)
-    existing = session.query(column).filter(column.like('%s%%' % string)).all()
-    return get_next_increment(flatten_iterator(existing), string, max_length)
+    counters = SlugCounter.__table__
+    name = '%s.%s' % (column.table.name, column.name)
+    where = sql.and_(counters.c.name == name, counters.c.prefix == string)
+    while True:
+        result = execute(counters.update(where, {'value': counters.c.value + 1}))
+        if result.rowcount:
+            value = execute(sql.select([counters.c.value], where)).scalar()
+        else:
+            # initialize the counter from the values created before
+            existing = execute(sql.select([column],
+                column.like('%s%%' % string))).fetchall()
+            suffixes = [v[len(string):] for v in flatten_iterator(existing)]
+            value = max([int(s) for s in suffixes if s.isdigit()] or [1]) + 1
+            savepoint = None
+            if connection.dialect.name == 'postgresql':
+                # a failing statement aborts the whole transaction there,
+                # the other databases only roll back the statement itself
+                savepoint = connection.begin_nested()
+            try:
+                execute(counters.insert().values(name=name, prefix=string,
+                                                 value=value))
+            except exc.IntegrityError:
+                # initialized concurrently, increment that counter instead
+                if savepoint is not None:
+                    savepoint.rollback()
+                continue
+            if savepoint is not None:
+                savepoint.commit()
+        suffix = unicode(value)
+        if max_length is not None:
+            candidate = string[:max_length - len(suffix)] + suffix
+        else:
+            candidate = string + suffix
+        if not exists(candidate):
+            return candidate
 
 
-def select_blocks(query, column, block_size=1000, start_with=0):
+def _nulls_sort_last():
+    """Return `True` if ``NULL`` sorts after all other values (as on
+    PostgreSQL) and `False` if it sorts before them (as on SQLite and
+    MySQL).
+    """
+    return get_engine().dialect.name in ('postgresql', 'oracle')
+
+
+def keyset_criterion(columns, values, inclusive=False, descending=None):
+    """Return a portable ``(a, b, ...) > (x, y, ...)`` expression, that is
+    the criterion for all rows after `values` in the order of `columns`.
+    `descending` is a list of flags for the columns sorted in descending
+    order, the rows before the value are selected for them.
+
+    Row value comparison is not supported by all of our database backends,
+    so we expand it into nested ``OR``/``AND`` clauses.  `None` values are
+    compared like the database sorts ``NULL``, see :func:`_nulls_sort_last`.
+    """
+    descending = list(descending or [False] * len(columns))
+    column, value = columns[0], values[0]
+    nullable = getattr(column, 'nullable', True)
+    nulls_last = _nulls_sort_last()
+    if value is None:
+        equal = column == None
+        # all values are after a NULL sorted before them
+        after = column != None if nulls_last == descending[0] else None
+    else:
+        equal = column == value
+        after = column < value if descending[0] else column > value
+        if nullable and nulls_last != descending[0]:
+            after = sql.or_(after, column == None)
+
+    if len(columns) == 1:
+        rest = equal if inclusive else None
+    else:
+        rest = sql.and_(equal, keyset_criterion(columns[1:], values[1:],
+                                                inclusive, descending[1:]))
+    if after is None or rest is None:
+        criterion = after if rest is None else rest
+        if criterion is None:
+            # nothing comes after the value, there is no portable ``FALSE``
+            criterion = sql.literal(0) == 1
+        return criterion
+    return sql.or_(after, rest)
+
+
+def _expunge_new_instances(session, known_keys):
+    """Expunge every unmodified instance that was loaded into the identity
+    map since `known_keys` was taken.
+    """
+    for key in list(session.identity_map.keys()):
+        if key in known_keys:
+            continue
+        obj = session.identity_map.get(key)
+        if obj is not None and not orm.attributes.instance_state(obj).modified:
+            session.expunge(obj)
+
+
+def bulk_insert(model, rows, batch_size=1000, counters=None):
+    """Insert the dictionaries of `rows` into the table of `model` (a model
+    or a table) with ``executemany`` statements of `batch_size` rows.  This
+    avoids the per-object overhead of the ORM and is meant for imports and
+    test data::
+
+        db.bulk_insert(Comment, ({'text': text, 'author_id': 1,
+                                  'article_id': 2} for text in texts),
+                       counters={'article_id': (Article, 'comment_count')})
+        db.session.commit()
+
+    The keys of the dictionaries are the column names.  Mapper extensions
+    that implement ``before_bulk_insert(mapper, connection, rows)`` or
+    ``after_bulk_insert(mapper, connection, rows)`` are called once per
+    batch; that way the :class:`SlugGenerator` and :class:`GuidGenerator`
+    fill in slugs and GUIDs.  All other extensions are skipped, so the
+    search index has to be rebuilt afterwards (``fab reindex``).  The
+    :class:`ReferenceData` of the changed tables is invalidated on commit.
+
+    `counters` maps a foreign key column of the rows to a ``(model,
+    column)`` tuple.  The counter of each referenced row is increased by the
+    number of inserted rows referencing it with one UPDATE per batch.
+
+    Returns the number of inserted rows.
+    """
+    if isinstance(model, sqlalchemy.Table):
+        table, mapper, extensions = model, None, ()
+    else:
+        mapper = orm.class_mapper(model)
+        if mapper.inherits is not None:
+            raise ValueError('bulk_insert does not support inherited models')
+        table, extensions = mapper.local_table, list(mapper.extension)
+
+    connection = session.connection(mapper)
+    _mark_table_change(session(), table)
+    inserted = 0
+    rows = iter(rows)
+    while True:
+        batch = [dict(row) for row in islice(rows, batch_size)]
+        if not batch:
+            break
+        for ext in extensions:
+            if hasattr(ext, 'before_bulk_insert'):
+                ext.before_bulk_insert(mapper, connection, batch)
+        # executemany requires the same keys for all rows of a statement
+        by_keys = {}
+        for row in batch:
+            by_keys.setdefault(frozenset(row), []).append(row)
+        for group in by_keys.itervalues():
+            connection.execute(table.insert(), group)
+        for ext in extensions:
+            if hasattr(ext, 'after_bulk_insert'):
+                ext.after_bulk_insert(mapper, connection, batch)
+        for key, (target, column) in (counters or {}).iteritems():
+            deltas = {}
+            for row in batch:
+                if row.get(key) is not None:
+                    deltas[row[key]] = deltas.get(row[key], 0) + 1
+            if deltas:
+                target_table = orm.class_mapper(target).columns[column].table
+                target_key = list(target_table.primary_key)[0]
+                connection.execute(_make_delta_update(target_table,
+                    target_key, column, deltas))
+                _mark_table_change(session(), target_table)
+        inserted += len(batch)
+    return inserted
+
+
+def select_blocks(query, column, block_size=1000, start_with=None,
+                  yield_per=None, expunge=True):
     """
     Execute a query blockwise to prevent lack of memory. Yields all rows
     seperately.
-    You've to specify an id column, `block_size` and `start_with` are optional.
+
+    The blocks are selected by keyset, every block is fetched with
+    ``WHERE column > last ORDER BY column LIMIT block_size`` so that sparse
+    ranges do not cost additional queries.  `column` can be any ordered
+    unique column or a tuple of columns that are unique together.
+    `start_with` is the (inclusive) key to start with, use a tuple if
+    multiple columns are applied.
+
+    If `yield_per` is applied the rows of every block are fetched in
+    batches of that size which enables server side cursors where supported.
+    Note that this does not work well with eagerly loaded collections.
+
+    If `expunge` is `True` (the default) all instances loaded by a block
+    are removed from the session as soon as the block is exhausted so
+    that bulk jobs run in constant memory.  Modified instances are kept.
 
     Example::
 
@@ -293,11 +1004,31 @@ def select_blocks(query, column, block_size=1000, start_with=0):
         for obj in db.select_blocks(query, MyModel.id):
             ...
     """
-    range = (start_with, start_with + block_size)
-    while range[0] < session.execute(db.select([func.max(column)])).fetchone()[0]:
-        for obj in query.filter(column.between(*range)):
-            yield obj
-        range = range[1] + 1, range[1] + block_size
+    columns = tuple(to_list(column))
+    last = to_list(start_with) if start_with is not None else None
+    inclusive = last is not None
+    session = query.session
+
+    while True:
+        block = query
+        if last is not None:
+            block = block.filter(keyset_criterion(columns, last, inclusive))
+        block = block.order_by(None).order_by(*columns).limit(block_size)
+        if yield_per is not None:
+            block = block.yield_per(yield_per)
+
+        known_keys = set(session.identity_map.keys()) if expunge else None
+        rows = 0
+        for row in block:
+            rows += 1
+            last = [getattr(row, c.key) for c in columns]
+            yield row
+
+        if expunge:
+            _expunge_new_instances(session, known_keys)
+        if rows < block_size:
+            break
+        inclusive = False
 
 
 @contextmanager
@@ -369,20 +1100,240 @@ def mapper(model, table, **options):
     return orm.mapper(model, table, **options)
 
 
+def _is_read_only(clause):
+    """Return `True` if `clause` is a statement that does not write."""
+    if isinstance(clause, (sql.expression.Select, sql.expression.CompoundSelect)):
+        return True
+    if isinstance(clause, sql.expression._TextClause):
+        return _read_statement_re.match(clause.text) is not None
+    return False
+
+
+class ReferenceData(object):
+    """Per-process read-through cache of detached instances for small,
+    rarely changing tables such as tags or forums::
+
+        class Forum(db.Model):
+            reference = db.ReferenceData('slug')
+
+        Forum.query.get(1)
+        Forum.query.get_by(slug=u'ubuntu')
+
+    The first lookup of a primary key or of a value of one of the given
+    unique `keys` queries the database, later lookups merge the cached
+    instance into the session without loading it.  Only queries without
+    criteria or options are served from the cache.  If `queries` is `False`
+    the cache is only used by explicit calls of :meth:`lookup`.
+
+    Every commit that changes instances of the model clears the cache of
+    the process and bumps a generation number in the shared cache, which
+    makes the other processes drop their copies within
+    ``database.reference_check_interval`` seconds.  Without a cache shared
+    by all processes nothing is cached.  Changes done with plain SQL are
+    not noticed, instances are loaded again after
+    ``database.reference_max_age`` seconds.
+
+    `fragments` is a list of fragment cache tags (see
+    :func:`~inyoka.core.cache.invalidate_fragments`) of template fragments
+    showing the data, they are invalidated together with the cache.
+    """
+
+    #: All models with reference data
+    registry = []
+
+    #: The caching systems shared by all processes
+    cache_systems = ('memcached', 'gaememcached')
+
+    def __init__(self, *keys, **options):
+        self.keys = keys
+        self.queries = options.pop('queries', True)
+        self.fragments = tuple(options.pop('fragments', ()))
+        self.model = None
+        self._instances = {}
+        self._generation = None
+        self._checked = 0
+        self._lock = Lock()
+
+    def bind(self, model):
+        """Called by the model metaclass for the class defining the cache."""
+        self.model = model
+        model._reference_data = self
+        ReferenceData.registry.append(self)
+
+    @property
+    def _generation_key(self):
+        return 'reference/%s' % orm.class_mapper(self.model).local_table.name
+
+    def _check_generation(self):
+        from inyoka.core.cache import cache
+        now = time.time()
+        if now - self._checked < ctx.cfg['database.reference_check_interval']:
+            return
+        self._checked = now
+        generation = cache.get(self._generation_key)
+        if generation != self._generation:
+            self.clear()
+            self._generation = generation
+
+    def _copy_columns(self, obj):
+        """Return a detached copy of `obj` with its loaded column values
+        only.  Relations are loaded again by the sessions using the copy.
+        """
+        mapper = orm.object_mapper(obj)
+        state = orm.attributes.instance_state(obj)
+        copy = mapper.class_manager.new_instance()
+        copy_state = orm.attributes.instance_state(copy)
+        for prop in mapper.iterate_properties:
+            if isinstance(prop, orm.ColumnProperty) and prop.key in state.dict:
+                copy_state.dict[prop.key] = state.dict[prop.key]
+        copy_state.key = state.key
+        copy_state.commit_all(copy_state.dict)
+        return copy
+
+    def lookup(self, session, key, value, load):
+        """Return the instance whose `key` (`None` for the primary key)
+        equals `value` merged into `session`.  On a cache miss the instance
+        is loaded by calling `load`.  Instances already in the session are
+        returned unchanged.
+        """
+        if ctx.cfg['caching.system'] not in self.cache_systems:
+            # the other processes could not tell us about their changes
+            return load()
+        self._check_generation()
+        now = time.time()
+        obj, expires = self._instances.get((key, value), (None, None))
+        if obj is None or expires <= now:
+            obj = load()
+            changes = getattr(session, '_reference_changes', ())
+            if self not in changes and \
+               not orm.attributes.instance_state(obj).modified:
+                # keep a detached copy that is shared by all sessions
+                copy = self._copy_columns(obj)
+                expires = now + ctx.cfg['database.reference_max_age']
+                with self._lock:
+                    self._instances[(key, value)] = (copy, expires)
+            return obj
+        # merging would overwrite pending changes of the session's instance
+        existing = session.identity_map.get(
+            orm.attributes.instance_state(obj).key)
+        if existing is not None:
+            return existing
+        return session.merge(obj, load=False)
+
+    def clear(self):
+        """Forget the cached instances of this process."""
+        with self._lock:
+            self._instances.clear()
+
+    def invalidate(self):
+        """Forget the cached instances and fragments in all processes."""
+        from inyoka.core.cache import cache, invalidate_fragments
+        self.clear()
+        # memcached does not increment missing keys
+        cache.add(self._generation_key, 0)
+        cache.inc(self._generation_key)
+        if self.fragments:
+            invalidate_fragments(*self.fragments)
+
+
+def clear_reference_data():
+    """Forget all cached reference data of this process."""
+    for reference in ReferenceData.registry:
+        reference.clear()
+
+
+def _mark_reference_change(session, model):
+    reference = getattr(model, '_reference_data', None)
+    if reference is not None:
+        if not hasattr(session, '_reference_changes'):
+            session._reference_changes = set()
+        session._reference_changes.add(reference)
+
+
+def _mark_table_change(session, table):
+    """Like :func:`_mark_reference_change` for changes done with plain SQL
+    to the rows of `table`.
+    """
+    for reference in ReferenceData.registry:
+        if orm.class_mapper(reference.model).local_table is table:
+            _mark_reference_change(session, reference.model)
+
+
+class ReferenceDataExtension(orm.interfaces.SessionExtension):
+    """Invalidates the :class:`ReferenceData` of models that were changed
+    by a transaction once it's committed.
+    """
+
+    def after_flush(self, session, flush_context):
+        for obj in chain(session.new, session.dirty, session.deleted):
+            _mark_reference_change(session, type(obj))
+
+    def after_commit(self, session):
+        for reference in session.__dict__.pop('_reference_changes', ()):
+            reference.invalidate()
+
+    def after_rollback(self, session):
+        # instances loaded after a flush might contain rolled back changes
+        for reference in session.__dict__.pop('_reference_changes', ()):
+            reference.clear()
+
+
 class InyokaSession(SASession):
-    """Session that binds the engine as late as possible"""
+    """Session that binds the engine as late as possible.
+
+    If read replicas are configured the session routes read-only queries to
+    one of them (round-robin).  Flushes and all other statements are sent to
+    the primary database.  As soon as the session wrote something it sticks
+    to the primary until it's closed, so that a request always sees its own
+    changes.  See :class:`~inyoka.core.middlewares.ReplicaMiddleware` for
+    how this is extended to subsequent requests.
+
+    :param bind: The primary engine, defaults to :func:`get_engine`.
+    :param replicas: A list of replica engines, defaults to
+                     :func:`get_replica_engines`.
+    """
 
-    def __init__(self):
-        SASession.__init__(self, get_engine(), autoflush=True,
-                           autocommit=False)
+    def __init__(self, bind=None, replicas=None):
+        SASession.__init__(self, bind or get_engine(), autoflush=True,
+                           autocommit=False,
+                           extension=[ReferenceDataExtension()])
+        self.replicas = get_replica_engines() if replicas is None else replicas
+        #: If `True` all statements are sent to the primary database
+        self.use_primary = False
+        #: `True` if the session sent a writing statement to the primary
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        primary = SASession.get_bind(self, mapper, clause)
+        if not self.replicas or self.use_primary or self.wrote:
+            return primary
+        if self._flushing or clause is None or not _is_read_only(clause):
+            # flushes and explicitly requested connections might write
+            # so we stick to the primary for the rest of the session.
+            self.wrote = True
+            return primary
+        return self.replicas[_replica_counter.next() % len(self.replicas)]
+
+    def close(self):
+        SASession.close(self)
+        self.use_primary = self.wrote = False
 
 
 metadata = MetaData()
 session = orm.scoped_session(InyokaSession)
 
 
-class ConnectionDebugProxy(ConnectionProxy):
-    """Helps debugging the database."""
+#: Per-endpoint sums of the request query counters
+query_stats = Aggregate(('statements', 'time', 'rows'))
+
+
+class ConnectionAccountingProxy(ConnectionProxy):
+    """Counts the statements, the time spent in the database and the fetched
+    rows (where the DBAPI reports them) for the current request.
+
+    This is cheap enough to be enabled all the time.  The counters are
+    stored on the request object as `db_statements`, `db_time` and `db_rows`.
+    """
 
     def cursor_execute(self, execute, cursor, statement, parameters,
                        context, executemany):
@@ -390,46 +1341,225 @@ class ConnectionDebugProxy(ConnectionProxy):
         try:
             return execute(cursor, statement, parameters, context)
         finally:
+            end = time.time()
             request = ctx.current_request
             if request is not None:
-                request.queries.append((statement, parameters, start,
-                                        time.time(), find_calling_context()))
+                request.db_statements += 1
+                request.db_time += end - start
+                if cursor.description is not None and cursor.rowcount > 0:
+                    request.db_rows += cursor.rowcount
+                if request.n_plus_one_detector is not None:
+                    request.n_plus_one_detector.add(statement)
+                self.record(request, statement, parameters, start, end)
+            for detector in getattr(_detectors, 'stack', ()):
+                detector.add(statement)
+
+    def record(self, request, statement, parameters, start, end):
+        """Called for every executed statement if there is a request."""
+
+
+class ConnectionDebugProxy(ConnectionAccountingProxy):
+    """Helps debugging the database."""
+
+    def record(self, request, statement, parameters, start, end):
+        request.queries.append((statement, parameters, start, end,
+                                find_calling_context(3)))
+
+
+@contextmanager
+def detect_n_plus_one(threshold=5):
+    """Detect "N+1" query patterns in the `with` block.  Yields a
+    :class:`~inyoka.utils.debug.NPlusOneDetector` that collects all
+    statements executed more than `threshold` times.
+
+    Example usage::
+
+        with db.detect_n_plus_one(threshold=3) as detector:
+            render_question_list()
+        assert not detector.offenders, detector.report()
+    """
+    detector = NPlusOneDetector(threshold)
+    if not hasattr(_detectors, 'stack'):
+        _detectors.stack = []
+    _detectors.stack.append(detector)
+    try:
+        yield detector
+    finally:
+        _detectors.stack.remove(detector)
+
+
+def warn_n_plus_one(request):
+    """Log a warning if an "N+1" query pattern was found in `request`."""
+    detector = request.n_plus_one_detector
+    if detector is not None and detector.offenders:
+        logger.warning(u'N+1 query pattern in view %s:\n%s'
+                       % (request.endpoint, detector.report()))
+
+
+def record_query_stats(request):
+    """Sample the query counters of `request` into :data:`query_stats`."""
+    query_stats.sample_rate = ctx.cfg['database.stats_sample_rate']
+    query_stats.sample(request.endpoint, statements=request.db_statements,
+                       time=request.db_time, rows=request.db_rows)
+
+
+_projection_types = {}
+
+
+def _get_projection_type(model, fields):
+    """Return the tuple class for rows of `model` with `fields`.  The class
+    borrows the properties, ``__unicode__`` and ``get_url_values`` of the
+    model, so that rows can be displayed and passed to
+    :func:`~inyoka.core.routing.href` like instances if the fields used by
+    them are projected.
+    """
+    key = (model, fields)
+    rv = _projection_types.get(key)
+    if rv is None:
+        attrs = {}
+        for cls in reversed(model.__mro__):
+            for name, value in vars(cls).iteritems():
+                if isinstance(value, property) or \
+                   name in ('__unicode__', 'get_url_values'):
+                    attrs[name] = value
+        for idx, name in enumerate(fields):
+            attrs[name] = property(itemgetter(idx))
+        attrs.update(__slots__=(), model=model, _fields=fields,
+                     _make=classmethod(tuple.__new__))
+        rv = _projection_types[key] = type(model.__name__ + 'Row', (tuple,),
+                                           attrs)
+    return rv
+
+
+def _join_relations(query, model, joins, path):
+    """Outer join the many-to-one relations along `path` (a list of
+    relation names starting at `model`) to `query` unless they are in
+    `joins` already.  Return the query, the aliased target and its model.
+    """
+    target = model
+    for idx, key in enumerate(path):
+        join_path = tuple(path[:idx + 1])
+        prop = getattr(target, key).property
+        if not isinstance(prop, orm.RelationshipProperty) or prop.uselist:
+            raise ValueError('%s is no many-to-one relation'
+                             % '.'.join(join_path))
+        if join_path not in joins:
+            joins[join_path] = orm.aliased(prop.mapper.class_)
+            query = query.outerjoin((joins[join_path], getattr(target, key)))
+        target, model = joins[join_path], prop.mapper.class_
+    return query, target, model
+
+
+def _make_projection(row_type, nested):
+    """Return a function that turns the plain rows of a projection into
+    rows of `row_type`.  `nested` maps the indexes of fields that are rows
+    of related models to their row type and number of columns.
+    """
+    if not nested:
+        return row_type._make
+    def make(row):
+        values = []
+        pos = 0
+        for idx in xrange(len(row_type._fields)):
+            if idx not in nested:
+                values.append(row[pos])
+                pos += 1
+                continue
+            nested_type, width = nested[idx]
+            columns = row[pos:pos + width]
+            pos += width
+            # the outer join found no related row
+            if all(value is None for value in columns):
+                values.append(None)
+            else:
+                values.append(nested_type._make(columns))
+        return row_type._make(values)
+    return make
 
 
 class Query(orm.Query):
     """Default query class."""
 
+    _projection = None
+
+    def _set_entities(self, entities, entity_wrapper=None):
+        # other entities (e.g. the one of count()) return plain rows again
+        orm.Query._set_entities(self, entities, entity_wrapper)
+        self._projection = None
+
+    def __iter__(self):
+        rows = orm.Query.__iter__(self)
+        if self._projection is None:
+            return rows
+        return imap(self._projection, rows)
+
     def get(self, pk):
         """Modify the default get to raise ``inyoka.core.database.db.NoResultFound``
         instead of returning ``None``.
         """
+        reference = self._get_reference_data()
+        if reference is not None:
+            return reference.lookup(self.session, None, pk,
+                                    lambda: self._get_or_raise(pk))
+        return self._get_or_raise(pk)
+
+    def _get_or_raise(self, pk):
         result = super(Query, self).get(pk)
         if not result:
             raise orm.exc.NoResultFound()
         return result
 
+    def _get_reference_data(self):
+        if self._criterion is not None or self._with_options:
+            return None
+        reference = getattr(self._mapper_zero().class_, '_reference_data', None)
+        return reference if reference is not None and reference.queries else None
+
+    def get_by(self, **kwargs):
+        """Return the one instance matching the keyword arguments like
+        ``filter_by(**kwargs).one()``.  Lookups of one of the keys of the
+        model's :class:`ReferenceData` are served from its cache.
+        """
+        load = lambda: self.filter_by(**kwargs).one()
+        reference = self._get_reference_data()
+        if reference is not None and len(kwargs) == 1:
+            key, value = kwargs.items()[0]
+            if key in reference.keys:
+                return reference.lookup(self.session, key, value, load)
+        return load()
+
+    def date_buckets(self, key, kind, limit=None):
+        """Return a list of ``(date, count)`` tuples, one for each year,
+        month, day, hour, minute or second (`kind`) in which the column `key`
+        of an entry falls, newest first.  `date` is the start of that period.
+
+        The dates are truncated and counted by the database with a single
+        ``GROUP BY`` query.
+        """
+        column = self._mapper_zero().columns[key]
+        bucket = date_trunc(kind, column)
+        query = self.with_entities(bucket, func.count(column)) \
+                    .group_by(bucket).order_by(None).order_by(bucket.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        return [(parse_date_bucket(value), count) for value, count in query
+                if value is not None]
+
     def dates(self, key, kind, limit=None, dt_obj=False):
         """Return all dates for which an entry exists in `column`.
 
         For example, dates(Article.pub_date, 'month') returns all months where an
-        Article was published (a tuple (year, month) for each month).
+        Article was published (a tuple (year, month) for each month), newest
+        first.  If `dt_obj` is `True` datetime objects are returned instead.
 
         `kind` must be one of year, month, day, hour, minute, second.
         Inspired by Django's Models.objects.dates.
         """
-        entity = self._mapper_zero()
-        column = entity.columns[key]
-
-        _kinds = ['year', 'month', 'day', 'hour', 'minute', 'second']
-        idx = (_kinds.index('day') if dt_obj else _kinds.index(kind)) + 1
-        query = self.session.query(column)
-        result = set()
-        for date in (x[0] for x in query.all()):
-            if limit is not None and len(result) >= limit:
-                break
-            value = date.timetuple()[:idx]
-            result.add(datetime(*value) if dt_obj else value)
-        return result
+        idx = _date_kinds.index(kind) + 1
+        buckets = self.date_buckets(key, kind, limit)
+        if dt_obj:
+            return [date for date, count in buckets]
+        return [date.timetuple()[:idx] for date, count in buckets]
 
     def cached(self, key, timeout=None):
         """Return a query result from the cache or execute the query again"""
@@ -441,6 +1571,53 @@ class Query(orm.Query):
         data = list(self.merge_result(data, load=False))
         return data
 
+    def project(self, *fields, **labeled):
+        """Return a query for tuples of `fields` instead of model
+        instances.  This is meant for listings that only display a few
+        values, as it avoids instantiating models as well as loading eager
+        relations and polymorphic tables that are not needed::
+
+            pastes = PasteEntry.query.order_by(PasteEntry.pub_date.desc()) \
+                .project('id', 'title', 'pub_date', author=('username',))
+            for paste in pastes:
+                print paste.display_title, paste.author, href(paste)
+
+        Fields are attribute names of the model, dotted names follow
+        many-to-one relations (outer joined).  They are named like the
+        field with dots replaced by underscores, use keyword arguments for
+        other names.  A keyword argument with a tuple of fields projects the
+        many-to-one relation of that name as a row of its own, or `None`.
+
+        The rows borrow the properties, ``__unicode__`` and
+        ``get_url_values`` of their model.  Those work if the fields they
+        use are projected.
+        """
+        mapper = self._mapper_zero()
+        items = [(field.replace('.', '_'), field) for field in fields]
+        items.extend(sorted(labeled.iteritems()))
+
+        query = self
+        joins = {}
+        columns = []
+        nested = {}
+        for idx, (name, field) in enumerate(items):
+            if isinstance(field, tuple):
+                query, target, model = _join_relations(query, mapper.class_,
+                                                       joins, [name])
+                nested[idx] = (_get_projection_type(model, field), len(field))
+                columns.extend(getattr(target, key) for key in field)
+            else:
+                path = field.split('.')
+                query, target, model = _join_relations(query, mapper.class_,
+                                                       joins, path[:-1])
+                columns.append(getattr(target, path[-1]))
+
+        query = query.with_entities(*columns)
+        row_type = _get_projection_type(mapper.class_,
+                                        tuple(n for n, f in items))
+        query._projection = _make_projection(row_type, nested)
+        return query
+
     def lightweight(self, deferred=None, lazy=None):
         """Send a lightweight query which deferes some more expensive
         things such as comment queries or even text and parser data.
@@ -458,6 +1635,9 @@ class DeclarativeMeta(SADeclarativeMeta, InterfaceMeta):
         # load the model into the correct resource manager
         if 'manager' in dict_:
             dict_['manager'].models.append(mcs)
+        for value in dict_.itervalues():
+            if isinstance(value, (BufferedCounter, ReferenceData)):
+                value.bind(mcs)
 
 
 class ModelBase(object):
@@ -495,6 +1675,9 @@ ModelBase.query = session.query_property(Query)
 class SlugGenerator(orm.MapperExtension):
     """This MapperExtension can generate unique slugs automatically.
 
+    Every insert looks the slug up with one SELECT on the (indexed) slug
+    column, see :func:`find_next_increment` for taken slugs.
+
     .. note::
 
         If you apply a max_length to the slug field that length is
@@ -515,50 +1698,80 @@ class SlugGenerator(orm.MapperExtension):
         self.generate_from = generate_from
         self.separator = sep
 
-    def before_insert(self, mapper, connection, instance):
-        fields = [get_attribute(instance, f) for f in self.generate_from]
-
-        table = mapper.columns[self.slugfield].table
-        column = table.c[self.slugfield]
+    def _get_column(self, mapper):
+        column = mapper.columns[self.slugfield].table.c[self.slugfield]
         assert isinstance(column.type, (db.Unicode, db.String))
-        max_length = column.type.length
+        return column
 
+    def _make_slug(self, fields, max_length):
         # filter out fields with no value as we cannot join them they are
         # not relevant for slug generation.
         fields = ifilter(None, fields)
         slug = self.separator.join(imap(gen_ascii_slug, fields))
         # strip the string if max_length is applied
-        slug = slug[:max_length-4] if max_length is not None else slug
+        return slug[:max_length-4] if max_length is not None else slug
 
+    def before_insert(self, mapper, connection, instance):
+        column = self._get_column(mapper)
+        max_length = column.type.length
+        slug = self._make_slug([get_attribute(instance, f)
+                                for f in self.generate_from], max_length)
         set_attribute(instance, self.slugfield,
-            find_next_increment(getattr(instance.__class__, self.slugfield),
-                                slug, max_length))
+            find_next_increment(column, slug, max_length, connection))
         return orm.EXT_CONTINUE
 
+    def before_bulk_insert(self, mapper, connection, rows):
+        column = self._get_column(mapper)
+        max_length = column.type.length
+        slugs = [self._make_slug([row.get(f) for f in self.generate_from],
+                                 max_length) for row in rows]
+        # find the slugs already taken with one query and only resolve
+        # those (and duplicates within `rows`) one by one
+        taken = set(flatten_iterator(connection.execute(
+            sql.select([column], column.in_(set(slugs)))).fetchall()))
+        used = set()
+        for row, slug in izip(rows, slugs):
+            if slug in taken or slug in used:
+                slug = find_next_increment(column, slug, max_length,
+                                           connection, used)
+            used.add(slug)
+            row[self.slugfield] = slug
+
 class GuidGenerator(orm.MapperExtension):
     """
     Automatically generate a GUID (for usage in feeds for the entry).
     This allows changing domain name etc. without breaking existing entries.
 
+    The GUID is built from `key` or, if no `key` is given or its value is not
+    known before the INSERT (like an autoincremented primary key), from a
+    random UUID.  Either way it is written with the INSERT.
+
     :param namespace: The namespace for the object.
-    :param key: The attribute used for generating the guid (default: `id`)
+    :param key: The attribute used for generating the guid (default: a UUID)
     :param field: The field the guid is saved to (default: `guid`)
     """
-    def __init__(self, namespace, key='id', field='guid'):
+    def __init__(self, namespace, key=None, field='guid'):
         self.namespace = namespace
         self.key = key
         self.field = field
 
-    def after_insert(self, mapper, connection, instance):
-        guid = '%s%s/%s' % (
-            ctx.cfg['tag_uri_base'],
-            self.namespace, getattr(instance, self.key)
-        )
-        setattr(instance, self.field, guid)
-        connection.execute(instance.__table__.update()
-                           .values(**{self.field: guid})
-                           .where(instance.__table__.c.id == instance.id)
-        )
+    def _make_guid(self, value):
+        if value is None:
+            value = uuid4().hex
+        return u'%s%s/%s' % (ctx.cfg['tag_uri_base'], self.namespace, value)
+
+    def before_insert(self, mapper, connection, instance):
+        if getattr(instance, self.field) is None:
+            value = getattr(instance, self.key) if self.key else None
+            setattr(instance, self.field, self._make_guid(value))
+        return orm.EXT_CONTINUE
+
+    def before_bulk_insert(self, mapper, connection, rows):
+        for row in rows:
+            if row.get(self.field) is None:
+                value = row.get(self.key) if self.key else None
+                row[self.field] = self._make_guid(value)
+
 
 class FileObject(FileStorage):
 
@@ -696,13 +1909,27 @@ def _make_module():
     db.PGArray = PGArray
 
     db.get_engine = get_engine
+    db.get_pool_status = get_pool_status
     db.session = session
     db.metadata = metadata
     db.mapper = mapper
     db.atomic_add = atomic_add
+    db.BufferedCounter = BufferedCounter
+    db.ReferenceData = ReferenceData
+    db.clear_reference_data = clear_reference_data
+    db.flush_counters = flush_counters
+    db.register_counter = register_counter
+    db.reconcile_counters = reconcile_counters
     db.no_autoflush = no_autoflush
     db.find_next_increment = find_next_increment
     db.select_blocks = select_blocks
+    db.keyset_criterion = keyset_criterion
+    db.bulk_insert = bulk_insert
+    db.date_trunc = date_trunc
+    db.query_stats = query_stats
+    db.record_query_stats = record_query_stats
+    db.detect_n_plus_one = detect_n_plus_one
+    db.warn_n_plus_one = warn_n_plus_one
     db.driver = driver
     db.Model = Model
     db.Query = Query
@@ -10,6 +10,7 @@
     :license: GNU GPL, see LICENSE for more details.
 """
 from uuid import uuid4
+from hashlib import md5
 from functools import update_wrapper
 from collections import namedtuple
 from werkzeug import Request as BaseRequest, Response as BaseResponse, \
@@ -17,7 +18,14 @@ from werkzeug import Request as BaseRequest, Response as BaseResponse, \
 from werkzeug.contrib.securecookie import SecureCookie
 from markupsafe import escape
 from inyoka.context import ctx
+from inyoka.core.config import IntegerConfigField
 from inyoka.core.routing import href
+from inyoka.utils.debug import NPlusOneDetector
+
+
+#: Streamed bodies are sent in chunks of at least n characters
+streaming_chunk_size = IntegerConfigField('streaming.chunk_size',
+                                          default=8192, min_value=1)
 
 
 class FlashMessage(namedtuple('FlashMessage', ('text', 'success', 'id', 'html'))):
@@ -67,6 +75,18 @@ class Request(BaseRequest):
         BaseRequest.__init__(self, *args, **kwargs)
         #: Logged database queries
         self.queries = []
+        #: Number of executed database statements
+        self.db_statements = 0
+        #: Seconds spent in the database
+        self.db_time = 0.0
+        #: Number of fetched rows, if the database driver reports them
+        self.db_rows = 0
+        #: Seconds spent per request phase, see :mod:`inyoka.utils.timing`
+        self.timings = {}
+        #: Detector for "N+1" query patterns, if enabled
+        threshold = ctx.cfg['database.n_plus_one_threshold']
+        self.n_plus_one_detector = NPlusOneDetector(threshold) \
+            if threshold else None
 
     @cached_property
     def session(self):
@@ -128,6 +148,25 @@ class Response(BaseResponse):
         self.headers['Expires'] = '-1'
 
 
+def iter_coalesced(iterable, size=None):
+    """Join the small chunks of `iterable` into chunks of at least `size`
+    characters, ``streaming.chunk_size`` by default.
+    """
+    if size is None:
+        size = ctx.cfg['streaming.chunk_size']
+    buffer = []
+    buffered = 0
+    for chunk in iterable:
+        buffer.append(chunk)
+        buffered += len(chunk)
+        if buffered >= size:
+            yield ''.join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield ''.join(buffer)
+
+
 def redirect_to(endpoint, **kwargs):
     """Temporarily redirect to an URL rule."""
     return redirect(href(endpoint, **kwargs))
@@ -150,3 +189,62 @@ def allow_next_redirects(default):
             return result
         return update_wrapper(_inner, func)
     return decorated
+
+
+def conditional(etag=None, last_modified=None):
+    """Use this decorator to answer conditional ``GET`` requests before the
+    view renders anything.  `etag` and `last_modified` are called with the
+    arguments of the view.  `etag` returns a value identifying the version
+    of the page, `last_modified` the date of its last modification.  Either
+    of them may return `None` to render the page unconditionally.
+
+    Everything the page depends on must be part of the validators, like
+    the user it is rendered for::
+
+        @view('detail')
+        @conditional(lambda self, request, id: (Entry.query.get(id).updated,
+                                                request.user.id))
+        @templated('detail.html')
+        def detail(self, request, id):
+            ...
+
+    :param etag: Callable returning a value the ETag is computed from.
+    :param last_modified: Callable returning a :class:`~datetime.datetime`.
+    """
+
+    def decorated(func):
+        def _inner(*args, **kwargs):
+            req = ctx.current_request
+            if req.method not in ('GET', 'HEAD') or req.has_flashed_messages():
+                return func(*args, **kwargs)
+
+            tag = modified = None
+            if etag is not None:
+                value = etag(*args, **kwargs)
+                if value is not None:
+                    tag = md5(repr(value)).hexdigest()
+            if last_modified is not None:
+                modified = last_modified(*args, **kwargs)
+                if modified is not None:
+                    modified = modified.replace(microsecond=0)
+
+            if tag is not None and req.if_none_match:
+                not_modified = req.if_none_match.contains_weak(tag)
+            elif modified is not None and req.if_modified_since:
+                not_modified = modified <= req.if_modified_since
+            else:
+                not_modified = False
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = func(*args, **kwargs)
+                if not isinstance(response, BaseResponse):
+                    return response
+            if tag is not None:
+                response.set_etag(tag)
+            if modified is not None:
+                response.last_modified = modified
+            return response
+        return update_wrapper(_inner, func)
+    return decorated
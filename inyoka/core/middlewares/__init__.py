@@ -8,8 +8,10 @@
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
+from time import time
 from inyoka import Interface
 from inyoka.context import ctx
+from inyoka.core.database import db
 from inyoka.core.routing import UrlMixin
 
 
@@ -98,3 +100,33 @@ class CommonMiddleware(IMiddleware):
         if request.has_flashed_messages():
             response.prevent_caching()
         return response
+
+
+class ReplicaMiddleware(IMiddleware):
+    """Keeps a client on the primary database for some seconds after it
+    wrote to it, so that users see their own edits on the next requests
+    even if the read replicas lag behind.  Requests that are not safe
+    (e.g. ``POST``) use the primary database right from the start since
+    they read what they are about to change.
+
+    This middleware does nothing if no read replicas are configured.
+    """
+
+    priority = 90
+
+    #: The request methods that may read from the replicas
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+    def process_request(self, request):
+        session = db.session()
+        if session.replicas and \
+           (request.method not in self.safe_methods or
+            request.session.get('_db_primary_until', 0) > time()):
+            session.use_primary = True
+
+    def process_response(self, request, response):
+        session = db.session()
+        if session.replicas and session.wrote:
+            request.session['_db_primary_until'] = \
+                time() + ctx.cfg['database.replica_stick_time']
+        return response
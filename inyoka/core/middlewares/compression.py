@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+    inyoka.core.middlewares.compression
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A middleware that gzip compresses responses for clients that accept it.
+    Streamed responses are compressed chunk by chunk.  Static files are not
+    handled here, the static file middlewares serve precompressed siblings
+    instead, see :func:`accepts_gzip`.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+import zlib
+from werkzeug import parse_accept_header
+from inyoka.context import ctx
+from inyoka.core.config import BooleanConfigField, IntegerConfigField
+from inyoka.core.middlewares import IMiddleware
+
+
+#: Enable gzip compression of responses
+compression_enabled = BooleanConfigField('compression.enabled', default=True)
+
+#: The zlib compression level, from 1 (fastest) to 9 (smallest)
+compression_level = IntegerConfigField('compression.level', default=6,
+                                       min_value=1)
+
+#: Do not compress buffered responses smaller than n bytes
+compression_min_size = IntegerConfigField('compression.min_size', default=500,
+                                          min_value=0)
+
+#: Mimetypes besides ``text/*`` worth compressing
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'application/json', 'application/javascript', 'application/x-javascript',
+    'application/xml', 'application/atom+xml', 'application/rss+xml',
+    'image/svg+xml',
+])
+
+
+def accepts_gzip(environ):
+    """Return `True` if the client of `environ` accepts gzip encoding."""
+    return parse_accept_header(environ.get('HTTP_ACCEPT_ENCODING'))['gzip'] > 0
+
+
+def is_compressible(mimetype):
+    """Return `True` if content of `mimetype` is worth compressing."""
+    return mimetype.startswith('text/') or mimetype in COMPRESSIBLE_MIMETYPES
+
+
+def _compressobj(level):
+    # 16 + MAX_WBITS writes a gzip header and trailer instead of zlib ones
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def iter_compressed(app_iter, level=6):
+    """Compress `app_iter` with gzip.  Every chunk is flushed so that the
+    client can start rendering streamed pages early.
+    """
+    compressor = _compressobj(level)
+    try:
+        for chunk in app_iter:
+            data = compressor.compress(chunk) + \
+                   compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+class CompressionMiddleware(IMiddleware):
+    """Gzip compresses text responses if the client accepts it.  This runs
+    last on responses so that it sees the final body.
+    """
+
+    priority = 95
+
+    def process_response(self, request, response):
+        cfg = ctx.cfg
+        if response.status_code == 304 and cfg['compression.enabled'] and \
+           accepts_gzip(request.environ):
+            # keep the validator the same as that of the compressed page
+            self._weaken_etag(response)
+            return response
+        if not cfg['compression.enabled'] or response.status_code != 200 or \
+           'Content-Encoding' in response.headers or \
+           not is_compressible(response.mimetype):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        if not accepts_gzip(request.environ):
+            return response
+
+        level = cfg['compression.level']
+        if response.is_sequence:
+            data = response.data
+            if len(data) < cfg['compression.min_size']:
+                return response
+            compressor = _compressobj(level)
+            response.data = compressor.compress(data) + compressor.flush()
+        else:
+            response.response = iter_compressed(response.iter_encoded(), level)
+            response.headers.pop('Content-Length', None)
+
+        response.headers['Content-Encoding'] = 'gzip'
+        self._weaken_etag(response)
+        return response
+
+    def _weaken_etag(self, response):
+        # the compressed body is not byte-equal to the uncompressed one
+        etag, weak = response.get_etag()
+        if etag is not None:
+            response.set_etag(etag, weak=True)
@@ -22,6 +22,7 @@ class DebugMiddleware(IMiddleware):
 
     def process_response(self, request, response):
         if self.enabled and response.status == '200 OK' \
+            and response.is_sequence \
             and re_htmlmime.match(response.content_type):
             inject_query_info(request, response)
         return response
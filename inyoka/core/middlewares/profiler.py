@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+    inyoka.core.middlewares.profiler
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    A middleware that profiles a sample of the requests with :mod:`cProfile`
+    and writes the profiles aggregated per endpoint to a directory.  The
+    files are in the format of :mod:`pstats`, use :func:`load_profile` or
+    ``fab profile`` to inspect them.
+
+    Requests are profiled if they are sampled by ``profiling.sample_rate``
+    or if they carry an ``X-Inyoka-Profile`` header signed with
+    :func:`make_profile_token` and ``profiling.allow_signed`` is enabled.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+import os
+import hmac
+from hashlib import sha1
+from glob import glob
+from cProfile import Profile
+from pstats import Stats
+from threading import Lock
+from time import time
+from itertools import count, izip
+from os.path import join, isdir, getmtime
+
+from inyoka.context import ctx
+from inyoka.core.config import TextConfigField, IntegerConfigField, \
+     BooleanConfigField
+from inyoka.core.middlewares import IMiddleware
+
+
+#: Profile every n-th request, ``0`` disables sampling
+profiling_sample_rate = IntegerConfigField('profiling.sample_rate', default=0,
+                                           min_value=0)
+
+#: Profile requests with a valid ``X-Inyoka-Profile`` header
+profiling_allow_signed = BooleanConfigField('profiling.allow_signed',
+                                            default=False)
+
+#: The directory the profiles are written to
+profiling_path = TextConfigField('profiling.path', default=join(
+    os.environ['INYOKA_INSTANCE'], 'profiles'))
+
+#: The maximal percentage of the request time that may be spent in sampled
+#: requests.  Sampling pauses while the budget is exceeded.
+profiling_max_overhead = IntegerConfigField('profiling.max_overhead',
+                                            default=5, min_value=0)
+
+#: Remove profiles that were not updated for n days
+profiling_retention = IntegerConfigField('profiling.retention', default=7,
+                                         min_value=1)
+
+
+def _get_filename(endpoint, pid):
+    return '%s.%s.prof' % (endpoint.replace('/', '.'), pid)
+
+
+def _safe_str_cmp(a, b):
+    """Compare two strings in constant time."""
+    if len(a) != len(b):
+        return False
+    rv = 0
+    for x, y in izip(a, b):
+        rv |= ord(x) ^ ord(y)
+    return rv == 0
+
+
+def make_profile_token(path):
+    """Return the value of the ``X-Inyoka-Profile`` header that requests a
+    profile of `path`.
+    """
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    secret = ctx.cfg['secret_key'].encode('utf-8')
+    return hmac.new(secret, 'profile:' + path, sha1).hexdigest()
+
+
+def load_profile(endpoint, path=None):
+    """Return the :class:`pstats.Stats` of `endpoint` aggregated over all
+    processes or `None` if there is no profile.
+    """
+    path = path or ctx.cfg['profiling.path']
+    filenames = glob(join(path, _get_filename(endpoint, '[0-9]*')))
+    if filenames:
+        return Stats(*filenames)
+
+
+class _ProfiledBody(object):
+    """The body of a profiled response.  Streamed bodies are generated
+    while the server sends them, so iterating and closing the body is
+    profiled as well.  `callback` is called once the body is closed.
+    """
+
+    def __init__(self, app_iter, profile, callback):
+        self.app_iter = app_iter
+        self.profile = profile
+        self.callback = callback
+
+    def __iter__(self):
+        iterator = iter(self.app_iter)
+        while True:
+            try:
+                chunk = self.profile.runcall(iterator.next)
+            except StopIteration:
+                return
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.profile.runcall(self.app_iter.close)
+        finally:
+            self.callback()
+
+
+class ProfilerMiddleware(IMiddleware):
+    """Profiles sampled requests and aggregates the profiles per endpoint
+    and process.
+    """
+
+    low_level = True
+
+    priority = 80
+
+    def __init__(self, ctx):
+        IMiddleware.__init__(self, ctx)
+        self._counter = count(1)
+        self._lock = Lock()
+        self._stats = {}
+        self._request_time = 0.0
+        self._profiled_time = 0.0
+        self._last_cleanup = 0
+
+    def should_profile(self, environ):
+        """Return `True` if the request of `environ` should be profiled."""
+        cfg = ctx.cfg
+        token = environ.get('HTTP_X_INYOKA_PROFILE')
+        if token and cfg['profiling.allow_signed']:
+            expected = make_profile_token(environ.get('PATH_INFO', ''))
+            return _safe_str_cmp(token, expected)
+        rate = cfg['profiling.sample_rate']
+        if not rate or self._counter.next() % rate:
+            return False
+        return self._profiled_time * 100 <= \
+               self._request_time * cfg['profiling.max_overhead']
+
+    def save(self, endpoint, profile):
+        """Add `profile` to the profile of `endpoint` and write it."""
+        path = ctx.cfg['profiling.path']
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = Stats(profile)
+            else:
+                stats.add(profile)
+            if not isdir(path):
+                os.makedirs(path)
+            stats.dump_stats(join(path, _get_filename(endpoint, os.getpid())))
+            self.cleanup(path)
+
+    def cleanup(self, path):
+        """Remove the profiles older than the retention, at most once
+        an hour.
+        """
+        now = time()
+        if now - self._last_cleanup < 3600:
+            return
+        self._last_cleanup = now
+        limit = now - ctx.cfg['profiling.retention'] * 86400
+        for filename in glob(join(path, '*.prof')):
+            try:
+                if getmtime(filename) < limit:
+                    os.remove(filename)
+            except OSError:
+                # removed by another process
+                pass
+
+    def finish(self, environ, profile, start):
+        """Save the `profile` of the request of `environ`."""
+        request = environ.get('werkzeug.request')
+        endpoint = getattr(request, 'endpoint', None)
+        if endpoint is not None:
+            self.save(endpoint, profile)
+        duration = time() - start
+        self._profiled_time += duration
+        self._request_time += duration
+
+    def __call__(self, environ, start_response):
+        start = time()
+        if not self.should_profile(environ):
+            try:
+                return self.application(environ, start_response)
+            finally:
+                self._request_time += time() - start
+        profile = Profile()
+        try:
+            app_iter = profile.runcall(self.application, environ,
+                                       start_response)
+        except:
+            self.finish(environ, profile, start)
+            raise
+        return _ProfiledBody(app_iter, profile,
+                             lambda: self.finish(environ, profile, start))
@@ -4,24 +4,41 @@
     ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
     A middleware that integrates with werkzeug's SharedDataMiddleware and provides
-    static file serving
+    static file serving.
+
+    Fingerprinted files written by ``fab build_assets`` are served with
+    far-future cache headers and may be handed to the web server with
+    ``static.sendfile_header``.
 
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
 import os
-from os.path import join
-from werkzeug import SharedDataMiddleware
+import mimetypes
+from time import time
+from os.path import join, isfile, getmtime, getsize, normpath, sep
+from werkzeug import SharedDataMiddleware, http_date, wrap_file, parse_etags
 from werkzeug.routing import Rule
 
 from inyoka.context import ctx
+from inyoka.core.assets import get_fingerprint
+from inyoka.core.config import TextConfigField
 from inyoka.core.middlewares import IMiddleware
+from inyoka.core.middlewares.compression import accepts_gzip, \
+     is_compressible
 from itertools import imap
 
 
 STATIC_PATH = join(os.environ['INYOKA_MODULE'], ctx.cfg['static_path'])
 MEDIA_PATH = ctx.cfg['media_root']
 
+#: The header handing fingerprinted files to the web server, e.g.
+#: ``X-Sendfile``.  If empty they are sent by the application.
+static_sendfile_header = TextConfigField('static.sendfile_header', default=u'')
+
+#: The cache timeout of fingerprinted files, one year
+IMMUTABLE_CACHE_TIMEOUT = 60 * 60 * 24 * 365
+
 
 class StaticMiddlewareBase(object):
     """Handles static file requests and dispatches those requests
@@ -40,21 +57,117 @@ class StaticMiddlewareBase(object):
 
     ignore_prefix = True
 
+    #: Serve fingerprinted files with far-future cache headers
+    fingerprinted = False
+
     def __init__(self, ctx):
-        # Convert paths and ids to utf-8, otherwise werkzeug will break
-        self.exports = dict(imap(
-            lambda x: (x[0].encode('utf-8'), x[1].encode('utf-8')),
-            self.exports.items()))
         IMiddleware.__init__(self, ctx)
-        SharedDataMiddleware.__init__(self, self.application, self.exports)
+        self.set_exports(self.exports)
 
-    def __call__(self, *args, **kwargs):
-        return SharedDataMiddleware.__call__(self, *args, **kwargs)
+    def set_exports(self, exports):
+        """Serve the files of `exports`, a dict mapping URL prefixes to
+        directories.
+        """
+        # Convert paths and ids to utf-8, otherwise werkzeug will break
+        exports = dict(imap(
+            lambda x: (x[0].encode('utf-8'), x[1].encode('utf-8')),
+            exports.items()))
+        self.directories = dict((prefix.rstrip('/') + '/', normpath(directory))
+                                for prefix, directory in exports.items())
+        SharedDataMiddleware.__init__(self, self.application, exports)
+
+    def get_filename(self, path):
+        """Return the filename of the exported file at `path` or `None`."""
+        for prefix, directory in self.directories.iteritems():
+            if path.startswith(prefix):
+                # leading slashes would make the path absolute
+                filename = normpath(join(directory,
+                                         path[len(prefix):].lstrip('/')))
+                if filename.startswith(directory + sep) and isfile(filename):
+                    return filename
+
+    def find_precompressed(self, path):
+        """Return the path of the gzip compressed sibling of the file at
+        `path` or `None` if there is no up to date one.  The siblings are
+        created by ``fab compress_static``.
+        """
+        mimetype = mimetypes.guess_type(path)[0]
+        if not mimetype or not is_compressible(mimetype):
+            return None
+        filename = self.get_filename(path)
+        if filename is not None and isfile(filename + '.gz') and \
+           getmtime(filename + '.gz') >= getmtime(filename):
+            return path + '.gz'
+
+    def serve_fingerprinted(self, environ, start_response, path, filename):
+        """Serve the fingerprinted file at `path`.  Its content never
+        changes, so it may be cached forever.  The fingerprint is the ETag,
+        conditional requests sending it are answered with
+        ``304 Not Modified``.
+        """
+        fingerprint = get_fingerprint(path)
+        headers = [
+            ('Date', http_date()),
+            ('Cache-Control', 'max-age=%d, public, immutable' %
+                              IMMUTABLE_CACHE_TIMEOUT),
+            ('Expires', http_date(time() + IMMUTABLE_CACHE_TIMEOUT)),
+            ('Etag', '"%s"' % fingerprint),
+        ]
+        if parse_etags(environ.get('HTTP_IF_NONE_MATCH')).contains(fingerprint):
+            start_response('304 Not Modified', headers)
+            return []
+
+        mimetype = mimetypes.guess_type(path)[0] or self.fallback_mimetype
+        headers.append(('Content-Type', mimetype))
+        if self.find_precompressed(path) is not None:
+            headers.append(('Vary', 'Accept-Encoding'))
+            if accepts_gzip(environ):
+                filename += '.gz'
+                headers.append(('Content-Encoding', 'gzip'))
+
+        sendfile_header = ctx.cfg['static.sendfile_header']
+        if sendfile_header:
+            headers.append((sendfile_header.encode('utf-8'), filename))
+            start_response('200 OK', headers)
+            return []
+        headers.append(('Content-Length', str(getsize(filename))))
+        start_response('200 OK', headers)
+        # uses ``wsgi.file_wrapper`` if the server provides one
+        return wrap_file(environ, open(filename, 'rb'))
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if self.fingerprinted and get_fingerprint(path) is not None:
+            filename = self.get_filename(path)
+            if filename is not None:
+                return self.serve_fingerprinted(environ, start_response,
+                                                path, filename)
+
+        compressed = self.find_precompressed(path)
+        if compressed is None:
+            return SharedDataMiddleware.__call__(self, environ, start_response)
+
+        vary = [('Vary', 'Accept-Encoding')]
+        if not accepts_gzip(environ):
+            def _start_response(status, headers, exc_info=None):
+                return start_response(status, headers + vary, exc_info)
+            return SharedDataMiddleware.__call__(self, environ, _start_response)
+
+        mimetype = mimetypes.guess_type(path)[0] or self.fallback_mimetype
+        def _start_response(status, headers, exc_info=None):
+            headers = [(key, value) for key, value in headers
+                       if key.lower() != 'content-type']
+            headers += [('Content-Type', mimetype),
+                        ('Content-Encoding', 'gzip')] + vary
+            return start_response(status, headers, exc_info)
+        return SharedDataMiddleware.__call__(self, dict(environ,
+            PATH_INFO=compressed), _start_response)
 
 
 class StaticMiddleware(StaticMiddlewareBase, IMiddleware, SharedDataMiddleware):
     """Concrete static file serving middleware implementation"""
     name = 'static'
+    fingerprinted = True
     exports = {ctx.cfg['routing.urls.static'].split(':', 1)[1]: STATIC_PATH}
     url_rules = [
         Rule('/', defaults={'file': '/'}, endpoint='static'),
@@ -115,6 +115,9 @@ class Tag(db.Model, SerializableObject):
     object_type = 'core.tag'
     public_fields = ('id', 'name', 'slug')
 
+    #: the tag clouds are cached with the ``tags`` fragment cache tag
+    reference = db.ReferenceData('slug', fragments=['tags'])
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Unicode(20), nullable=False, index=True)
     slug = db.Column(db.Unicode(20), nullable=False, unique=True)
@@ -237,3 +240,16 @@ class Storage(db.Model):
 
     key = db.Column(db.Unicode(200), primary_key=True, index=True)
     value = db.Column(db.PickleType)
+
+
+class SlugCounter(db.Model):
+    """The last numeric suffix handed out for a slug prefix.  Used by
+    :class:`~inyoka.core.database.SlugGenerator` to find the next free slug
+    without scanning all similar slugs.
+    """
+    __tablename__ = 'core_slug_counter'
+
+    #: The slug column in the form ``table.column``
+    name = db.Column(db.String(100), primary_key=True)
+    prefix = db.Column(db.Unicode(200), primary_key=True)
+    value = db.Column(db.Integer, nullable=False)
@@ -10,13 +10,14 @@ import re
 import sre_constants
 from inspect import ismethod, getmembers
 from datetime import datetime
+from urlparse import urljoin
 from werkzeug.routing import Submount, Subdomain, EndpointPrefix, \
-    Rule, BaseConverter, ValidationError
+    Rule, BaseConverter, ValidationError, RequestSlash, RequestRedirect
 from werkzeug import url_quote
-from werkzeug.routing import Map as BaseMap
+from werkzeug.routing import Map as BaseMap, MapAdapter as BaseMapAdapter
 from inyoka import Interface
 from inyoka.context import ctx
-from inyoka.core.exceptions import MethodNotAllowed
+from inyoka.core.exceptions import MethodNotAllowed, NotFound
 from inyoka.core.serializer import send_service_response
 from inyoka.utils.urls import make_full_domain
 from inyoka.utils.decorators import make_decorator, update_wrapper
@@ -24,6 +25,7 @@ from inyoka.core.config import DottedConfigField
 
 
 _date_formatter_split_re = re.compile('(%.)')
+_simple_rule_re = re.compile(r'<([^>]+)>')
 _date_formatter_mapping = {
     'd': r'\d\d',
     'j': r'\d{3}',
@@ -328,7 +330,202 @@ class DateConverter(BaseConverter):
                                   'be invalid.')
 
 
+def _get_literal_prefix(rule):
+    """Return the static beginning of the ``subdomain|/path`` string `rule`
+    matches and whether that is the complete rule.
+    """
+    trace = rule._trace if rule.is_leaf else rule._trace[:-1]
+    prefix = []
+    for is_dynamic, data in trace:
+        if is_dynamic:
+            return u''.join(prefix), False
+        prefix.append(data)
+    return u''.join(prefix), True
+
+
+class MapAdapter(BaseMapAdapter):
+    """An adapter that only matches the rules that can apply to the
+    subdomain and the first path segment of the URL (see
+    :meth:`Map.get_match_candidates`) and remembers which rules can build
+    an URL for an endpoint and a set of argument names.  Werkzeug tries
+    every rule on each match and every rule of the endpoint on each build
+    which adds up with many applications and links.
+    """
+
+    def match(self, path_info=None, method=None, return_rule=False):
+        # Works like werkzeug's `MapAdapter.match`, except for the rules
+        # tried.  Keep in sync when upgrading werkzeug.
+        self.map.update()
+        if path_info is None:
+            path_info = self.path_info
+        if not isinstance(path_info, unicode):
+            path_info = path_info.decode(self.map.charset, 'ignore')
+        method = (method or self.default_method).upper()
+        path_info = path_info.lstrip('/')
+        path = u'%s|/%s' % (self.subdomain, path_info)
+        have_match_for = set()
+        candidates = self.map.get_match_candidates(self.subdomain,
+                                                   path_info.split('/', 1)[0])
+        for prefix, rule in candidates:
+            if not path.startswith(prefix):
+                continue
+            try:
+                rv = rule.match(path)
+            except RequestSlash:
+                raise RequestRedirect(str('%s://%s%s%s/%s/' % (
+                    self.url_scheme,
+                    self.subdomain and self.subdomain + '.' or '',
+                    self.server_name,
+                    self.script_name[:-1],
+                    url_quote(path_info, self.map.charset)
+                )))
+            if rv is None:
+                continue
+            if rule.methods is not None and method not in rule.methods:
+                have_match_for.update(rule.methods)
+                continue
+            if self.map.redirect_defaults:
+                for r in self.map._rules_by_endpoint[rule.endpoint]:
+                    if r.provides_defaults_for(rule) and \
+                       r.suitable_for(rv, method):
+                        rv.update(r.defaults)
+                        subdomain, path = r.build(rv)
+                        raise RequestRedirect(str('%s://%s%s%s/%s' % (
+                            self.url_scheme,
+                            subdomain and subdomain + '.' or '',
+                            self.server_name,
+                            self.script_name[:-1],
+                            url_quote(path.lstrip('/'), self.map.charset)
+                        )))
+            if rule.redirect_to is not None:
+                if isinstance(rule.redirect_to, basestring):
+                    def _handle_match(match):
+                        value = rv[match.group(1)]
+                        return rule._converters[match.group(1)].to_url(value)
+                    redirect_url = _simple_rule_re.sub(_handle_match,
+                                                       rule.redirect_to)
+                else:
+                    redirect_url = rule.redirect_to(self, **rv)
+                raise RequestRedirect(str(urljoin('%s://%s%s%s' % (
+                    self.url_scheme,
+                    self.subdomain and self.subdomain + '.' or '',
+                    self.server_name,
+                    self.script_name
+                ), redirect_url)))
+            if return_rule:
+                return rule, rv
+            return rule.endpoint, rv
+        if have_match_for:
+            raise MethodNotAllowed(valid_methods=list(have_match_for))
+        raise NotFound()
+
+    def _get_build_candidates(self, endpoint, names, method):
+        if method is None:
+            # like werkzeug try the rules of the default method first
+            methods = (self.default_method, None)
+        else:
+            methods = (method,)
+        candidates = []
+        for method in methods:
+            for rule in self.map._rules_by_endpoint.get(endpoint, ()):
+                if method is not None and rule.methods is not None and \
+                   method not in rule.methods:
+                    continue
+                if not rule.arguments - set(rule.defaults or ()) <= names:
+                    continue
+                # the defaults must match the values on every build
+                check = rule.defaults is not None and rule.arguments <= names
+                if (rule, check) not in candidates:
+                    candidates.append((rule, check))
+        return candidates
+
+    def _partial_build(self, endpoint, values, method, append_unknown):
+        names = frozenset(values)
+        key = (endpoint, method, names)
+        candidates = self.map._build_cache.get(key)
+        if candidates is None:
+            candidates = self._get_build_candidates(endpoint, names, method)
+            self.map._build_cache[key] = candidates
+        for rule, check in candidates:
+            if check and not rule.suitable_for(values):
+                continue
+            rv = rule.build(values, append_unknown)
+            if rv is not None:
+                return rv
+
+
 class Map(BaseMap):
-    """Our own map implementation for hooking in some custom converters"""
+    """Our own map implementation for hooking in some custom converters
+    and caching the rule lookup of :class:`MapAdapter`.
+    """
     default_converters = BaseMap.default_converters.copy()
     default_converters['date'] = DateConverter
+
+    def __init__(self, *args, **kwargs):
+        self._build_cache = {}
+        self._match_index = None
+        BaseMap.__init__(self, *args, **kwargs)
+
+    def add(self, rulefactory):
+        BaseMap.add(self, rulefactory)
+        self._build_cache.clear()
+        self._match_index = None
+
+    def _build_match_index(self):
+        """Partition the rules by subdomain and the first path segment.
+        Returns ``{subdomain: ({segment: rules}, rules)}`` and the rules
+        with a dynamic subdomain.  The first rules are the ones for a
+        known segment, the second one those for any other segment.  All
+        rules are ``(literal prefix, rule)`` tuples in matching order.
+        """
+        partitions = {}
+        any_subdomain = []
+        for position, rule in enumerate(self._rules):
+            if rule.build_only:
+                continue
+            prefix, complete = _get_literal_prefix(rule)
+            entry = (position, prefix, rule)
+            if '|' not in prefix:
+                any_subdomain.append(entry)
+                continue
+            subdomain, path = prefix.split('|', 1)
+            segments, other = partitions.setdefault(subdomain, ({}, []))
+            path = path[1:]
+            if '/' in path or (complete and path):
+                segments.setdefault(path.split('/', 1)[0], []).append(entry)
+            else:
+                other.append(entry)
+
+        def _merge(*entries):
+            return [(prefix, rule) for position, prefix, rule in
+                    sorted(sum(entries, []), key=lambda entry: entry[0])]
+
+        index = {}
+        for subdomain, (segments, other) in partitions.iteritems():
+            index[subdomain] = (
+                dict((segment, _merge(rules, other, any_subdomain))
+                     for segment, rules in segments.iteritems()),
+                _merge(other, any_subdomain))
+        return index, _merge(any_subdomain)
+
+    def get_match_candidates(self, subdomain, segment):
+        """Return the ``(literal prefix, rule)`` tuples that can match an
+        URL on `subdomain` whose path starts with `segment`, in the order
+        werkzeug tries them.
+        """
+        if self._match_index is None:
+            self._match_index = self._build_match_index()
+        index, any_subdomain = self._match_index
+        if subdomain not in index:
+            return any_subdomain
+        segments, other = index[subdomain]
+        return segments.get(segment, other)
+
+    def bind(self, server_name, script_name=None, subdomain=None,
+             url_scheme='http', default_method='GET', path_info=None):
+        if subdomain is None:
+            subdomain = self.default_subdomain
+        if script_name is None:
+            script_name = '/'
+        return MapAdapter(self, server_name, script_name, subdomain,
+                          url_scheme, path_info, default_method)
@@ -9,9 +9,28 @@
     :license: GNU GPL, see LICENSE for more details.
 """
 from inyoka.i18n import serve_javascript
-from inyoka.core.api import IServiceProvider, Rule, service
+from inyoka.context import ctx
+from inyoka.core.api import IServiceProvider, Rule, service, db
+from inyoka.core.config import TextConfigField
+from inyoka.core.exceptions import Forbidden
 from inyoka.core.models import Tag
 from inyoka.core.auth.models import User
+from inyoka.utils.timing import get_request_stats
+
+
+#: Whitespace separated list of the remote addresses that are allowed to
+#: fetch the internal statistics of a worker process.  The statistics must
+#: be fetched from the worker directly: behind a reverse proxy every
+#: request comes from the address of the proxy, so requests forwarded by a
+#: proxy (with an ``X-Forwarded-For`` header) are always refused.
+stats_allowed_addresses = TextConfigField('stats_allowed_addresses',
+                                          default=u'127.0.0.1 ::1')
+
+
+def _check_stats_access(request):
+    if 'X-Forwarded-For' in request.headers or request.remote_addr not in \
+       ctx.cfg['stats_allowed_addresses'].split():
+        raise Forbidden()
 
 
 class CoreServiceController(IServiceProvider):
@@ -21,6 +40,8 @@ class CoreServiceController(IServiceProvider):
         Rule('/get_tags/', endpoint='get_tags'),
         Rule('/get_translations/', endpoint='get_translations'),
         Rule('/get_user/', endpoint='get_user'),
+        Rule('/database_stats/', endpoint='database_stats'),
+        Rule('/request_stats/', endpoint='request_stats'),
     ]
 
     #@service('get_tags', config={'core.tag': ['label', 'value'], 'show_type': False})
@@ -45,6 +66,18 @@ class CoreServiceController(IServiceProvider):
             users = User.query.filter(User.username.startswith(q))
         return [user.username for user in users[:10]]
 
+    @service('database_stats')
+    def database_stats(self, request):
+        _check_stats_access(request)
+        status = db.get_pool_status()
+        status['queries'] = db.query_stats.snapshot()
+        return status
+
+    @service('request_stats')
+    def request_stats(self, request):
+        _check_stats_access(request)
+        return get_request_stats()
+
     @service('get_translations')
     def get_translations(self, request):
         return serve_javascript(request)
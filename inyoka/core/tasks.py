@@ -16,6 +16,7 @@ from xappy import errors
 from inyoka.i18n import _
 from inyoka.context import ctx
 from inyoka.core.auth.models import User
+from inyoka.core.database import db
 from inyoka.core.resource import IResourceManager
 from inyoka.core.search import create_search_document, SearchIndex
 from inyoka.core.subscriptions import SubscriptionAction
@@ -192,3 +193,26 @@ def flush_indexer():
         with index.indexer_connection() as indexer:
             logger.debug('Flush search index: %s' % index.name)
             indexer.flush()
+
+
+@periodic_task(run_every=timedelta(minutes=1))
+def flush_counters():
+    """
+    Write the buffered counter increments (e.g. view counts) back to the
+    database.
+    """
+    logger = flush_counters.get_logger()
+    rows = db.flush_counters()
+    logger.debug('Flushed buffered counters of %d rows' % rows)
+
+
+@periodic_task(run_every=timedelta(days=1))
+def reconcile_counters():
+    """
+    Recompute the denormalized counters (e.g. answer counts or tag counts)
+    and correct the ones that drifted.
+    """
+    logger = reconcile_counters.get_logger()
+    for name, drift in db.reconcile_counters().iteritems():
+        logger.debug('Reconciled counter %s, %d rows drifted'
+                     % (name, len(drift)))
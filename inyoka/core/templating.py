@@ -13,17 +13,22 @@ import sys
 import json
 import functools
 from threading import Lock
+import shutil
 from jinja2 import Environment, FileSystemLoader, StrictUndefined, \
     ChoiceLoader, FileSystemBytecodeCache, MemcachedBytecodeCache, \
-    PrefixLoader
+    PrefixLoader, BaseLoader, ModuleLoader, TemplateNotFound, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
 from inyoka import INYOKA_REVISION, l10n, i18n
 from inyoka.context import ctx
 from inyoka.signals import signals
-from inyoka.core.http import Response
+from inyoka.core.http import Response, iter_coalesced
 from inyoka.core.routing import href, IServiceProvider
+from inyoka.core.assets import asset_url, asset_urls
 from inyoka.core.resource import IResourceManager
-from inyoka.core.cache import cache as inyoka_cache
+from inyoka.core.cache import cache as inyoka_cache, cached_fragment
 from inyoka.core.config import TextConfigField, BooleanConfigField
+from inyoka.utils.timing import timed
 
 
 #! This signal is raised if a template is rendered.  Use it to catch context variables
@@ -48,6 +53,14 @@ templates_use_memcached_cache = BooleanConfigField('templates.use_memcached_cach
 #: Use filesystem for bytecode caching
 templates_use_filesystem_cache = BooleanConfigField('templates.use_filesystem_cache', default=False)
 
+#: Load the templates compiled by ``fab compile_templates``, this disables
+#: auto reloading
+templates_use_compiled = BooleanConfigField('templates.use_compiled', default=False)
+
+#: The directory the compiled templates are written to
+templates_compiled_path = TextConfigField('templates.compiled_path',
+    default=os.path.join(os.environ['INYOKA_INSTANCE'], 'compiled_templates'))
+
 
 def populate_context_defaults(context):
     """Fill in context defaults."""
@@ -69,7 +82,11 @@ def _return_rendered_template(tmpl, context, modifier, request=None, stream=Fals
     # apply the context modifier
     if modifier is not None:
         modifier(request, context)
-    retval = tmpl.stream(context) if stream else tmpl.render(context)
+    if stream:
+        retval = tmpl.stream(context)
+    else:
+        with timed('template'):
+            retval = tmpl.render(context)
     template_rendered.send(template=tmpl, context=context)
     return retval
 
@@ -109,6 +126,12 @@ def templated(template_name, modifier=None, stream=False):
     :exc:`~inyoka.core.database.NoResultFound` exceptions are catched
     and raised again as :exc:`~inyoka.core.exceptions.NotFound`.
 
+    With `stream` enabled the page is sent while it is rendered, in chunks
+    of ``streaming.chunk_size``.  The headers and the session cookie are
+    sent before the template is rendered, so the template must not modify
+    the session and errors while rendering cannot show an error page.
+    Pages with flashed messages are not streamed for that reason.
+
     :param template_name: The name of the template to render.
     :param modifier: A callback to modify the template context on-the-fly.
     :param stream: Use Jinja template streaming, see :func:`render_template`
@@ -124,14 +147,73 @@ def templated(template_name, modifier=None, stream=False):
             if not isinstance(context, dict):
                 return Response.force_type(context)
 
+            streamed = stream and \
+                not ctx.current_request.has_flashed_messages()
             data = render_template(template_name, context, modifier=modifier,
-                                   request=request, stream=stream)
+                                   request=request, stream=streamed)
+            if streamed:
+                data = iter_coalesced(data)
             response = Response(data)
             return response
         return templated_wrapper
     return decorator
 
 
+class CompiledLoader(BaseLoader):
+    """Loads the templates compiled by :func:`compile_templates` from
+    `path`.  Templates that were not compiled are loaded from the
+    `source_loader`, which also provides the sources to compile.
+    """
+
+    def __init__(self, path, source_loader):
+        self.module_loader = ModuleLoader(path)
+        self.source_loader = source_loader
+
+    def get_source(self, environment, template):
+        return self.source_loader.get_source(environment, template)
+
+    def list_templates(self):
+        return self.source_loader.list_templates()
+
+    def load(self, environment, name, globals=None):
+        try:
+            return self.module_loader.load(environment, name, globals)
+        except TemplateNotFound:
+            return self.source_loader.load(environment, name, globals)
+
+
+class FragmentCacheExtension(Extension):
+    """Caches the rendered content of a template block::
+
+        {% cache 'portal/tag_cloud', 300, ['tags'] %}
+          ...
+        {% endcache %}
+
+    The arguments are the key, the timeout in seconds and the tags to
+    invalidate the fragment with, the latter two are optional.  See
+    :func:`~inyoka.core.cache.cached_fragment` for the details.  Variables
+    of the block must be computed inside of it or they are computed for
+    every request anyway.
+    """
+
+    tags = set(['cache'])
+
+    def parse(self, parser):
+        lineno = parser.stream.next().lineno
+        args = [parser.parse_expression()]
+        for default in (None, ()):
+            if parser.stream.skip_if('comma'):
+                args.append(parser.parse_expression())
+            else:
+                args.append(nodes.Const(default))
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_cache', args), [], [],
+                               body).set_lineno(lineno)
+
+    def _cache(self, key, timeout, tags, caller):
+        return Markup(cached_fragment(key, caller, timeout, tags))
+
+
 class InyokaEnvironment(Environment):
     def __init__(self):
         loaders = {}
@@ -140,6 +222,10 @@ class InyokaEnvironment(Environment):
 
         loader = ChoiceLoader([FileSystemLoader(ctx.cfg['templates.path']),
                                PrefixLoader(loaders)])
+        auto_reload = ctx.cfg['templates.auto_reload']
+        if ctx.cfg['templates.use_compiled']:
+            loader = CompiledLoader(ctx.cfg['templates.compiled_path'], loader)
+            auto_reload = False
 
         cache_obj = None
         if ctx.cfg['templates.use_cache']:
@@ -156,8 +242,8 @@ class InyokaEnvironment(Environment):
         Environment.__init__(self,
             loader=loader,
             extensions=['jinja2.ext.i18n', 'jinja2.ext.do', 'jinja2.ext.with_',
-                        'jinja2.ext.autoescape'],
-            auto_reload=ctx.cfg['templates.auto_reload'],
+                        'jinja2.ext.autoescape', FragmentCacheExtension],
+            auto_reload=auto_reload,
             undefined=StrictUndefined,
             cache_size=-1,
             bytecode_cache=cache_obj,
@@ -169,6 +255,8 @@ class InyokaEnvironment(Environment):
             PYTHON_VERSION='%d.%d.%d' % sys.version_info[:3],
             DEBUG=ctx.cfg['debug'],
             href=href,
+            asset_url=asset_url,
+            asset_urls=asset_urls,
         )
         self.filters.update(
             jsonencode=json.dumps,
@@ -199,6 +287,26 @@ def get_environment():
         return _jinja_env
 
 
+def compile_templates(target=None):
+    """Compile all templates to modules in `target`, by default
+    ``templates.compiled_path``, replacing the previously compiled ones.
+    Return the number of compiled templates.
+    """
+    target = target or ctx.cfg['templates.compiled_path']
+    env = get_environment()
+    names = env.list_templates()
+    tmp_target = target + '.tmp'
+    if os.path.isdir(tmp_target):
+        shutil.rmtree(tmp_target)
+    os.makedirs(tmp_target)
+    env.compile_templates(tmp_target, zip=None, ignore_errors=False,
+                          py_compile=True)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    os.rename(tmp_target, target)
+    return len(names)
+
+
 @i18n.translations_reloaded.connect
 def reload_environment(sender):
     get_environment().install_gettext_translations(
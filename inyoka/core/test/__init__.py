@@ -14,6 +14,7 @@ import sys
 import unittest
 import warnings
 from functools import wraps, partial
+from contextlib import contextmanager
 from urllib2 import urlparse
 
 import nose
@@ -47,7 +48,7 @@ __all__ = ('TestResponse', 'ViewTestCase', 'TestCase', 'with_fixtures',
            'future', 'db', 'Response', 'ctx',
            'DatabaseTestCase', 'TestResourceManager',
            'skip_if_environ', 'todo', 'skip', 'skip_if', 'skip_unless', 'skip_if_database',
-           'set_simple_cache')
+           'set_simple_cache', 'assert_no_n_plus_one')
 
 
 __all__ = __all__ + tuple(nose.tools.__all__)
@@ -467,6 +468,7 @@ class InyokaPlugin(cover.Coverage):
         self._transaction.rollback()
         db.session.rollback()
         db.session.remove()
+        db.clear_reference_data()
 
     def finalize(self, result):
         """Cleanup some stuff."""
@@ -592,6 +594,22 @@ def set_simple_cache(func):
     return wrapper
 
 
+@contextmanager
+def assert_no_n_plus_one(threshold=5):
+    """Fail if some statement is executed more than `threshold` times
+    (except for its parameters) in the `with` block.  Example::
+
+        with assert_no_n_plus_one(threshold=3):
+            self.get('/questions/')
+
+    """
+    with db.detect_n_plus_one(threshold) as detector:
+        yield detector
+    if detector.offenders:
+        raise AssertionError(u'N+1 query pattern detected:\n%s'
+                             % detector.report())
+
+
 def future(func):
     """Mark a test as expected to unconditionally fail."""
     @wraps(func)
@@ -13,6 +13,7 @@
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
+from time import time
 from datetime import timedelta, datetime
 
 from werkzeug import redirect, cached_property, create_environ
@@ -25,6 +26,7 @@ from inyoka.core.exceptions import HTTPException, NotFound
 from inyoka.core.routing import Map
 from inyoka.utils.http import notfound
 from inyoka.utils.logger import RequestProcessor
+from inyoka.utils.timing import timed, record_timings, format_server_timing
 
 
 class _RequestContext(object):
@@ -37,16 +39,26 @@ class _RequestContext(object):
     :param environ: the WSGI environment dictionary.
     """
 
+    #: Set while a streamed response body is sent.  The context is then
+    #: popped by the body when the server closes it.
+    streaming = False
+
     def __init__(self, ctx, environ):
         self.ctx = ctx
         self.request = request = ctx.dispatcher.request_class(environ)
-        urls = ctx.dispatcher.get_url_adapter(environ)
-
+        self.url_adapter = None
+        rule, args = None, None
+        start = time()
         try:
-            rule, args = urls.match(request.path, return_rule=True)
+            # the adapter is reused for all URLs built during the request
+            self.url_adapter = ctx.dispatcher.get_url_adapter(environ)
+            rule, args = self.url_adapter.match(request.path, return_rule=True)
+        except ValueError:
+            # not our base domain, the dispatcher redirects to it
+            pass
         except HTTPException as err:
-            rule, args = None, None
             request.routing_exception = err
+        request.timings['routing'] = time() - start
         request.url_rule = rule
         request.view_args = args
 
@@ -63,6 +75,8 @@ class _RequestContext(object):
         return self
 
     def __exit__(self, exc_type, exc_value, tb):
+        if self.streaming:
+            return
         # do not pop the request stack if we are in debug mode and an
         # exception happened.  This will allow the debugger to still
         # access the request object in the interactive shell.  Furthermore
@@ -73,6 +87,34 @@ class _RequestContext(object):
             self.pop()
 
 
+class _StreamedBody(object):
+    """The body of a streamed response.  It is generated while the server
+    sends it, so the request stays bound until the server closes the body.
+    Closing it records the statistics of the request with `finish` and
+    cleans up the request.
+    """
+
+    def __init__(self, app_iter, reqctx, finish, callbacks):
+        self.app_iter = app_iter
+        self.reqctx = reqctx
+        self.finish = finish
+        self.callbacks = callbacks
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+            self.finish()
+        finally:
+            self.reqctx.streaming = False
+            self.reqctx.__exit__(None, None, None)
+            for callback in self.callbacks:
+                callback()
+
+
 class RequestDispatcher(object):
     """The main dispatcher that handles all the dispatching
     and routing stuff.
@@ -89,6 +131,7 @@ class RequestDispatcher(object):
         self.ctx = ctx
         self.cleanup_callbacks = (db.session.close, local_manager.cleanup,
                                   self.ctx.bind)
+        self._unbound_adapters = {}
 
     @cached_property
     def url_map(self):
@@ -109,14 +152,23 @@ class RequestDispatcher(object):
         """Get an url adapter.
 
         The adapter is bound to the current url map
-        and, if present, the current request.
+        and, if present, the current request.  The adapter of the current
+        request is bound only once and reused, as is the adapter used
+        outside of requests.
         """
+        if environ is None:
+            reqctx = _request_ctx_stack.top
+            if reqctx is not None and reqctx.url_adapter is not None:
+                return reqctx.url_adapter
         domain = self.ctx.cfg['base_domain_name']
         try:
             env = environ or self.ctx.current_request.environ
             adapter = self.url_map.bind_to_environ(env, server_name=domain)
         except AttributeError:
-            adapter = self.url_map.bind(domain)
+            adapter = self._unbound_adapters.get(domain)
+            if adapter is None or adapter.map is not self.url_map:
+                adapter = self.url_map.bind(domain)
+                self._unbound_adapters[domain] = adapter
         return adapter
 
     def get_view(self, endpoint):
@@ -146,7 +198,7 @@ class RequestDispatcher(object):
         try:
             # Test if we are on the correct base domain and do redirect
             # if we're using something like `localhost` instead.
-            url_adapter = self.get_url_adapter(request.environ)
+            url_adapter = self.get_url_adapter()
         except ValueError:
             # we cannot use make_full_domain() here because the url adapter
             # is used there too.  So we raise a new `ValueError` here too.
@@ -154,7 +206,9 @@ class RequestDispatcher(object):
             return redirect('http://%s/' % self.ctx.cfg['base_domain_name'])
 
         for middleware in IMiddleware.iter_middlewares():
-            response = middleware.process_request(request)
+            with timed('mw.%s.request' % middleware.__class__.__name__,
+                       request):
+                response = middleware.process_request(request)
 
             if response is not None:
                 return response
@@ -167,7 +221,8 @@ class RequestDispatcher(object):
 
             try:
                 view = self.get_view(request.endpoint)
-                response = view(request, **request.view_args)
+                with timed('view', request):
+                    response = view(request, **request.view_args)
                 if response is None:
                     raise ValueError('View function did not return a response')
             except db.NoResultFound:
@@ -188,7 +243,9 @@ class RequestDispatcher(object):
         # If an request modifing middleware is in-place we never reach
         # this code block.
         for middleware in reversed(IMiddleware.iter_middlewares()):
-            response = middleware.process_response(request, response)
+            with timed('mw.%s.response' % middleware.__class__.__name__,
+                       request):
+                response = middleware.process_response(request, response)
 
         return response
 
@@ -209,12 +266,18 @@ class RequestDispatcher(object):
         # and all the other stuff on the current thread but initialize
         # it afterwards.  We do this so that the request object can query
         # the database in the initialization method.
+        start = time()
         self.ctx.bind()
         with self.request_context(environ) as reqctx:
             request = reqctx.request
 
             with RequestProcessor(request):
                 response = self.dispatch_request(request, environ)
+                # the timings of streamed bodies are not complete yet
+                self.update_timings(request, start)
+                if ctx.cfg['timing.server_timing_header']:
+                    response.headers['Server-Timing'] = \
+                        format_server_timing(request.timings)
 
                 # apply common response processors like cookies and etags
                 if request.session.should_save:
@@ -232,7 +295,33 @@ class RequestDispatcher(object):
                     response.add_etag()
                     response = response.make_conditional(request)
 
-            return response(environ, start_response)
+            app_iter = response(environ, start_response)
+            if not response.is_sequence:
+                # the request is recorded and cleaned up by the body,
+                # see `__call__`
+                reqctx.streaming = True
+                environ['inyoka.streamed'] = True
+                return _StreamedBody(app_iter, reqctx,
+                    lambda: self.record_request(request, start),
+                    self.cleanup_callbacks)
+            self.record_request(request, start)
+            return app_iter
+
+    def update_timings(self, request, start):
+        """Add the database time and the total time since `start` to the
+        timings of `request`.
+        """
+        request.timings['db'] = request.db_time
+        request.timings['total'] = time() - start
+
+    def record_request(self, request, start):
+        """Record the query and timing statistics of `request` that was
+        started at `start`.
+        """
+        db.record_query_stats(request)
+        db.warn_n_plus_one(request)
+        self.update_timings(request, start)
+        record_timings(request)
 
     def make_response(self, request, rev):
         """Converts the return value from a handler to a real response
@@ -313,16 +402,20 @@ class RequestDispatcher(object):
 
         You shall not (never ever) access stuff like the db-session and locals
         in outer WSGI middlewares.  This method also keeps track of config
-        changes and emits the proper `config-changed` signal.
+        changes and emits the proper `config-changed` signal, the file is
+        checked at most every ``config_check_interval`` seconds.
+
+        Streamed responses are cleaned up after their body was sent.
         """
         try:
             # reload the configuration if it was changed
-            if self.ctx.cfg.changed_external:
-                self.ctx.cfg.reload()
+            cfg = self.ctx.cfg
+            cfg.reload_if_changed(cfg['config_check_interval'])
             return self.dispatch_wsgi(environ, start_response)
         finally:
-            for callback in self.cleanup_callbacks:
-                callback()
+            if not environ.get('inyoka.streamed'):
+                for callback in self.cleanup_callbacks:
+                    callback()
 
 
 def make_dispatcher(ctx):
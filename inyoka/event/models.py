@@ -139,3 +139,6 @@ class Event(db.Model, SerializableObject, TextRendererMixin):
 
     def __unicode__(self):
         return self.title
+
+
+db.register_counter(Tag.tagged, event_tag.c.tag_id)
@@ -15,7 +15,7 @@ from inyoka.core.api import IController, Rule, view, templated, db, \
          redirect, redirect_to, href, login_required
 from inyoka.core.exceptions import Forbidden
 from inyoka.core.forms.utils import model_to_dict, update_model
-from inyoka.utils.pagination import URLPagination
+from inyoka.utils.pagination import KeysetURLPagination, cached_count
 from itertools import ifilter
 
 
@@ -89,7 +89,7 @@ class ForumController(IController):
 
         # Filter by Forum or Tag (optionally)
         if forum:
-            forum = Forum.query.filter_by(slug=forum).first()
+            forum = Forum.query.get_by(slug=forum)
             query = query.forum(forum)
             tags = forum.all_tags
         elif tags:
@@ -101,7 +101,10 @@ class ForumController(IController):
         query = getattr(query, sort)
 
         # Paginate results
-        pagination = URLPagination(query, page)
+        pagination = KeysetURLPagination(query, page,
+                                         after=request.args.get('after'),
+                                         before=request.args.get('before'),
+                                         total=cached_count(query))
         return {
             'forum': forum,
             'tags': tags or [],
@@ -111,7 +114,7 @@ class ForumController(IController):
         }
 
     @view('question')
-    @templated('forum/question.html', modifier=context_modifier)
+    @templated('forum/question.html', modifier=context_modifier, stream=True)
     def question(self, request, slug, sort='votes', page=1):
         question = Question.query.filter_by(slug=slug).one()
         answer_query = Answer.query.filter_by(question=question)
@@ -119,7 +122,10 @@ class ForumController(IController):
         # Order by "votes", "latest" or "oldest"
         answer_query = getattr(answer_query, sort)
 
-        pagination = URLPagination(answer_query, page)
+        pagination = KeysetURLPagination(answer_query, page,
+                                         after=request.args.get('after'),
+                                         before=request.args.get('before'),
+                                         total=question.answer_count)
 
         form = AnswerQuestionForm(request.form)
         if form.validate_on_submit():
@@ -160,7 +166,7 @@ class ForumController(IController):
             tags = ifilter(bool, (Tag.query.public().filter_by(slug=t).one() \
                           for t in request.args.get('tags').split()))
         elif forum:
-            forum = Forum.query.filter_by(slug=forum).one()
+            forum = Forum.query.get_by(slug=forum)
             tags = forum.tags
 
         form = AskQuestionForm(request.form, tags=tags)
@@ -230,7 +236,7 @@ class ForumController(IController):
     @templated('forum/admin/forum.html')
     def edit_forum(self, request, forum=None):
         if forum:
-            forum = Forum.query.filter_by(slug=forum).first()
+            forum = Forum.query.get_by(slug=forum)
             initial = model_to_dict(forum)
         else:
             forum = None
@@ -70,6 +70,8 @@ class Forum(db.Model, SerializableObject):
     public_fields = ('id', 'name', 'slug', 'description', 'tags'
                      'position', 'subforums')
 
+    reference = db.ReferenceData('slug')
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.Unicode(80), nullable=False)
     slug = db.Column(db.Unicode(80), unique=True, index=True)
@@ -171,6 +173,7 @@ class ForumEntry(db.Model, SerializableObject, TextRendererMixin):
     score = db.Column(db.Integer, nullable=False, default=0)
     text = db.Column(db.Text, nullable=False)
     view_count = db.Column(db.Integer, default=0, nullable=False)
+    views = db.BufferedCounter('view_count')
 
     author = db.relationship(User, lazy='joined', innerjoin=True)
     votes = db.relationship('Vote', backref='entry',
@@ -179,7 +182,7 @@ class ForumEntry(db.Model, SerializableObject, TextRendererMixin):
     __mapper_args__ = {'polymorphic_on': discriminator}
 
     def touch(self):
-        db.atomic_add(self, 'view_count', 1)
+        ForumEntry.views.add(self)
 
     def get_vote(self, user):
         return Vote.query.filter_by(user=user, entry=self).first()
@@ -322,3 +325,9 @@ class Vote(db.Model, SerializableObject):
     favorite = db.Column(db.Boolean, nullable=False, default=False)
 
     user = db.relationship(User, backref='votes', lazy='joined', innerjoin=True)
+
+
+db.register_counter(Question.answer_count, Answer.question_id)
+db.register_counter(ForumEntry.score, Vote.entry_id, db.func.sum(Vote.score))
+db.register_counter(Tag.tagged, forum_tag.c.tag_id)
+db.register_counter(Tag.tagged, question_tag.c.tag_id)
@@ -31,7 +31,7 @@ def context_modifier(request, context):
     key = 'news/archive'
     data = cache.get(key)
     if data is None:
-        archive = Article.query.dates('pub_date', 'month')
+        archive = Article.query.dates('pub_date', 'month', limit=6)
         if len(archive) > 5:
             archive = archive[:5]
             short_archive = True
@@ -137,6 +137,7 @@ class Article(db.Model, TextRendererMixin):
     text = db.Column(db.Text)
     public = db.Column(db.Boolean, default=False, nullable=False)
     view_count = db.Column(db.Integer, default=0, nullable=False)
+    views = db.BufferedCounter('view_count')
     comment_count = db.Column(db.Integer, default=0, nullable=False)
     comments_enabled = db.Column(db.Boolean, default=True, nullable=False)
     guid = db.Column(db.Unicode(80), unique=True)
@@ -170,7 +171,7 @@ class Article(db.Model, TextRendererMixin):
                self.pub_date.replace(microsecond=0)
 
     def touch(self):
-        db.atomic_add(self, 'view_count', 1)
+        Article.views.add(self)
 
     def get_url_values(self, **kwargs):
         action = kwargs.pop('action', 'view')
@@ -190,3 +191,7 @@ class Article(db.Model, TextRendererMixin):
 
     def __unicode__(self):
         return self.title
+
+
+db.register_counter(Article.comment_count, Comment.article_id)
+db.register_counter(Tag.tagged, article_tag.c.tag_id)
@@ -10,13 +10,39 @@
 """
 from inyoka.core import exceptions as exc
 from inyoka.core.api import IController, Rule, view, Response, \
-    templated, db, redirect_to
+    templated, db, redirect_to, conditional
+from inyoka.core.auth.models import User
 from inyoka.core.forms.utils import model_to_dict, update_model
+from inyoka.i18n import get_locale
 from inyoka.utils.pagination import URLPagination
 from inyoka.paste.forms import AddPasteForm, EditPasteForm
 from inyoka.paste.models import PasteEntry
 
 
+def paste_version(self, request, id):
+    """The version of a rendered paste, it depends on the paste tree, the
+    names shown for the author and the parent, the language of the page
+    and the user for the navigation.  Only the columns shown are queried.
+    """
+    parent = db.aliased(PasteEntry)
+    child = db.aliased(PasteEntry)
+    has_children = db.exists([child.id], child.parent_id == PasteEntry.id)
+    row = db.session.query(PasteEntry.text, PasteEntry.language,
+            PasteEntry.title, PasteEntry.hidden, User.username,
+            PasteEntry.parent_id, parent.title, has_children) \
+        .join((User, PasteEntry.author_id == User.id)) \
+        .outerjoin((parent, PasteEntry.parent_id == parent.id)) \
+        .filter(PasteEntry.id == id).first()
+    if row is None:
+        return None
+    return tuple(row) + (unicode(get_locale()), request.user.id)
+
+
+def raw_paste_version(self, request, id):
+    return db.session.query(PasteEntry.text).filter(PasteEntry.id == id) \
+        .scalar()
+
+
 def context_modifier(request, context):
     context.update(
         active='paste'
@@ -68,7 +94,8 @@ class PasteController(IController):
         }
 
     @view('view')
-    @templated('paste/view.html', modifier=context_modifier)
+    @conditional(paste_version)
+    @templated('paste/view.html', modifier=context_modifier, stream=True)
     def view_paste(self, request, id):
         e = PasteEntry.query.get(id)
         return {
@@ -94,6 +121,7 @@ class PasteController(IController):
         }
 
     @view('raw')
+    @conditional(raw_paste_version)
     def raw_paste(self, request, id):
         e = PasteEntry.query.get(id)
         return Response(e.text, mimetype='text/plain')
@@ -101,7 +129,8 @@ class PasteController(IController):
     @view('browse')
     @templated('paste/browse.html', modifier=context_modifier)
     def browse_pastes(self, request, page):
-        query = PasteEntry.query
+        query = PasteEntry.query.project('id', 'title', 'hidden', 'pub_date',
+            'language', author=('username', '_status'))
         pagination = URLPagination(query, page=page)
         return {
             'pastes': pagination.query,
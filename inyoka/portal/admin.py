@@ -33,7 +33,7 @@ class PortalAdminController(IController):
         if new:
             tag, data = Tag(), {}
         else:
-            tag = Tag.query.filter_by(slug=slug).one()
+            tag = Tag.query.get_by(slug=slug)
             data = model_to_dict(tag, exclude=('slug'))
 
         form = EditTagForm(request.form, **data)
@@ -56,7 +56,7 @@ class PortalAdminController(IController):
     @view('tag_delete')
     def tags_delete(self, request, slug):
         message = _(u'Do you really want to delete this tag?')
-        tag = Tag.query.filter_by(slug=slug).one()
+        tag = Tag.query.get_by(slug=slug)
         if confirm_action(request, message, 'portal/tag_delete', slug=slug):
             db.session.delete(tag)
             db.session.commit()
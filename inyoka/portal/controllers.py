@@ -24,7 +24,8 @@ from inyoka.portal.api import ITaggableContentProvider
 from inyoka.portal.forms import ProfileForm, SearchForm, DeactivateProfileForm,\
     get_change_password_form
 from inyoka.utils.confirm import call_confirm, Expired
-from inyoka.utils.pagination import URLPagination, SearchPagination
+from inyoka.utils.pagination import URLPagination, SearchPagination, \
+     KeysetURLPagination, cached_count
 from inyoka.utils.sortable import Sortable
 from inyoka.utils.text import get_search_words
 
@@ -60,11 +61,10 @@ class PortalController(IController):
     @view
     @templated('portal/index.html', modifier=context_modifier)
     def index(self, request):
-        cloud, more = Tag.query.public().get_cloud()
         articles = Article.query.public().order_by(Article.updated.desc()).limit(5).all()
         return {
-            'tag_cloud': cloud,
-            'more_tags': more,
+            # called by the cached tag cloud fragment only
+            'get_tag_cloud': Tag.query.public().get_cloud,
             'articles': articles,
         }
 
@@ -73,7 +73,11 @@ class PortalController(IController):
     def users(self, request, page=1):
         query = User.query.options(db.joinedload('profile'))
         sortable = Sortable(query, 'id', request)
-        pagination = URLPagination(sortable.get_sorted(), page)
+        pagination = KeysetURLPagination(sortable.get_sorted(), page,
+                                         args={'order': sortable.order_by},
+                                         after=request.args.get('after'),
+                                         before=request.args.get('before'),
+                                         total=cached_count(query))
         return {
             'users': pagination.query,
             'pagination': pagination,
@@ -94,7 +98,7 @@ class PortalController(IController):
     @view
     @templated('portal/group.html', modifier=context_modifier)
     def group(self, request, name, page=1):
-        group = Group.query.filter_by(name=name).one()
+        group = Group.query.get_by(name=name)
         pagination = URLPagination(group.users, page)
         return {
             'group': group,
@@ -160,7 +164,7 @@ class PortalController(IController):
     @view
     @templated('portal/tag.html', modifier=context_modifier)
     def tag(self, request, slug):
-        tag = Tag.query.filter_by(slug=slug).one()
+        tag = Tag.query.get_by(slug=slug)
         providers = ctx.get_implementations(ITaggableContentProvider, instances=True)
         content = []
         for provider in providers:
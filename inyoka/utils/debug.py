@@ -15,6 +15,13 @@ from werkzeug import html
 
 
 _body_end_re = re.compile(r'</\s*(body|html)(?i)')
+_statement_literal_re = re.compile(r"""
+    '(?:[^']|'')*'                  |   # string literals
+    %\(\w+\)s | %s | (?<!:):\w+     |   # named and format placeholders
+    \b\d+(?:\.\d+)?\b                   # numbers
+""", re.X)
+_statement_in_list_re = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_whitespace_re = re.compile(r'\s+')
 
 
 def debug_repr(obj):
@@ -31,12 +38,15 @@ def debug_repr(obj):
     )
 
 
-def find_calling_context(skip=2, module='inyoka'):
-    """Finds the calling context."""
+def find_calling_context(skip=2, module='inyoka', exclude=()):
+    """Finds the calling context.  Frames of modules listed in `exclude`
+    are skipped.
+    """
     frame = sys._getframe(skip)
     while frame.f_back is not None:
         name = frame.f_globals.get('__name__')
-        if name and (name == module or name.startswith(module + '.')):
+        if name and (name == module or name.startswith(module + '.')) \
+           and name not in exclude:
             funcname = frame.f_code.co_name
             if 'self' in frame.f_locals:
                 funcname = '%s.%s of %s' % (
@@ -53,6 +63,66 @@ def find_calling_context(skip=2, module='inyoka'):
     return '<unknown>'
 
 
+def find_calling_template(skip=2):
+    """Finds the Jinja template that is currently rendered and return
+    its name and line number or `None`.
+    """
+    frame = sys._getframe(skip)
+    while frame is not None:
+        template = frame.f_globals.get('__jinja_template__')
+        if template is not None:
+            return '%s:%s' % (template.name,
+                              template.get_corresponding_lineno(frame.f_lineno))
+        frame = frame.f_back
+
+
+def normalize_statement(statement):
+    """Normalize the text of a SQL statement so that statements which only
+    differ in their parameters or the length of ``IN`` lists are equal.
+    """
+    statement = _statement_literal_re.sub('?', statement)
+    statement = _statement_in_list_re.sub('(?)', statement)
+    return _whitespace_re.sub(' ', statement).strip()
+
+
+class NPlusOneDetector(object):
+    """Detects "N+1" query patterns, that is the same statement (except for
+    parameters) executed over and over again, mostly once per item of some
+    list.
+
+    :param threshold: The number of executions of the same statement that
+                      is still fine.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        #: statement shape -> number of executions
+        self.counts = {}
+        #: statement shape -> (calling context, calling template)
+        self.offenders = {}
+
+    def add(self, statement):
+        """Count an executed `statement`."""
+        shape = normalize_statement(statement)
+        count = self.counts.get(shape, 0) + 1
+        self.counts[shape] = count
+        if count == self.threshold + 1:
+            self.offenders[shape] = (
+                find_calling_context(3, exclude=('inyoka.core.database',
+                                                 'inyoka.utils.debug')),
+                find_calling_template(3))
+
+    def report(self):
+        """Return a description of all detected patterns or an empty string
+        if there are none.
+        """
+        result = []
+        for shape, (context, template) in sorted(self.offenders.iteritems()):
+            result.append(u'%d times: %s\n  called from %s\n  in template %s'
+                          % (self.counts[shape], shape, context, template))
+        return u'\n'.join(result)
+
+
 def render_query_table(queries):
     """Renders a nice table of all queries in the page."""
     total = 0
@@ -18,7 +18,11 @@ def make_request_info_injector(request):
         record.extra.update(
             ip=request.remote_addr,
             method=request.method,
-            url=request.url)
+            url=request.url,
+            endpoint=request.endpoint,
+            db_statements=request.db_statements,
+            db_time=request.db_time,
+            db_rows=request.db_rows)
     return inject_request_info
 
 
@@ -27,14 +27,94 @@
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
+import json
+from hashlib import md5
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import date, datetime
 from werkzeug import Href, url_encode
 from markupsafe import Markup, escape
-from inyoka.core.api import ctx
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import _UnaryExpression
+from inyoka.core.api import ctx, db
+from inyoka.core.cache import cache
+from inyoka.core.config import IntegerConfigField
 from inyoka.core.exceptions import NotFound
 from inyoka.utils.decorators import abstract
 from inyoka.i18n import _
 
 
+#: The number of seconds a count of :func:`cached_count` is cached.
+count_cache_timeout = IntegerConfigField('pagination.count_cache_timeout',
+                                         default=60, min_value=0)
+
+_cursor_datetime_format = '%Y-%m-%dT%H:%M:%S.%f'
+_cursor_date_format = '%Y-%m-%d'
+
+
+def _expect(*types):
+    def check(value):
+        # booleans are integers as well
+        if not isinstance(value, types) or \
+           (isinstance(value, bool) and bool not in types):
+            raise TypeError('%r is no valid cursor value' % (value,))
+        return value
+    return check
+
+
+def _format_date(format, type):
+    check = _expect(type)
+    return lambda value: check(value).strftime(format)
+
+
+def _parse_date(format, convert=lambda value: value):
+    return lambda value: convert(datetime.strptime(_expect(basestring)(value),
+                                                   format))
+
+
+#: The column types that can be part of a cursor with the functions that
+#: convert their values to JSON and back.  Orderings by other columns are
+#: paginated with an ``OFFSET``.
+_cursor_types = (
+    (db.DateTime, _format_date(_cursor_datetime_format, datetime),
+                  _parse_date(_cursor_datetime_format)),
+    (db.Date, _format_date(_cursor_date_format, date),
+              _parse_date(_cursor_date_format, datetime.date)),
+    (db.Integer, _expect(int, long), _expect(int, long)),
+    (db.String, _expect(basestring), _expect(basestring)),
+    (db.Boolean, _expect(bool), _expect(bool)),
+)
+
+
+def _get_cursor_type(column):
+    """Return the functions that convert the values of `column` to JSON
+    and back or `None` if the column cannot be part of a cursor.
+    """
+    for type, encode, decode in _cursor_types:
+        if isinstance(column.type, type):
+            return encode, decode
+
+
+def cached_count(query, timeout=None):
+    """Return the number of rows of `query` and cache it for `timeout`
+    seconds (``pagination.count_cache_timeout`` by default).
+
+    Pass the result as `total` to a pagination if the exact number of
+    entries is expensive to calculate and may be a bit out of date.
+    """
+    statement = query.statement.compile()
+    key = md5(u'%s%r' % (statement, sorted(statement.params.items()))
+              .encode('utf-8')).hexdigest()
+    key = 'pagination/count/%s' % key
+    total = cache.get(key)
+    if total is None:
+        total = query.count()
+        if timeout is None:
+            timeout = ctx.cfg['pagination.count_cache_timeout']
+        cache.set(key, total, timeout=timeout)
+    return total
+
+
 class Pagination(object):
     """
     :param query: A SQLAlchemy query object.
@@ -44,6 +124,9 @@ class Pagination(object):
     :param args: URL parameters, that, if given, are included in the generated
                  urls.
     :param per_page: Number of entries displayed on one page.
+    :param total: The number of entries if it is already known, for example
+                  from a denormalized counter or :func:`cached_count`.
+                  Otherwise the query is counted.
 
     After initialisation, ``pagination.query`` is a list of the matching
     objects.  Call the pagination object for html code of links to the other
@@ -62,7 +145,8 @@ class Pagination(object):
     right_threshold = 1
     per_page = 15
 
-    def __init__(self, query, page=None, link=None, args=None, per_page=None):
+    def __init__(self, query, page=None, link=None, args=None, per_page=None,
+                 total=None):
         self.base_query = query
         self.page = 1 if page is None else page
         if link is not None and not isinstance(link, basestring):
@@ -72,17 +156,19 @@ class Pagination(object):
         if per_page is not None:
             self.per_page = per_page
 
-        #TODO: implement position_col
-        self.total = self.base_query.count()
+        self.total = self.base_query.count() if total is None else total
 
         self.pages = (max(0, self.total - 1) // self.per_page) + 1
 
         if self.page > self.pages or self.page < 1:
             raise NotFound()
 
+        self.query = self.get_objects()
+
+    def get_objects(self):
+        """Return the list of objects displayed on the current page."""
         offset = (self.page - 1) * self.per_page
-        #TODO: implement position_col
-        self.query = query[offset:offset + self.per_page]
+        return self.base_query[offset:offset + self.per_page]
 
     @abstract
     def make_link(self, page):
@@ -92,6 +178,10 @@ class Pagination(object):
         Subclasses must implement this.
         """
 
+    def get_link_args(self, page):
+        """Return the URL parameters of the link to `page`."""
+        return self.args
+
     def make_template(self):
         """
         Return a template for creating links. Usually used internally only.
@@ -107,6 +197,8 @@ class Pagination(object):
                     right_threshold=None, prev=True, next=True):
         """
         Return the buttons as tuples.
+        Only the visible page numbers are calculated, so this is as cheap
+        for the last of thousands of pages as it is for the first one.
         First item is page number or one of prev, next, ellipsis.
         Second item is link or None if it's the current page or
                (for prev/next) if it's the first or last page
@@ -119,27 +211,14 @@ class Pagination(object):
         if right_threshold is None:
             right_threshold = self.right_threshold
 
-        def include(num, avoidsingle=True):
-            if num < 1 or num > self.pages:
-                return False
-
-            if num < (left_threshold + 1):
-                return True
-            if num < self.page and num >= (self.page - inner_threshold):
-                return True
-            if num == self.page:
-                return True
-            if num > self.page and num <= (self.page + inner_threshold):
-                return True
-            if num > (self.pages - right_threshold):
-                return True
-
-            # avoid 4 ... 6
-            if avoidsingle:
-                if include(num + 1, False) and include(num - 1, False):
-                    return True
-
-            return False
+        pages = set(xrange(1, min(left_threshold, self.pages) + 1))
+        pages.update(xrange(max(1, self.page - inner_threshold),
+                            min(self.pages, self.page + inner_threshold) + 1))
+        pages.update(xrange(max(1, self.pages - right_threshold + 1),
+                            self.pages + 1))
+        # avoid 4 ... 6
+        pages.update([num + 1 for num in pages
+                      if num + 2 in pages and num + 1 not in pages])
 
         if prev:
             if self.page == 1:
@@ -147,18 +226,17 @@ class Pagination(object):
             else:
                 yield 'prev', self.make_link(self.page - 1)
 
-        was_ellipsis = False
-        for num in xrange(1, self.pages + 1):
-            if include(num):
-                if num == self.page:
-                    yield num, None
-                else:
-                    yield num, self.make_link(num)
-                was_ellipsis = False
+        last = 0
+        for num in sorted(pages):
+            if num > last + 1:
+                yield 'ellipsis', self.make_template()
+            if num == self.page:
+                yield num, None
             else:
-                if not was_ellipsis:
-                    yield 'ellipsis', self.make_template()
-                was_ellipsis = True
+                yield num, self.make_link(num)
+            last = num
+        if last < self.pages:
+            yield 'ellipsis', self.make_template()
 
         if next:
             if self.page == self.pages:
@@ -241,6 +319,136 @@ class Pagination(object):
         return self.buttons(*args, **kwargs)
 
 
+def _get_ordering(query):
+    """Return the ordering of `query` as list of ``(column, key, descending)``
+    tuples, with the missing primary key columns appended so that every row
+    has a unique position.  `None` is returned if the ordering cannot be
+    expressed by mapped columns, e.g. if it is a plain SQL string, or if a
+    column has a type that is not supported by cursors.
+    """
+    mapper = query._mapper_zero()
+    order = []
+    for clause in query._order_by or mapper.order_by or ():
+        descending = False
+        if isinstance(clause, _UnaryExpression):
+            if clause.modifier not in (operators.asc_op, operators.desc_op):
+                return None
+            descending = clause.modifier is operators.desc_op
+            clause = clause.element
+        try:
+            prop = mapper.get_property_by_column(clause)
+        except (UnmappedColumnError, AttributeError):
+            return None
+        order.append((clause, prop.key, descending))
+
+    keys = set(key for column, key, descending in order)
+    descending = order[-1][2] if order else False
+    for column in mapper.primary_key:
+        key = mapper.get_property_by_column(column).key
+        if key not in keys:
+            order.append((column, key, descending))
+    for column, key, descending in order:
+        if _get_cursor_type(column) is None:
+            return None
+    return order
+
+
+class KeysetPagination(Pagination):
+    """
+    A pagination that uses the last row of a page as cursor for the next
+    page (and the first row for the previous page) instead of an ``OFFSET``.
+    The database can then seek to the first row of a page using the index
+    of the sort columns, so deep pages are as fast as the first one.
+
+    The sort columns are taken from the ``ORDER BY`` of the query, e.g. the
+    one applied by :meth:`Sortable.get_sorted` or
+    :attr:`QuestionQuery.latest`.  The primary key is appended as
+    tie-breaker.
+
+    The links to the previous and the next page carry the cursor as `before`
+    or `after` URL parameter, pass them as `before` and `after`::
+
+        pagination = KeysetURLPagination(query, page,
+                                         after=request.args.get('after'),
+                                         before=request.args.get('before'),
+                                         total=cached_count(query))
+
+    Other pages are still selected with an ``OFFSET``.
+    """
+
+    def __init__(self, query, page=None, link=None, args=None, per_page=None,
+                 total=None, after=None, before=None):
+        self.order = _get_ordering(query)
+        if self.order is not None:
+            query = self._apply_ordering(query)
+        self.cursor = before or after
+        self.reverse = bool(before)
+        if args is not None:
+            args = dict(args)
+            args.pop('after', None)
+            args.pop('before', None)
+        Pagination.__init__(self, query, page, link, args, per_page, total)
+
+    def get_objects(self):
+        if self.cursor is None or self.order is None:
+            return Pagination.get_objects(self)
+
+        values = self.decode_cursor(self.cursor)
+        query = self.base_query.filter(db.keyset_criterion(
+            [column for column, key, descending in self.order], values,
+            descending=[descending != self.reverse
+                        for column, key, descending in self.order]))
+        objects = self._apply_ordering(query, self.reverse) \
+                      .limit(self.per_page).all()
+        if self.reverse:
+            objects.reverse()
+        return objects
+
+    def _apply_ordering(self, query, reverse=False):
+        return query.order_by(None).order_by(*[
+            (db.asc, db.desc)[descending != reverse](column)
+            for column, key, descending in self.order])
+
+    def get_link_args(self, page):
+        if self.order is None or not self.query:
+            return self.args
+        args = dict(self.args)
+        if page == self.page + 1:
+            args['after'] = self.encode_cursor(self.query[-1])
+        elif page == self.page - 1 and page > 1:
+            args['before'] = self.encode_cursor(self.query[0])
+        return args
+
+    def encode_cursor(self, obj):
+        """Return the cursor that points to `obj`.  Raises :exc:`TypeError`
+        if a value does not match the type of its column.
+        """
+        values = []
+        for column, key, descending in self.order:
+            value = getattr(obj, key)
+            if value is not None:
+                value = _get_cursor_type(column)[0](value)
+            values.append(value)
+        return urlsafe_b64encode(json.dumps(values)).rstrip('=')
+
+    def decode_cursor(self, cursor):
+        """Return the column values of `cursor`.  Raises :exc:`NotFound` if
+        the cursor is invalid.
+        """
+        try:
+            cursor = str(cursor)
+            values = json.loads(urlsafe_b64decode(
+                cursor + '=' * (-len(cursor) % 4)))
+            if len(values) != len(self.order):
+                raise ValueError('cursor does not match the ordering')
+            for idx, (column, key, descending) in enumerate(self.order):
+                if values[idx] is not None:
+                    values[idx] = _get_cursor_type(column)[1](values[idx])
+        except (TypeError, ValueError):
+            raise NotFound()
+        return values
+
+
 class URLPagination(Pagination):
     """
     A Pagination that appends the page number to the URL.
@@ -255,9 +463,10 @@ class URLPagination(Pagination):
         else:
             href = Href(self.link)
 
+        args = self.get_link_args(page)
         if page == 1:
-            return href(**self.args)
-        return href(u'%d/' % page, **self.args)
+            return href(**args)
+        return href(u'%d/' % page, **args)
 
     def make_template(self):
         if self.link is None:
@@ -285,9 +494,10 @@ class PageURLPagination(Pagination):
         else:
             href = Href(self.link)
 
+        args = self.get_link_args(page)
         if page == 1:
-            return href(**self.args)
-        return href(u'page/%d/' % page, **self.args)
+            return href(**args)
+        return href(u'page/%d/' % page, **args)
 
     def make_template(self):
         if self.link is None:
@@ -315,7 +525,7 @@ class GETPagination(Pagination):
         return u'%s?%s&page=!' % (base, url_encode(args))
 
     def make_link(self, page):
-        args = self.args.copy()
+        args = dict(self.get_link_args(page))
         args['page'] = page
         if page == 1:
             args.pop('page', None)
@@ -340,3 +550,11 @@ class SearchPagination(GETPagination):
 
         offset = (self.page - 1) * self.per_page
         self.query = query[offset:offset + self.per_page]
+
+
+class KeysetURLPagination(KeysetPagination, URLPagination):
+    """A :class:`KeysetPagination` with the links of :class:`URLPagination`."""
+
+
+class KeysetGETPagination(KeysetPagination, GETPagination):
+    """A :class:`KeysetPagination` with the links of :class:`GETPagination`."""
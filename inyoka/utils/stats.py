@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+    inyoka.utils.stats
+    ~~~~~~~~~~~~~~~~~~
+
+    Lightweight in-process statistics.  The collected values live in the
+    memory of the worker process and are meant to be cheap enough to be
+    always enabled in production.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+from bisect import bisect_left
+from threading import Lock
+from itertools import count
+
+
+class Aggregate(object):
+    """Thread-safe per-key sums of numeric values.
+
+    Example usage::
+
+        >>> stats = Aggregate(('statements', 'time'))
+        >>> stats.add('portal/index', statements=3, time=0.5)
+        >>> stats.add('portal/index', statements=5, time=0.25)
+        >>> sorted(stats.snapshot()['portal/index'].items())
+        [('samples', 2), ('statements', 8), ('time', 0.75)]
+
+    :param fields: The names of the values summed up per key.
+    :param sample_rate: Only every n-th call of :meth:`sample` is recorded.
+                        ``0`` disables sampling completely.
+    """
+
+    def __init__(self, fields, sample_rate=1):
+        self.fields = tuple(fields)
+        self.sample_rate = sample_rate
+        self._counter = count()
+        self._values = {}
+        self._lock = Lock()
+
+    def add(self, key, **values):
+        """Add the `values` to the sums of `key`."""
+        with self._lock:
+            sums = self._values.get(key)
+            if sums is None:
+                sums = self._values[key] = dict.fromkeys(self.fields, 0)
+                sums['samples'] = 0
+            sums['samples'] += 1
+            for field in self.fields:
+                sums[field] += values.get(field, 0)
+
+    def sample(self, key, **values):
+        """Like :meth:`add` but only records every n-th call.  Returns `True`
+        if the values were recorded.
+        """
+        if not self.sample_rate or self._counter.next() % self.sample_rate:
+            return False
+        self.add(key, **values)
+        return True
+
+    def snapshot(self):
+        """Return a copy of all sums per key."""
+        with self._lock:
+            return {key: dict(sums) for key, sums in self._values.iteritems()}
+
+    def clear(self):
+        """Forget all recorded values."""
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(object):
+    """Thread-safe counts of values falling into fixed buckets.
+
+    Example usage::
+
+        >>> waits = Histogram((0.01, 0.1, 1))
+        >>> for value in (0.005, 0.05, 0.5, 5):
+        ...     waits.add(value)
+        >>> waits.snapshot()
+        [(0.01, 1), (0.1, 1), (1, 1), (None, 1)]
+
+    :param bounds: The sorted upper bounds of the buckets.  Values above the
+                   last bound are counted in an additional bucket whose bound
+                   is `None`.
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self._counts = [0] * (len(self.bounds) + 1)
+        self._lock = Lock()
+
+    def add(self, value):
+        """Count `value` in the first bucket whose bound is not below it."""
+        idx = bisect_left(self.bounds, value)
+        with self._lock:
+            self._counts[idx] += 1
+
+    def snapshot(self):
+        """Return a list of ``(bound, count)`` tuples."""
+        with self._lock:
+            return zip(self.bounds + (None,), self._counts)
+
+    def clear(self):
+        """Reset all counts."""
+        with self._lock:
+            self._counts = [0] * (len(self.bounds) + 1)
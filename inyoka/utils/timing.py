@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+    inyoka.utils.timing
+    ~~~~~~~~~~~~~~~~~~~
+
+    Measures the time a request spends in its phases, like URL matching,
+    the middlewares, the view, template rendering, the database and the
+    cache.  The timings of a request are collected in `request.timings`,
+    sent in a ``Server-Timing`` header if enabled and recorded into
+    per-endpoint statistics.
+
+    Phases may overlap, template rendering for example is also part of
+    the view.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+from time import time
+from functools import wraps
+from threading import Lock
+from contextlib import contextmanager
+from inyoka.context import ctx
+from inyoka.core.config import BooleanConfigField
+from inyoka.utils.stats import Aggregate, Histogram
+
+
+#: Send the timings of the request phases in a ``Server-Timing`` header
+timing_server_timing_header = BooleanConfigField('timing.server_timing_header',
+                                                 default=False)
+
+#: The upper bounds in seconds of the latency histogram buckets
+LATENCY_BOUNDS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+#: The phases summed up per endpoint, the middleware phases are summed up
+#: as ``middleware``.
+PHASES = ('routing', 'middleware', 'view', 'template', 'db', 'cache', 'total')
+
+#: Per-endpoint sums of the request phases
+phase_stats = Aggregate(PHASES)
+
+#: Per-endpoint histograms of the request latency
+latency_histograms = {}
+_histograms_lock = Lock()
+
+
+def add_timing(phase, seconds, request=None):
+    """Add `seconds` to the time spent in `phase` by `request` or the
+    current request.  Does nothing outside of requests.
+    """
+    if request is None:
+        request = ctx.current_request
+    timings = getattr(request, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed(phase, request=None):
+    """Measure the time spent in the `with` block as `phase`."""
+    start = time()
+    try:
+        yield
+    finally:
+        add_timing(phase, time() - start, request)
+
+
+def timed_function(phase, func):
+    """Return a wrapper of `func` measuring its calls as `phase`."""
+    @wraps(func)
+    def timed_wrapper(*args, **kwargs):
+        start = time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_timing(phase, time() - start)
+    return timed_wrapper
+
+
+def format_server_timing(timings):
+    """Return the value of a ``Server-Timing`` header for `timings`."""
+    return ', '.join('%s;dur=%.1f' % (phase, seconds * 1000)
+                     for phase, seconds in sorted(timings.iteritems()))
+
+
+def record_timings(request):
+    """Record the timings of `request` into :data:`phase_stats` and
+    :data:`latency_histograms`.
+    """
+    timings = request.timings
+    values = dict((phase, timings[phase]) for phase in PHASES
+                  if phase in timings)
+    values['middleware'] = sum(seconds for phase, seconds in
+                               timings.iteritems() if phase.startswith('mw.'))
+    endpoint = request.endpoint
+    phase_stats.add(endpoint, **values)
+    histogram = latency_histograms.get(endpoint)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = latency_histograms.setdefault(endpoint,
+                                                      Histogram(LATENCY_BOUNDS))
+    histogram.add(timings.get('total', 0.0))
+
+
+def get_request_stats():
+    """Return the phase sums and the latency histogram per endpoint."""
+    phases = phase_stats.snapshot()
+    return dict((endpoint, {'phases': phases.get(endpoint, {}),
+                            'latency': histogram.snapshot()})
+                for endpoint, histogram in latency_histograms.items())
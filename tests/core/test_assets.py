@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+    test_assets
+    ~~~~~~~~~~~
+
+    Tests for the fingerprinted static assets.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+import os
+import json
+import shutil
+import tempfile
+from werkzeug import Headers, create_environ, run_wsgi_app, http_date
+from inyoka.core.test import *
+from inyoka.core import assets
+from inyoka.core.routing import href
+from inyoka.core.middlewares.static import StaticMiddleware, STATIC_PATH
+
+
+_static_path = None
+
+
+def _setup_static():
+    global _static_path
+    _static_path = tempfile.mkdtemp()
+    ctx.get_instance(StaticMiddleware).set_exports({u'/': _static_path})
+
+
+def _teardown_static():
+    global _static_path
+    ctx.get_instance(StaticMiddleware).set_exports(StaticMiddleware.exports)
+    shutil.rmtree(_static_path)
+    _static_path = None
+
+
+def test_build_assets():
+    static_path = tempfile.mkdtemp()
+    try:
+        for directory in assets.ASSET_DIRECTORIES:
+            shutil.copytree(os.path.join(STATIC_PATH, directory),
+                            os.path.join(static_path, directory))
+        manifest = assets.build_assets(static_path)
+        with open(os.path.join(static_path, assets.MANIFEST_FILE)) as fobj:
+            eq_(json.load(fobj), manifest)
+
+        files = manifest['assets']
+        core = files['js/jquery.js']
+        eq_(files['js/inyoka.js'], core)
+        assert_true(core.startswith('js/core.bundle.'))
+        assert_true(assets.get_fingerprint(core))
+        with open(os.path.join(static_path, core)) as fobj:
+            data = fobj.read()
+        with open(os.path.join(STATIC_PATH, 'js/inyoka.js')) as fobj:
+            assert_true(data.endswith(fobj.read()))
+        assert_true(files['style/forum.css'].startswith('style/forum.'))
+
+        # rebuilding does not fingerprint the fingerprinted files
+        eq_(assets.build_assets(static_path), manifest)
+    finally:
+        shutil.rmtree(static_path)
+
+
+def test_asset_urls():
+    assets._manifest = {'js/jquery.js': 'js/core.bundle.0123456789ab.js',
+                        'js/inyoka.js': 'js/core.bundle.0123456789ab.js'}
+    try:
+        eq_(assets.asset_urls(['jquery.js', 'inyoka.js', 'portal.js'], 'js'),
+            [href('static', file='js/core.bundle.0123456789ab.js'),
+             href('static', file='js/portal.js')])
+        eq_(assets.asset_urls(['inyoka.js', 'portal.js'], 'js',
+                              exclude=['jquery.js']),
+            [href('static', file='js/portal.js')])
+        eq_(assets.asset_url('js/jquery.js'),
+            href('static', file='js/core.bundle.0123456789ab.js'))
+    finally:
+        assets.reset_manifest()
+
+
+@with_setup(_setup_static, _teardown_static)
+def test_serve_fingerprinted():
+    filename = os.path.join(_static_path, 'test.0123456789ab.css')
+    with open(filename, 'w') as fobj:
+        fobj.write('body { color: red; }')
+    middleware = ctx.get_instance(StaticMiddleware)
+
+    def get(path, headers=()):
+        app_iter, status, headers = run_wsgi_app(middleware,
+            create_environ(path, headers=list(headers)))
+        return ''.join(app_iter), status, Headers(headers)
+
+    data, status, headers = get('/test.0123456789ab.css')
+    eq_(status, '200 OK')
+    assert_true('immutable' in headers['Cache-Control'])
+    eq_(headers['Etag'], '"0123456789ab"')
+    eq_(data, 'body { color: red; }')
+
+    eq_(get('/test.0123456789ab.css',
+            [('If-None-Match', '"0123456789ab"')])[1], '304 Not Modified')
+    # only the fingerprint validates the cached file
+    eq_(get('/test.0123456789ab.css',
+            [('If-None-Match', '"ba9876543210"')])[1], '200 OK')
+    eq_(get('/test.0123456789ab.css',
+            [('If-Modified-Since', http_date())])[1], '200 OK')
+
+    ctx.cfg['static.sendfile_header'] = u'X-Sendfile'
+    try:
+        data, status, headers = get('/test.0123456789ab.css')
+        eq_(headers['X-Sendfile'], filename)
+        eq_(data, '')
+    finally:
+        ctx.cfg['static.sendfile_header'] = u''
+
+
+@with_setup(_setup_static, _teardown_static)
+def test_fingerprinted_outside_static_path():
+    outside = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(outside, 'secret.0123456789ab.css')
+        with open(filename, 'w') as fobj:
+            fobj.write('secret')
+        middleware = ctx.get_instance(StaticMiddleware)
+        relative = os.path.relpath(filename, _static_path)
+        for path in ('/' + filename, '//' + filename, '/' + relative):
+            eq_(middleware.get_filename(path), None)
+            app_iter, status, headers = run_wsgi_app(middleware,
+                                                     create_environ(path))
+            assert_false('secret' in ''.join(app_iter))
+    finally:
+        shutil.rmtree(outside)
@@ -11,7 +11,9 @@
 import time
 import random
 from inyoka.core.test import *
-from inyoka.core.cache import cache, memoize, cached, set_cache, clear_memoized
+from inyoka.core.cache import cache, memoize, cached, set_cache, \
+     clear_memoized, cached_fragment, invalidate_fragments
+from inyoka.core.templating import render_string
 
 
 class TestCacheFramework(ViewTestCase):
@@ -129,6 +131,31 @@ class TestCacheFramework(ViewTestCase):
             self.assertNotEqual(big_foo(5, 2), result)
             self.assertEqual(another_foo(5, 2), another_result)
 
+    def test_cached_fragment(self):
+        calls = []
+        def render():
+            calls.append(1)
+            return u'fragment %d' % len(calls)
+
+        self.assertEqual(cached_fragment('frag', render, 1), u'fragment 1')
+        self.assertEqual(cached_fragment('frag', render, 1), u'fragment 1')
+        time.sleep(1.1)
+        # the first request after the expiry renders the fragment again
+        self.assertEqual(cached_fragment('frag', render, 1), u'fragment 2')
+
+        self.assertEqual(cached_fragment('frag', render, 5, ['t']),
+                         u'fragment 3')
+        self.assertEqual(cached_fragment('frag', render, 5, ['t']),
+                         u'fragment 3')
+        invalidate_fragments('t')
+        self.assertEqual(cached_fragment('frag', render, 5, ['t']),
+                         u'fragment 4')
+
+    def test_cache_tag(self):
+        source = u"{% cache 'frag', 5 %}{{ value }}{% endcache %}"
+        self.assertEqual(render_string(source, {'value': u'<a>'}), u'&lt;a&gt;')
+        self.assertEqual(render_string(source, {'value': u'b'}), u'&lt;a&gt;')
+
 
 class TestDatabaseCache(ViewTestCase):
 
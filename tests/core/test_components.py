@@ -8,7 +8,14 @@
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
-from inyoka import Interface, InterfaceMeta, _is_interface, _import_module
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+from inyoka import Interface, InterfaceMeta, _is_interface, _import_module, \
+    get_hg_revision
 from inyoka.core.api import ctx
 from inyoka.core.test import with_setup, eq_, assert_false, assert_true, \
     raises
@@ -103,6 +110,50 @@ def test_components():
     assert_false(hasattr(obj, '_interfaces'))
 
 
+@with_setup(teardown=_teardown_components)
+def test_manifest():
+    ctx.load_components([Implementation1, Implementation2, Implementation3])
+    manifest = ctx.dump_manifest()
+    assert_true('inyoka.core.api' in manifest['modules'])
+    eq_(manifest['components']['tests.core.test_components.Interface1'],
+        ['tests.core.test_components.Implementation1',
+         'tests.core.test_components.Implementation2'])
+    ctx.unload_components(_test_components)
+
+    ctx.load_manifest(manifest,
+                      ['tests.core.test_components.Implementation1'])
+    assert_false(Interface1 in ctx._components)
+    eq_(ctx.get_implementations(Interface1), set([Implementation2]))
+    eq_(ctx.get_implementations(Interface3), set([Implementation3]))
+
+
+def test_manifest_registers_counters():
+    # start a new process from a manifest like a celery worker does
+    path = tempfile.mkdtemp()
+    try:
+        module_path = os.path.join(path, 'inyoka')
+        os.mkdir(module_path)
+        with open(os.path.join(module_path, 'components.json'), 'w') as fobj:
+            json.dump(ctx.dump_manifest(), fobj)
+        env = dict(os.environ, INYOKA_MODULE=module_path,
+                   INYOKA_CONFIG=ctx.cfg.filename,
+                   PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.Popen([sys.executable, '-c',
+            'import inyoka\n'
+            'from inyoka.core.database import BufferedCounter, '
+            'DenormalizedCounter\n'
+            'print len(BufferedCounter.registry), '
+            'len(DenormalizedCounter.registry)'],
+            env=env, stdout=subprocess.PIPE).communicate()[0]
+        from inyoka.core.database import BufferedCounter, DenormalizedCounter
+        eq_(output.split()[-2:], [str(len(BufferedCounter.registry)),
+                                  str(len(DenormalizedCounter.registry))])
+        assert_true(BufferedCounter.registry)
+        assert_true(DenormalizedCounter.registry)
+    finally:
+        shutil.rmtree(path)
+
+
 @raises(RuntimeError)
 def test_double_interfaces_runtimeerror():
     class SomeInterface(Interface):
@@ -130,3 +181,11 @@ def test_import_module():
     # we assert here to import the module rather than to raise a ValueError
     # as werkzeug's find_modules would do.
     list(_import_module('werkzeug._internal.*'))
+
+
+def test_hg_revision_without_repository():
+    path = tempfile.mkdtemp()
+    try:
+        eq_(get_hg_revision(path), None)
+    finally:
+        shutil.rmtree(path)
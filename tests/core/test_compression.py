@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+    test_compression
+    ~~~~~~~~~~~~~~~~
+
+    Tests for the gzip compression of responses and static files.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+import os
+import gzip
+import zlib
+import shutil
+import tempfile
+from werkzeug import Client, BaseResponse, Headers, create_environ, \
+     run_wsgi_app
+from inyoka.core.test import *
+from inyoka.core.middlewares.compression import iter_compressed
+from inyoka.core.middlewares.static import StaticMiddleware
+
+
+_static_path = None
+
+
+def _setup_static():
+    global _static_path
+    _static_path = tempfile.mkdtemp()
+    ctx.get_instance(StaticMiddleware).set_exports({u'/': _static_path})
+
+
+def _teardown_static():
+    global _static_path
+    ctx.get_instance(StaticMiddleware).set_exports(StaticMiddleware.exports)
+    shutil.rmtree(_static_path)
+    _static_path = None
+
+
+def _decompress(data):
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def test_iter_compressed():
+    chunks = list(iter_compressed(iter(['foo', 'bar' * 100])))
+    assert_true(len(chunks) > 1)
+    eq_(_decompress(''.join(chunks)), 'foo' + 'bar' * 100)
+
+
+def test_compressed_response():
+    client = Client(ctx.dispatcher, BaseResponse)
+    base_url = 'http://%s/' % ctx.cfg['base_domain_name']
+    plain = client.get('/', base_url=base_url)
+    eq_(plain.headers.get('Content-Encoding'), None)
+    assert_true('Accept-Encoding' in plain.headers['Vary'])
+    compressed = client.get('/', base_url=base_url,
+                            headers=[('Accept-Encoding', 'gzip, deflate')])
+    eq_(compressed.headers['Content-Encoding'], 'gzip')
+    eq_(int(compressed.headers['Content-Length']), len(compressed.data))
+    assert_true('<html>' in _decompress(compressed.data))
+
+
+@with_setup(_setup_static, _teardown_static)
+def test_precompressed_static_file():
+    filename = os.path.join(_static_path, 'test.css')
+    with open(filename, 'w') as fobj:
+        fobj.write('body { color: red; }')
+    middleware = ctx.get_instance(StaticMiddleware)
+    eq_(middleware.find_precompressed('/test.css'), None)
+    compressed = gzip.GzipFile(filename + '.gz', 'wb')
+    compressed.write('body { color: red; }')
+    compressed.close()
+    eq_(middleware.find_precompressed('/test.css'), '/test.css.gz')
+
+    environ = create_environ('/test.css', headers=[
+        ('Accept-Encoding', 'gzip')])
+    app_iter, status, headers = run_wsgi_app(middleware, environ)
+    headers = Headers(headers)
+    eq_(headers['Content-Type'], 'text/css')
+    eq_(headers['Content-Encoding'], 'gzip')
+    eq_(_decompress(''.join(app_iter)), 'body { color: red; }')
+
+    environ = create_environ('/test.css')
+    app_iter, status, headers = run_wsgi_app(middleware, environ)
+    headers = Headers(headers)
+    eq_(headers.get('Content-Encoding'), None)
+    eq_(headers['Vary'], 'Accept-Encoding')
+    eq_(''.join(app_iter), 'body { color: red; }')
@@ -134,3 +134,18 @@ def test_automatical_config_creation():
     new_ctx = ApplicationContext()
     assert_true(os.path.exists(fn))
     open(fn, 'w').write(content)
+
+
+@with_setup(_setup_config_test, _teardown_config_test)
+def test_reload_if_changed():
+    reloads = []
+    _config.reload = lambda: reloads.append(True)
+    _config._load_time = os.path.getmtime(_config_file_name)
+    assert_false(_config.reload_if_changed(3600))
+    # the file is not asked again within the interval
+    os.utime(_config_file_name, (_config._load_time + 10,) * 2)
+    assert_false(_config.reload_if_changed(3600))
+    eq_(reloads, [])
+    _config._next_check = 0
+    assert_true(_config.reload_if_changed(3600))
+    eq_(reloads, [True])
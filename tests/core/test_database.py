@@ -8,10 +8,16 @@
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
+import os
+import re
 from time import sleep
-from functools import partial
+from datetime import datetime
+from functools import partial, wraps
+from tempfile import mkstemp
 from inyoka.core.test import *
 from inyoka.core.test.mock import mock, TraceTracker
+from inyoka.core import database as db_module
+from inyoka.core.database import InyokaSession
 
 
 class DatabaseTestCategory(db.Model):
@@ -22,6 +28,13 @@ class DatabaseTestCategory(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     slug = db.Column(db.String(100), unique=True, nullable=False)
 
+    @property
+    def display_slug(self):
+        return u'/%s/' % self.slug
+
+    def __unicode__(self):
+        return self.display_slug
+
 
 class SlugGeneratorTestModel(db.Model):
     __tablename__ = '_test_database_slug_generator'
@@ -38,6 +51,25 @@ class SlugGeneratorTestModel(db.Model):
     count = db.Column(db.Integer, default=0)
 
 
+class DatabaseTestComment(db.Model):
+    __tablename__ = '_test_database_comment'
+
+    manager = TestResourceManager
+
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.Integer, db.ForeignKey(SlugGeneratorTestModel.id))
+
+
+class DatabaseTestReference(db.Model):
+    __tablename__ = '_test_database_reference'
+
+    manager = TestResourceManager
+    reference = db.ReferenceData('slug', fragments=['_test_reference'])
+
+    id = db.Column(db.Integer, primary_key=True)
+    slug = db.Column(db.String(50), unique=True)
+
+
 class GuidGeneratorTestModel1(db.Model):
     __tablename__ = '_test_database_guid_generator1'
     __mapper_args__ = {'extension': db.GuidGenerator('_test1')}
@@ -67,6 +99,7 @@ class DatabaseTestEntry(db.Model):
     entry_id = db.Column(db.Integer, primary_key=True)
     discriminator = db.Column('type', db.String(12))
     view_count = db.Column(db.Integer, default=0, nullable=False)
+    views = db.BufferedCounter('view_count')
 
     __mapper_args__ = {'polymorphic_on': discriminator}
 
@@ -83,6 +116,18 @@ class DatabaseTestQuestion(DatabaseTestEntry):
     title = db.Column(db.String(160), nullable=False)
     answer_count = db.Column(db.Integer, default=0)
 
+    def get_url_values(self, action='view'):
+        return 'forum/question', {'slug': self.title, 'action': action}
+
+
+class DatabaseTestEvent(db.Model):
+    __tablename__ = '_test_database_event'
+
+    manager = TestResourceManager
+
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.DateTime, nullable=False)
+
 
 def test_find_next_increment():
     eq_(db.find_next_increment(DatabaseTestCategory.slug, u'cat'), u'cat')
@@ -97,6 +142,36 @@ def test_find_next_increment():
 
     eq_(db.find_next_increment(DatabaseTestCategory.slug, u'cat'), u'cat3')
 
+    # the suffix counter is not fooled by similar values
+    c3 = DatabaseTestCategory(slug=u'category')
+    c4 = DatabaseTestCategory(slug=u'cat3')
+    db.session.commit()
+    eq_(db.find_next_increment(DatabaseTestCategory.slug, u'cat'), u'cat4')
+
+
+def test_find_next_increment_concurrent_counter():
+    from sqlalchemy.sql.expression import Insert
+    from inyoka.core.models import SlugCounter
+    counters = SlugCounter.__table__
+    connection = db.session.connection()
+
+    class RacingConnection(object):
+        """Initializes the counter right before `find_next_increment`."""
+        def __getattr__(self, name):
+            return getattr(connection, name)
+
+        def execute(self, stmt, *args, **kwargs):
+            if isinstance(stmt, Insert) and stmt.table is counters:
+                connection.execute(counters.insert().values(
+                    name=u'_test_database_category.slug', prefix=u'dog',
+                    value=5))
+            return connection.execute(stmt, *args, **kwargs)
+
+    DatabaseTestCategory(slug=u'dog')
+    db.session.flush()
+    eq_(db.find_next_increment(DatabaseTestCategory.slug, u'dog',
+                               connection=RacingConnection()), u'dog6')
+
 
 def test_slug_generator():
     c1 = SlugGeneratorTestModel(name=u'cat')
@@ -120,12 +195,22 @@ def test_slug_generator():
     eq_(c5.slug, u'this-is-just-a-test-category-with-awesome-feat2')
 
 def test_guid_generator():
-    c1 = GuidGeneratorTestModel1()
-    db.session.commit()
-    eq_(c1.guid, u'tag:inyoka.local,1970:inyoka/_test1/%d' % c1.id)
-    c2 = GuidGeneratorTestModel2(slug=u'example')
-    db.session.commit()
-    eq_(c2.unique_id, u'tag:inyoka.local,1970:inyoka/_test2/example')
+    # guids are written with the INSERT
+    with db.detect_n_plus_one() as detector:
+        c1 = GuidGeneratorTestModel1()
+        c2 = GuidGeneratorTestModel1()
+        db.session.commit()
+    assert_false([s for s in detector.counts if s.startswith('UPDATE')])
+    for obj in (c1, c2):
+        assert_true(re.match(r'^tag:inyoka.local,1970:inyoka/_test1/'
+                             r'[0-9a-f]{32}$', obj.guid))
+    assert_not_equal(c1.guid, c2.guid)
+
+    with db.detect_n_plus_one() as detector:
+        c3 = GuidGeneratorTestModel2(slug=u'example')
+        db.session.commit()
+    eq_(c3.unique_id, u'tag:inyoka.local,1970:inyoka/_test2/example')
+    assert_false([s for s in detector.counts if s.startswith('UPDATE')])
 
 
 @set_simple_cache
@@ -200,3 +285,502 @@ def test_atomic_add_on_joined_tables():
     # check that expire is working
     db.atomic_add(obj, 'view_count', +1, expire=True)
     eq_(obj.view_count, 1)
+
+
+def test_buffered_counter():
+    obj = DatabaseTestQuestion(title=u'some question')
+    db.session.commit()
+    # without a cache the increments are written through
+    DatabaseTestEntry.views.add(obj)
+    eq_(obj.view_count, 1)
+    eq_(obj.views, 1)
+
+
+@set_simple_cache
+def test_buffered_counter_local_cache(cache):
+    obj = DatabaseTestQuestion(title=u'some question')
+    db.session.commit()
+    # the simple cache is not shared by the processes, don't buffer there
+    DatabaseTestEntry.views.add(obj)
+    eq_(obj.view_count, 1)
+    eq_(db.flush_counters(), 0)
+
+
+@set_simple_cache
+def test_buffered_counter_flush(cache):
+    # pretend the simple cache was shared
+    cache_systems = db.BufferedCounter.cache_systems
+    db.BufferedCounter.cache_systems = ('simple',)
+    try:
+        obj1 = DatabaseTestQuestion(title=u'first question')
+        obj2 = DatabaseTestQuestion(title=u'second question')
+        db.session.commit()
+        for idx in xrange(3):
+            DatabaseTestEntry.views.add(obj1)
+        DatabaseTestEntry.views.add(obj2, 2)
+        # nothing is written until the buffer is flushed
+        eq_(db.session.query(DatabaseTestEntry.view_count).all(),
+            [(0,), (0,)])
+        eq_((obj1.views, obj2.views), (3, 2))
+
+        eq_(db.flush_counters(), 2)
+        db.session.expire_all()
+        eq_((obj1.view_count, obj2.view_count), (3, 2))
+        eq_((obj1.views, obj2.views), (3, 2))
+        eq_(db.flush_counters(), 0)
+    finally:
+        db.BufferedCounter.cache_systems = cache_systems
+
+
+@set_simple_cache
+def test_buffered_counter_concurrent_registration(cache):
+    cache_systems = db.BufferedCounter.cache_systems
+    db.BufferedCounter.cache_systems = ('simple',)
+    try:
+        objects = [DatabaseTestQuestion(title=u'question %d' % idx)
+                   for idx in xrange(3)]
+        db.session.commit()
+        counter = DatabaseTestEntry.views
+        # every row is registered once until it's flushed
+        for obj in objects[:2]:
+            counter.add(obj)
+            counter.add(obj)
+        eq_(cache.get(counter._get_cache_key('next')), 2)
+        # another process registering with the same stale position does
+        # not overwrite the rows already registered
+        cache.set(counter._get_cache_key('next'), 0)
+        counter.add(objects[2])
+        eq_(cache.get(counter._get_cache_key('slots', 2))[0], objects[2].id)
+
+        eq_(db.flush_counters(), 3)
+        db.session.expire_all()
+        eq_([obj.view_count for obj in objects], [2, 2, 1])
+        # rows are registered again after the flush
+        counter.add(objects[0])
+        eq_(db.flush_counters(), 1)
+        db.session.expire_all()
+        eq_(objects[0].view_count, 3)
+    finally:
+        db.BufferedCounter.cache_systems = cache_systems
+
+
+def test_bulk_insert():
+    SlugGeneratorTestModel(name=u'cat')
+    db.session.commit()
+
+    eq_(db.bulk_insert(SlugGeneratorTestModel,
+                       ({'name': u'cat'} for idx in xrange(5)), batch_size=2), 5)
+    objects = SlugGeneratorTestModel.query.order_by(SlugGeneratorTestModel.id).all()
+    eq_([x.slug for x in objects],
+        [u'cat', u'cat2', u'cat3', u'cat4', u'cat5', u'cat6'])
+
+    rows = [{'entry_id': objects[idx % 2].id} for idx in xrange(5)]
+    db.bulk_insert(DatabaseTestComment, rows,
+                   counters={'entry_id': (SlugGeneratorTestModel, 'count')})
+    db.session.expire_all()
+    eq_([x.count for x in objects[:3]], [3, 2, 0])
+
+    db.bulk_insert(GuidGeneratorTestModel1, [{}, {}])
+    guids = set(obj.guid for obj in GuidGeneratorTestModel1.query.all())
+    eq_(len(guids), 2)
+    for guid in guids:
+        assert_true(guid.startswith(u'tag:inyoka.local,1970:inyoka/_test1/'))
+    db.bulk_insert(GuidGeneratorTestModel2, [{'slug': u'bulk'}])
+    eq_(GuidGeneratorTestModel2.query.one().unique_id,
+        u'tag:inyoka.local,1970:inyoka/_test2/bulk')
+
+
+comment_counter = db.register_counter(SlugGeneratorTestModel.count,
+                                      DatabaseTestComment.entry_id)
+
+
+def test_reconcile_counters():
+    objects = [SlugGeneratorTestModel(name=u'cat%d' % idx, count=count)
+               for idx, count in enumerate((0, 5, 0, 1, 0))]
+    db.session.commit()
+    db.bulk_insert(DatabaseTestComment, [{'entry_id': objects[0].id},
+                                         {'entry_id': objects[0].id},
+                                         {'entry_id': objects[3].id}])
+    ids = [obj.id for obj in objects]
+    table = SlugGeneratorTestModel.__table__
+    db.session.execute(table.update(table.c.id == ids[2], {'count': None}))
+    db.session.commit()
+
+    drift = {ids[0]: 2, ids[1]: -5, ids[2]: 0}
+    eq_(db.reconcile_counters(fix=False)[comment_counter.name], drift)
+    eq_(comment_counter.reconcile(chunk_size=2), drift)
+    db.session.expunge_all()
+    eq_([SlugGeneratorTestModel.query.get(id).count for id in ids],
+        [2, 0, 0, 1, 0])
+    eq_(comment_counter.reconcile(), {})
+
+
+def test_reconcile_counters_concurrent_change():
+    obj = SlugGeneratorTestModel(name=u'concurrent', count=0)
+    db.session.commit()
+    ident = obj.id
+    table = SlugGeneratorTestModel.__table__
+    get_actual = comment_counter._get_actual
+
+    def racing_get_actual(first, last):
+        # a comment is added after the stored counts were read
+        db.session.execute(DatabaseTestComment.__table__.insert(),
+                           {'entry_id': ident})
+        db.session.execute(table.update(table.c.id == ident,
+                                        {'count': table.c.count + 1}))
+        return get_actual(first, last)
+
+    comment_counter._get_actual = racing_get_actual
+    try:
+        comment_counter.reconcile()
+    finally:
+        del comment_counter._get_actual
+    db.session.expunge_all()
+    eq_(SlugGeneratorTestModel.query.get(ident).count, 1)
+
+
+def test_projection():
+    category = DatabaseTestCategory(slug=u'pets')
+    SlugGeneratorTestModel(name=u'cat', categories=category)
+    SlugGeneratorTestModel(name=u'dog')
+    DatabaseTestQuestion(title=u'why', view_count=3)
+    db.session.commit()
+    category_id = category.id
+    db.session.expunge_all()
+
+    query = SlugGeneratorTestModel.query.order_by(SlugGeneratorTestModel.id)
+    rows = query.project('slug', 'categories.slug', category='categories.id')
+    eq_(rows.count(), 2)
+    eq_(rows.all(), [(u'cat', u'pets', category_id), (u'dog', None, None)])
+    eq_(rows.first().categories_slug, u'pets')
+    eq_(rows[1].category, None)
+    eq_(len(db.session.identity_map), 0)
+
+    # relations projected as rows of their own
+    rows = query.project('name', categories=('id', 'slug')).all()
+    eq_(rows, [(u'cat', (category_id, u'pets')), (u'dog', None)])
+    eq_(rows[0].categories.slug, u'pets')
+    eq_(rows[0].categories.display_slug, u'/pets/')
+    eq_(unicode(rows[0].categories), u'/pets/')
+    eq_(len(db.session.identity_map), 0)
+    assert_raises(ValueError, DatabaseTestCategory.query.project,
+                  'sluggies.slug')
+
+    question = DatabaseTestQuestion.query.project('title', 'view_count').one()
+    eq_(question, (u'why', 3))
+    eq_(question.get_url_values(action='edit'),
+        ('forum/question', {'slug': u'why', 'action': 'edit'}))
+
+
+def shared_reference_cache(func):
+    """Run `func` with the simple cache pretending to be shared."""
+    @set_simple_cache
+    @wraps(func)
+    def wrapper(cache):
+        cache_systems = db.ReferenceData.cache_systems
+        db.ReferenceData.cache_systems = ('simple',)
+        try:
+            func()
+        finally:
+            db.ReferenceData.cache_systems = cache_systems
+    return wrapper
+
+
+def count_queries(func):
+    with db.detect_n_plus_one() as detector:
+        result = func()
+    return result, sum(detector.counts.values())
+
+
+@shared_reference_cache
+def test_reference_data():
+    obj = DatabaseTestReference(slug=u'ref')
+    db.session.commit()
+    ident = obj.id
+    db.session.expunge_all()
+
+    eq_(count_queries(lambda: DatabaseTestReference.query.get(ident))[1], 1)
+    db.session.expunge_all()
+    result, queries = count_queries(lambda: DatabaseTestReference.query.get(ident))
+    eq_((result.slug, queries), (u'ref', 0))
+    assert_true(result in db.session)
+    result, queries = count_queries(
+        lambda: DatabaseTestReference.query.get_by(slug=u'ref'))
+    eq_(queries, 1)
+    result, queries = count_queries(
+        lambda: DatabaseTestReference.query.get_by(slug=u'ref'))
+    eq_(queries, 0)
+    assert_raises(db.NoResultFound, DatabaseTestReference.query.get_by,
+                  slug=u'missing')
+
+    # a commit invalidates the cache
+    result.slug = u'changed'
+    db.session.commit()
+    db.session.expunge_all()
+    result, queries = count_queries(lambda: DatabaseTestReference.query.get(ident))
+    eq_((result.slug, queries), (u'changed', 1))
+
+    # cached instances expire even if no change was noticed
+    max_age = ctx.cfg['database.reference_max_age']
+    ctx.cfg['database.reference_max_age'] = 0
+    try:
+        result.slug = u'expired'
+        db.session.commit()
+        for idx in xrange(2):
+            db.session.expunge_all()
+            eq_(count_queries(
+                lambda: DatabaseTestReference.query.get(ident))[1], 1)
+    finally:
+        ctx.cfg['database.reference_max_age'] = max_age
+
+
+@set_simple_cache
+def test_reference_data_not_shared(cache):
+    # other processes could not invalidate a per-process cache
+    obj = DatabaseTestReference(slug=u'unshared')
+    db.session.commit()
+    ident = obj.id
+    for idx in xrange(2):
+        db.session.expunge_all()
+        eq_(count_queries(lambda: DatabaseTestReference.query.get(ident))[1], 1)
+
+
+@shared_reference_cache
+def test_reference_data_keeps_changes():
+    obj = DatabaseTestReference(slug=u'keep')
+    db.session.commit()
+    ident = obj.id
+    db.session.expunge_all()
+    # fill the cache and get the instance into a new session
+    DatabaseTestReference.query.get(ident)
+    db.session.expunge_all()
+    obj = DatabaseTestReference.query.get(ident)
+
+    obj.slug = u'kept'
+    again = DatabaseTestReference.query.get(ident)
+    assert_true(again is obj)
+    eq_(again.slug, u'kept')
+    assert_true(again in db.session.dirty)
+    db.session.commit()
+    db.session.expunge_all()
+    eq_(DatabaseTestReference.query.filter_by(id=ident).one().slug, u'kept')
+
+
+@set_simple_cache
+def test_reference_data_fragments(cache):
+    from inyoka.core.cache import cached_fragment
+    calls = []
+    def render():
+        calls.append(1)
+        return u'fragment %d' % len(calls)
+    fragment = lambda: cached_fragment('ref', render, tags=['_test_reference'])
+
+    obj = DatabaseTestReference(slug=u'fragment')
+    db.session.commit()
+    eq_(fragment(), u'fragment 1')
+    # the fragments are invalidated once the change is committed
+    obj.slug = u'fragment changed'
+    db.session.flush()
+    eq_(fragment(), u'fragment 1')
+    db.session.commit()
+    eq_(fragment(), u'fragment 2')
+    # changes done by a rolled back transaction don't invalidate anything
+    obj.slug = u'fragment rolled back'
+    db.session.flush()
+    db.session.rollback()
+    eq_(fragment(), u'fragment 2')
+    # rows inserted without the orm are noticed as well
+    db.bulk_insert(DatabaseTestReference, [{'slug': u'fragment bulk'}])
+    eq_(fragment(), u'fragment 2')
+    db.session.commit()
+    eq_(fragment(), u'fragment 3')
+
+
+def test_date_buckets():
+    for date in (datetime(2010, 12, 24, 18), datetime(2010, 12, 31),
+                 datetime(2011, 1, 1, 12, 30), datetime(2011, 1, 1, 13)):
+        DatabaseTestEvent(date=date)
+    db.session.commit()
+
+    eq_(DatabaseTestEvent.query.date_buckets('date', 'year'),
+        [(datetime(2011, 1, 1), 2), (datetime(2010, 1, 1), 2)])
+    eq_(DatabaseTestEvent.query.date_buckets('date', 'day', limit=2),
+        [(datetime(2011, 1, 1), 2), (datetime(2010, 12, 31), 1)])
+    eq_(DatabaseTestEvent.query.dates('date', 'month'),
+        [(2011, 1), (2010, 12)])
+    eq_(DatabaseTestEvent.query.dates('date', 'hour', dt_obj=True)[:2],
+        [datetime(2011, 1, 1, 13), datetime(2011, 1, 1, 12)])
+    # the criteria of the query are respected
+    query = DatabaseTestEvent.query.filter(
+        DatabaseTestEvent.date < datetime(2011, 1, 1))
+    eq_(query.dates('date', 'month'), [(2010, 12)])
+
+
+def test_pool_status():
+    engine = db.get_engine('sqlite://', force_new=True)
+    assert_true(isinstance(engine.pool.listeners[0], db_module.PingListener))
+    engine.execute('SELECT 1')
+    status = db.get_pool_status()
+    assert_true('status' in status['pools']['primary'])
+    eq_([bound for bound, count in status['wait_times']],
+        [0.001, 0.01, 0.1, 1, 10, None])
+
+    # a broken connection is replaced on checkout
+    connection = engine.connect()
+    connection.connection.connection.close()
+    connection.close()
+    eq_(engine.execute('SELECT 2').scalar(), 2)
+    engine.dispose()
+
+
+def test_pool_wait_times():
+    import sqlite3
+    pool = db_module.InyokaQueuePool(lambda: sqlite3.connect(':memory:'),
+                                     pool_size=1, max_overflow=0,
+                                     timeout=0.05)
+    waits = db_module.pool_wait_times
+    waits.clear()
+    try:
+        # opening a connection is no wait
+        connection = pool.connect()
+        eq_(sum(count for bound, count in waits.snapshot()), 0)
+        connection.close()
+        connection = pool.connect()
+        eq_(waits.snapshot()[0], (0.001, 1))
+        # wait until the pool gives up
+        assert_raises(db_module.exc.TimeoutError, pool.connect)
+        snapshot = waits.snapshot()
+        eq_(snapshot[0], (0.001, 1))
+        eq_(sum(count for bound, count in snapshot), 2)
+        connection.close()
+    finally:
+        pool.dispose()
+        waits.clear()
+
+
+def test_select_blocks():
+    # leave some gaps so that fixed range windows would run empty
+    categories = [DatabaseTestCategory(slug=u'block%d' % idx) for idx in xrange(25)]
+    db.session.commit()
+    for category in categories[3:12]:
+        db.session.delete(category)
+    db.session.commit()
+    expected = [c.id for c in categories[:3] + categories[12:]]
+    db.session.expunge_all()
+
+    query = DatabaseTestCategory.query
+    result = []
+    for obj in db.select_blocks(query, DatabaseTestCategory.id, block_size=4):
+        assert_true(obj in db.session)
+        result.append(obj)
+    eq_([c.id for c in result], expected)
+    # instances of exhausted blocks are removed from the session
+    assert_false(any(obj in db.session for obj in result))
+
+    # start with an inclusive key and use a tuple of ordered columns
+    blocks = db.select_blocks(query, (DatabaseTestCategory.slug,
+                                      DatabaseTestCategory.id),
+                              block_size=3, start_with=(u'block20', 0))
+    eq_([c.slug for c in blocks],
+        [u'block20', u'block21', u'block22', u'block23', u'block24'])
+
+
+def test_replica_routing():
+    # two sqlite files act as primary and replica database
+    files = [mkstemp(suffix='.db')[1] for idx in xrange(2)]
+    primary, replica = [db.create_engine('sqlite:///' + f) for f in files]
+    metadata = db.MetaData()
+    table = db.Table('_test_database_replica', metadata,
+        db.Column('id', db.Integer, primary_key=True),
+        db.Column('origin', db.String(20)))
+    for engine in (primary, replica):
+        metadata.create_all(engine)
+        engine.execute(table.insert(), origin=unicode(engine.url.database))
+
+    try:
+        session = InyokaSession(bind=primary, replicas=[replica])
+        origin = lambda: session.execute(db.select([table.c.origin])).scalar()
+        # reads go to the replica...
+        eq_(origin(), files[1])
+        assert_false(session.wrote)
+        # ...until the session writes something.
+        session.execute(table.update().values(origin=u'updated'))
+        assert_true(session.wrote)
+        eq_(origin(), u'updated')
+        session.commit()
+        eq_(origin(), u'updated')
+        # closing the session ends the stickiness
+        session.close()
+        eq_(origin(), files[1])
+        session.use_primary = True
+        eq_(origin(), u'updated')
+        session.close()
+    finally:
+        for engine in (primary, replica):
+            engine.dispose()
+        for f in files:
+            os.remove(f)
+
+
+def test_replica_middleware_unsafe_methods():
+    from inyoka.core.middlewares import ReplicaMiddleware
+    middleware = ctx.get_instance(ReplicaMiddleware)
+    session = db.session()
+    session.replicas = [db.get_engine()]
+    try:
+        for method, use_primary in (('GET', False), ('HEAD', False),
+                                    ('POST', True), ('DELETE', True)):
+            with ctx.dispatcher.test_request_context(method=method) as reqctx:
+                middleware.process_request(reqctx.request)
+                eq_(session.use_primary, use_primary)
+            session.close()
+    finally:
+        session.replicas = []
+        session.close()
+
+
+def test_query_accounting():
+    _sample_rate = ctx.cfg['database.stats_sample_rate']
+    ctx.cfg['database.stats_sample_rate'] = 1
+    db.query_stats.clear()
+    try:
+        base_url = 'http://%s/' % ctx.cfg['base_domain_name']
+        with ctx.dispatcher.test_request_context(base_url=base_url) as reqctx:
+            request = reqctx.request
+            eq_(request.db_statements, 0)
+            DatabaseTestCategory(slug=u'counted')
+            db.session.commit()
+            DatabaseTestCategory.query.filter_by(slug=u'counted').one()
+            assert_true(request.db_statements >= 2)
+            assert_true(request.db_time >= 0)
+            db.record_query_stats(request)
+            stats = db.query_stats.snapshot()[request.endpoint]
+            eq_(stats['samples'], 1)
+            eq_(stats['statements'], request.db_statements)
+    finally:
+        ctx.cfg['database.stats_sample_rate'] = _sample_rate
+        db.query_stats.clear()
+
+
+def test_n_plus_one_detection():
+    categories = [DatabaseTestCategory(slug=u'nplusone%d' % idx) for idx in xrange(4)]
+    db.session.commit()
+    ids = [c.id for c in categories]
+    db.session.expunge_all()
+
+    with db.detect_n_plus_one(threshold=3) as detector:
+        for id in ids:
+            DatabaseTestCategory.query.filter_by(id=id).one()
+    eq_(len(detector.offenders), 1)
+    assert_true(u'4 times' in detector.report())
+    assert_true(u'WHERE _test_database_category.id = ?' in detector.report())
+
+    with assert_no_n_plus_one(threshold=3):
+        DatabaseTestCategory.query.filter(DatabaseTestCategory.id.in_(ids)).all()
+        DatabaseTestCategory.query.filter(DatabaseTestCategory.id.in_(ids[:2])).all()
+
+    def _n_plus_one():
+        with assert_no_n_plus_one(threshold=2):
+            for id in ids:
+                DatabaseTestCategory.query.filter_by(id=id).one()
+    assert_raises(AssertionError, _n_plus_one)
@@ -9,7 +9,7 @@
     :license: GNU GPL, see LICENSE for more details.
 """
 from inyoka.core.test import *
-from inyoka.core.http import FlashMessage
+from inyoka.core.http import FlashMessage, iter_coalesced
 
 
 class TestRequest(ViewTestCase):
@@ -32,3 +32,10 @@ class TestRequest(ViewTestCase):
             id = req.flash(u'Message5')
             assert_false(id is None)
             assert_true(isinstance(id, unicode))
+
+
+def test_iter_coalesced():
+    chunks = list(iter_coalesced(['a', 'bc', 'def', 'g', 'hi'], 3))
+    eq_(chunks, ['abc', 'def', 'ghi'])
+    eq_(list(iter_coalesced(['a', 'b'], 10)), ['ab'])
+    eq_(list(iter_coalesced([], 10)), [])
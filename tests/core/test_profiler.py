@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+    test_profiler
+    ~~~~~~~~~~~~~
+
+    Tests for the sampling profiler middleware.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+import shutil
+from tempfile import mkdtemp
+from werkzeug import Client, BaseResponse, create_environ
+from inyoka.core.test import *
+from inyoka.core.middlewares.profiler import make_profile_token, \
+     load_profile, ProfilerMiddleware
+
+
+def test_signed_profile():
+    path = mkdtemp()
+    _old = ctx.cfg['profiling.path'], ctx.cfg['profiling.allow_signed']
+    ctx.cfg['profiling.path'] = path
+    ctx.cfg['profiling.allow_signed'] = True
+    try:
+        client = Client(ctx.dispatcher, BaseResponse)
+        base_url = 'http://%s/' % ctx.cfg['base_domain_name']
+        client.get('/', base_url=base_url, buffered=True,
+                   headers=[('X-Inyoka-Profile', 'invalid')])
+        eq_(load_profile('portal/index', path), None)
+        # the profile is saved when the server closes the body
+        for x in xrange(2):
+            client.get('/', base_url=base_url, buffered=True,
+                       headers=[('X-Inyoka-Profile', make_profile_token('/'))])
+        stats = load_profile('portal/index', path)
+        assert_true(stats.total_calls > 0)
+        eq_(load_profile('portal', path), None)
+    finally:
+        ctx.cfg['profiling.path'], ctx.cfg['profiling.allow_signed'] = _old
+        shutil.rmtree(path)
+
+
+def _generate_chunk():
+    return 'chunk'
+
+
+def test_profile_streamed_body():
+    path = mkdtemp()
+    _old = ctx.cfg['profiling.path'], ctx.cfg['profiling.allow_signed']
+    ctx.cfg['profiling.path'] = path
+    ctx.cfg['profiling.allow_signed'] = True
+    middleware = ctx.get_instance(ProfilerMiddleware)
+    _application = middleware.application
+
+    class DummyRequest(object):
+        endpoint = 'test/streamed'
+
+    def application(environ, start_response):
+        environ['werkzeug.request'] = DummyRequest()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (_generate_chunk() for x in xrange(3))
+
+    middleware.application = application
+    try:
+        environ = create_environ('/streamed', headers=[
+            ('X-Inyoka-Profile', make_profile_token('/streamed'))])
+        app_iter = middleware(environ, lambda status, headers: None)
+        # the profile is saved when the body is closed
+        eq_(load_profile('test/streamed', path), None)
+        eq_(''.join(app_iter), 'chunk' * 3)
+        app_iter.close()
+        stats = load_profile('test/streamed', path)
+        functions = [name for filename, line, name in stats.stats]
+        assert_true('_generate_chunk' in functions)
+    finally:
+        middleware.application = _application
+        ctx.cfg['profiling.path'], ctx.cfg['profiling.allow_signed'] = _old
+        shutil.rmtree(path)
@@ -9,9 +9,10 @@
     :license: GN UGPL, see LICENSE for more details.
 """
 from datetime import date
-from werkzeug.routing import ValidationError
+from werkzeug.routing import ValidationError, Map as WerkzeugMap, Rule, \
+     Subdomain
 from inyoka.core.test import *
-from inyoka.core.routing import DateConverter
+from inyoka.core.routing import DateConverter, Map, href
 
 
 
@@ -37,3 +38,89 @@ def test_date_converter():
     assert_raises(ValidationError, d.to_python, '2009 2009')
     d = DateConverter(map, '%Y %m')
     assert_raises(ValidationError, d.to_python, '2009 13')
+
+
+def test_cached_build():
+    def make_rules():
+        return [
+            Rule('/', endpoint='index'),
+            Rule('/questions/', endpoint='questions',
+                 defaults={'sort': 'latest', 'page': 1}),
+            Rule('/questions/<int:page>/', endpoint='questions',
+                 defaults={'sort': 'latest'}),
+            Rule('/questions/<any(latest, votes):sort>/', endpoint='questions',
+                 defaults={'page': 1}),
+            Rule('/questions/<any(latest, votes):sort>/<int:page>/',
+                 endpoint='questions'),
+            Rule('/post/', endpoint='post', methods=('POST',)),
+            Rule('/post/<int:id>/', endpoint='post'),
+            Subdomain('forum', [Rule('/<slug>/', endpoint='question')]),
+        ]
+    cached = Map(make_rules()).bind('example.com')
+    plain = WerkzeugMap(make_rules()).bind('example.com')
+
+    builds = [
+        ('index', {}), ('index', {'q': 'foo'}),
+        ('questions', {}), ('questions', {'page': 1}),
+        ('questions', {'page': 3}), ('questions', {'sort': 'votes'}),
+        ('questions', {'sort': 'latest', 'page': 2}),
+        ('questions', {'sort': 'votes', 'page': 2, 'tag': 'x'}),
+        ('questions', {'sort': 'invalid'}),
+        ('post', {}), ('post', {'id': 4}), ('question', {'slug': u'fööbar'}),
+    ]
+    # twice to use the cache
+    for endpoint, values in builds * 2:
+        eq_(cached.build(endpoint, values), plain.build(endpoint, values))
+    eq_(cached.build('post', {}, method='POST'),
+        plain.build('post', {}, method='POST'))
+
+
+def test_url_adapter_reuse():
+    base_url = 'http://%s/' % ctx.cfg['base_domain_name']
+    with ctx.dispatcher.test_request_context(base_url=base_url) as reqctx:
+        adapter = ctx.dispatcher.get_url_adapter()
+        assert_true(adapter is reqctx.url_adapter)
+        assert_true(adapter is ctx.dispatcher.get_url_adapter())
+        eq_(href('portal/index'), u'/')
+    adapter = ctx.dispatcher.get_url_adapter()
+    assert_true(adapter is ctx.dispatcher.get_url_adapter())
+
+
+def test_partitioned_match():
+    def make_rules():
+        return [
+            Rule('/', endpoint='index'),
+            Rule('/about', endpoint='about'),
+            Rule('/questions/', endpoint='questions',
+                 defaults={'page': 1}),
+            Rule('/questions/<int:page>/', endpoint='questions'),
+            Rule('/post/', endpoint='post', methods=('POST',)),
+            Rule('/post/<int:id>/', endpoint='post'),
+            Rule('/p<int:id>', endpoint='short'),
+            Rule('/old/<int:id>/', redirect_to='post/<id>/'),
+            Rule('/<slug>/', endpoint='page'),
+            Subdomain('forum', [
+                Rule('/', endpoint='forum'),
+                Rule('/questions/', endpoint='forum_questions'),
+            ]),
+            Subdomain('<user>', [Rule('/blog/', endpoint='blog')]),
+        ]
+    cached = Map(make_rules())
+    plain = WerkzeugMap(make_rules())
+
+    def match(map, subdomain, path, method):
+        adapter = map.bind('example.com', subdomain=subdomain)
+        try:
+            return adapter.match(path, method)
+        except Exception, exc:
+            return type(exc), getattr(exc, 'new_url', None), \
+                   sorted(getattr(exc, 'valid_methods', None) or ())
+
+    paths = ['/', '/about', '/about/', '/questions', '/questions/',
+             '/questions/1/', '/questions/2/', '/post/', '/post/3/', '/p5',
+             '/old/4/', '/foo/', '/foo', '/blog/', '/a/b/', u'/föö/']
+    for subdomain in ('', 'forum', 'anyone'):
+        for path in paths:
+            for method in ('GET', 'POST'):
+                eq_(match(cached, subdomain, path, method),
+                    match(plain, subdomain, path, method))
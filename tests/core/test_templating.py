@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    test_templating
+    ~~~~~~~~~~~~~~~
+
+    Tests for the template environment.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+import os
+import shutil
+import tempfile
+from jinja2 import TemplateNotFound
+from inyoka.core.test import *
+from inyoka.core.templating import get_environment, compile_templates, \
+     CompiledLoader
+
+
+def test_compile_templates():
+    env = get_environment()
+    target = os.path.join(tempfile.mkdtemp(), 'compiled')
+    try:
+        eq_(compile_templates(target), len(env.list_templates()))
+        loader = CompiledLoader(target, env.loader)
+        template = loader.load(env, 'paste/view.html')
+        assert_true(template.filename.startswith(target))
+        assert_raises(TemplateNotFound, loader.load, env, 'missing.html')
+    finally:
+        shutil.rmtree(os.path.dirname(target))
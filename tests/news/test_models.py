@@ -51,6 +51,10 @@ class TestNewsModels(DatabaseTestCase):
     def test_article_attributes(self):
         article = self.data['Article'][0]
         eq_(article.slug, 'my-ubuntu-rocks')
+        # the guid must not change with the slug
+        assert_true(article.guid.startswith(u'%snews/article/'
+                                            % ctx.cfg['tag_uri_base']))
+        assert_false(article.slug in article.guid)
 
     def test_comment_counter(self):
         article = self.data['Article'][0]
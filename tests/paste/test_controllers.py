@@ -8,9 +8,14 @@
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
+from werkzeug import Client, BaseResponse
 from inyoka.core.test import *
-from inyoka.paste.controllers import PasteController
+from inyoka.core.auth.models import User
+from inyoka.core.routing import href
+from inyoka.paste.controllers import PasteController, paste_version, \
+     raw_paste_version
 from inyoka.paste.models import PasteEntry
+from inyoka.utils.timing import get_request_stats
 
 
 class TestPasteController(ViewTestCase):
@@ -34,3 +39,91 @@ class TestPasteController(ViewTestCase):
         self.assertEqual(PasteEntry.query.filter_by(title=u'Test Paste').count(), 1)
         db.session.delete(PasteEntry.query.filter_by(title=u'Test Paste').first())
         db.session.commit()
+
+    def test_browse(self):
+        paste = PasteEntry(text=u'print 42', language=u'python',
+                           author=User.query.get_anonymous())
+        db.session.commit()
+        paste_id, username = paste.id, paste.author.username
+        resp = self.open('/browse/')
+        self.assertResponseOK(resp)
+        self.assertTemplateUsed('paste/browse.html')
+        entry = self.get_context_variable('pastes')[0]
+        self.assertEqual(entry.id, paste_id)
+        self.assertEqual(entry.author.username, username)
+        self.assertTrue(('/paste/%d/' % paste_id) in resp.data)
+        self.assertTrue(('Paste #%d' % paste_id) in resp.data)
+        self.assertTrue(str(href('portal/profile', username=username))
+                        in resp.data)
+
+    def test_streamed_view(self):
+        paste = PasteEntry(text=u'print 42', language=u'python',
+                           author=User.query.get_anonymous())
+        db.session.commit()
+        resp = self.open('/paste/%d/' % paste.id)
+        self.assertResponseOK(resp)
+        self.assertTemplateUsed('paste/view.html')
+        self.assertFalse('Content-Length' in resp.headers)
+        self.assertTrue('print' in resp.data)
+        self.assertTrue(resp.data.rstrip().endswith('</html>'))
+
+        # the request is recorded after the body was sent
+        samples = lambda: get_request_stats().get('paste/view',
+            {'phases': {}})['phases'].get('samples', 0)
+        before = samples()
+        client = Client(ctx.dispatcher, BaseResponse)
+        resp = client.get('/paste/%d/' % paste.id, base_url=self.base_url)
+        self.assertEqual(samples(), before)
+        self.assertTrue('print' in resp.data)
+        resp.close()
+        self.assertEqual(samples(), before + 1)
+
+    def test_conditional_view(self):
+        paste = PasteEntry(text=u'print 42', language=u'python',
+                           author=User.query.get_anonymous())
+        db.session.commit()
+        paste_id = paste.id
+        path = '/paste/%d/' % paste_id
+        resp = self.open(path)
+        self.assertResponseOK(resp)
+        etag = resp.headers['ETag']
+        self.templates = []
+        resp = self.open(path, headers=[('If-None-Match', etag)])
+        self.assertStatus(resp, 304)
+        self.assertEqual(self.templates, [])
+
+        PasteEntry.query.get(paste_id).text = u'print 23'
+        db.session.commit()
+        resp = self.open(path, headers=[('If-None-Match', etag)])
+        self.assertResponseOK(resp)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        # the title of the parent and the name of the author are rendered
+        parent = PasteEntry(text=u'print 1', language=u'python',
+                            title=u'First', author=User.query.get_anonymous())
+        PasteEntry.query.get(paste_id).parent = parent
+        db.session.commit()
+        etag = self.open(path).headers['ETag']
+        PasteEntry.query.get(parent.id).title = u'Second'
+        db.session.commit()
+        resp = self.open(path, headers=[('If-None-Match', etag)])
+        self.assertResponseOK(resp)
+
+        author = User(username=u'_test_paste_author', email=u'paste@example.com')
+        PasteEntry.query.get(paste_id).author = author
+        db.session.commit()
+        etag = self.open(path).headers['ETag']
+        User.query.get(u'_test_paste_author').username = u'_test_renamed'
+        db.session.commit()
+        resp = self.open(path, headers=[('If-None-Match', etag)])
+        self.assertResponseOK(resp)
+
+        # the validators query their columns only
+        request = type('Request', (object,), {'user': author})
+        author.id  # loaded before the instance is detached
+        db.session.expunge_all()
+        for validator in (paste_version, raw_paste_version):
+            with db.detect_n_plus_one() as detector:
+                self.assertNotEqual(validator(None, request, paste_id), None)
+            self.assertEqual(sum(detector.counts.values()), 1)
+            self.assertEqual(validator(None, request, paste_id + 100), None)
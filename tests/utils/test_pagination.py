@@ -8,11 +8,15 @@
     :copyright: 2009-2011 by the Inyoka Team, see AUTHORS for more details.
     :license: GNU GPL, see LICENSE for more details.
 """
+import json
 import random
+from base64 import urlsafe_b64encode
+from datetime import date
+from werkzeug import url_decode
 from inyoka.core.test import *
 from inyoka.core.exceptions import NotFound
 from inyoka.utils.pagination import URLPagination, GETPagination, \
-    PageURLPagination
+    PageURLPagination, KeysetURLPagination
 
 
 GROUP_COUNTS = [0, 1, 3, 14, 15, 16, 30, 31, 50, 70, 80]
@@ -41,6 +45,8 @@ class PaginationTest1(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     group = db.Column(db.Integer)
+    day = db.Column(db.Date)
+    score = db.Column(db.Float)
 
 
 class QueryMock(object):
@@ -255,3 +261,97 @@ def test_getpagination_links(fixtures):
     eq_(GETPagination(q, 2, args={'a':'b'}).make_link(1), '?a=b')
     eq_(GETPagination(q, 2, args={'a':'b'}).make_link(2), '?a=b&page=2')
     eq_(GETPagination(q, 2, args={'a':'b'}).make_template(), '?a=b&page=!')
+
+
+def test_button_window():
+    p = URLPagination(QueryMock(), 5000, total=150000, per_page=15)
+    eq_(p.pages, 10000)
+    eq_(list(p._get_buttons()), [
+        ('prev', '../4999/'),
+        (1, '../'),
+        (2, '../2/'),
+        ('ellipsis', '../!/'),
+        (4999, '../4999/'),
+        (5000, None),
+        (5001, '../5001/'),
+        ('ellipsis', '../!/'),
+        (10000, '../10000/'),
+        ('next', '../5001/'),
+    ])
+
+
+@with_fixtures(fixtures)
+def test_keyset_pagination(fixtures):
+    query = PaginationTest1.query.filter(PaginationTest1.group >= 9) \
+                                 .order_by(PaginationTest1.group.desc())
+    expected = query.order_by(PaginationTest1.id.desc()).all()
+    p = KeysetURLPagination(query, 1, per_page=40)
+    eq_(p.pages, 4)
+    eq_(list(p.query), expected[:40])
+
+    # follow the `next` links to the last page
+    page = 1
+    while page < p.pages:
+        after = url_decode(p.make_link(page + 1).split('?')[1])['after']
+        page += 1
+        with db.detect_n_plus_one() as detector:
+            p = KeysetURLPagination(query, page, per_page=40, after=after,
+                                    total=150)
+        eq_(list(p.query), expected[(page - 1) * 40:page * 40])
+        statement, = detector.counts
+        assert_true('_test_utils_pagination1.id < ?' in statement)
+
+    # and back again
+    before = url_decode(p.make_link(3).split('?')[1])['before']
+    p = KeysetURLPagination(query, 3, per_page=40, before=before)
+    eq_(list(p.query), expected[80:120])
+    eq_(p.make_link(1), '../')
+
+    assert_raises(NotFound, KeysetURLPagination, query, 2, per_page=40,
+                  after='garbage')
+
+
+def test_keyset_pagination_nulls():
+    for group in [None, 1, None, 2, 1, None, 2, None, 1]:
+        db.session.add(PaginationTest1(group=group))
+    db.session.commit()
+    for ordering in (PaginationTest1.group, PaginationTest1.group.desc()):
+        query = PaginationTest1.query.order_by(ordering)
+        expected = query.order_by(PaginationTest1.id).all()
+        if ordering is not PaginationTest1.group:
+            expected = query.order_by(PaginationTest1.id.desc()).all()
+        p = KeysetURLPagination(query, 1, per_page=2)
+        pages = [list(p.query)]
+        # rows with a NULL sort key are neither skipped nor repeated
+        while p.page < p.pages:
+            after = url_decode(p.make_link(p.page + 1).split('?')[1])['after']
+            p = KeysetURLPagination(query, p.page + 1, per_page=2,
+                                    after=after)
+            pages.append(list(p.query))
+        eq_(sum(pages, []), expected)
+        while p.page > 2:
+            before = url_decode(
+                p.make_link(p.page - 1).split('?')[1])['before']
+            p = KeysetURLPagination(query, p.page - 1, per_page=2,
+                                    before=before)
+            eq_(list(p.query), pages[p.page - 1])
+
+
+def test_keyset_cursor_types():
+    class Row(object):
+        id = 5
+        day = date(2011, 1, 2)
+
+    p = KeysetURLPagination(PaginationTest1.query.order_by(
+        PaginationTest1.day), 1)
+    cursor = p.encode_cursor(Row())
+    eq_(p.decode_cursor(cursor), [date(2011, 1, 2), 5])
+    Row.day = u'2011-01-02'
+    assert_raises(TypeError, p.encode_cursor, Row())
+    cursor = urlsafe_b64encode(json.dumps(['2011-01-02', '5']))
+    assert_raises(NotFound, p.decode_cursor, cursor)
+
+    # orderings by unsupported types fall back to an offset
+    p = KeysetURLPagination(PaginationTest1.query.order_by(
+        PaginationTest1.score), 1)
+    eq_(p.order, None)
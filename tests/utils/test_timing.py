@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+    test_timing
+    ~~~~~~~~~~~
+
+    Tests for the request phase timings.
+
+    :copyright: 2011 by the Inyoka Team, see AUTHORS for more details.
+    :license: GNU GPL, see LICENSE for more details.
+"""
+from werkzeug import Client, BaseResponse
+from inyoka.core.test import *
+from inyoka.utils.timing import format_server_timing, get_request_stats
+
+
+def test_format_server_timing():
+    eq_(format_server_timing({'view': 0.0125, 'db': 0.002}),
+        'db;dur=2.0, view;dur=12.5')
+
+
+def test_server_timing_header():
+    _old = ctx.cfg['timing.server_timing_header']
+    ctx.cfg['timing.server_timing_header'] = True
+    try:
+        client = Client(ctx.dispatcher, BaseResponse)
+        response = client.get('/', base_url='http://%s/' %
+                              ctx.cfg['base_domain_name'])
+    finally:
+        ctx.cfg['timing.server_timing_header'] = _old
+    phases = [value.split(';')[0] for value in
+              response.headers['Server-Timing'].split(', ')]
+    for phase in ('routing', 'view', 'template', 'db', 'total'):
+        assert_true(phase in phases, phase)
+    assert_true(any(phase.startswith('mw.') for phase in phases))
+
+    stats = get_request_stats()['portal/index']
+    assert_true(stats['phases']['samples'] > 0)
+    eq_(sum(count for bound, count in stats['latency']),
+        stats['phases']['samples'])
+
+
+def test_request_stats_access():
+    client = Client(ctx.dispatcher, BaseResponse)
+    base_url = 'http://api.%s/' % ctx.cfg['base_domain_name']
+    get = lambda address, headers=(): client.get(
+        '/dev/core/request_stats/?format=json', base_url=base_url,
+        headers=list(headers), environ_overrides={'REMOTE_ADDR': address})
+    eq_(get('127.0.0.1').status_code, 200)
+    eq_(get('192.0.2.1').status_code, 403)
+    # the address of a proxy does not grant access
+    eq_(get('127.0.0.1', [('X-Forwarded-For', '192.0.2.1')]).status_code,
+        403)